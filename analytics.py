@@ -0,0 +1,75 @@
+"""Aggregate queries for the monitoring dashboard.
+
+Each function is a single GROUP BY query over a user's jobs scheduled in a
+date range, with segment and template names joined in SQL, so the dashboard
+needs three round trips however many jobs there are.
+"""
+from sqlalchemy import func
+
+from app import db
+from models import ScheduledJob, EmailSegment, EmailTemplate
+
+JOB_STATUSES = ('scheduled', 'running', 'completed', 'failed', 'cancelled')
+
+
+def _in_period(query, user_id, from_date, to_date):
+    return query.filter(
+        ScheduledJob.user_id == user_id,
+        ScheduledJob.scheduled_time >= from_date,
+        ScheduledJob.scheduled_time <= to_date
+    )
+
+
+def get_status_counts(user_id, from_date, to_date):
+    """Return {status: job count} for every status in JOB_STATUSES"""
+    query = db.session.query(ScheduledJob.status, func.count(ScheduledJob.id))
+    rows = _in_period(query, user_id, from_date, to_date).group_by(ScheduledJob.status).all()
+
+    counts = dict.fromkeys(JOB_STATUSES, 0)
+    for status, count in rows:
+        if status in counts:
+            counts[status] = count
+    return counts
+
+
+def _performance(model, group_column, name_key, user_id, from_date, to_date):
+    query = db.session.query(
+        model.name,
+        func.sum(func.coalesce(ScheduledJob.total_emails, 0)).label('total'),
+        func.sum(func.coalesce(ScheduledJob.sent_emails, 0)).label('sent'),
+        func.sum(func.coalesce(ScheduledJob.unique_opens, 0)).label('opened'),
+        func.sum(func.coalesce(ScheduledJob.unique_clicks, 0)).label('clicked'),
+        func.sum(func.coalesce(ScheduledJob.failed_emails, 0)).label('failed')
+    ).join(model, group_column == model.id)
+    rows = _in_period(query, user_id, from_date, to_date).group_by(group_column, model.name).all()
+
+    performance = []
+    for row in rows:
+        performance.append({
+            name_key: row.name,
+            'total': row.total,
+            'sent': row.sent,
+            'opened': row.opened,
+            'clicked': row.clicked,
+            'failed': row.failed,
+            'open_rate': (row.opened / row.sent * 100) if row.sent > 0 else 0,
+            'click_rate': (row.clicked / row.opened * 100) if row.opened > 0 else 0,
+            'bounce_rate': (row.failed / row.total * 100) if row.total > 0 else 0,
+        })
+    return performance
+
+
+def get_segment_performance(user_id, from_date, to_date):
+    """Return per-segment totals and rates, best open rate first"""
+    performance = _performance(
+        EmailSegment, ScheduledJob.segment_id, 'segment_name', user_id, from_date, to_date
+    )
+    return sorted(performance, key=lambda x: x['open_rate'], reverse=True)
+
+
+def get_template_performance(user_id, from_date, to_date):
+    """Return per-template totals and rates, best click rate first"""
+    performance = _performance(
+        EmailTemplate, ScheduledJob.template_id, 'template_name', user_id, from_date, to_date
+    )
+    return sorted(performance, key=lambda x: x['click_rate'], reverse=True)
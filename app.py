@@ -58,6 +58,11 @@ app.config["MAIL_DEFAULT_SENDER"] = "noreply@yourdomain.com"
 app.config["BREVO_API_KEY"] = os.environ.get("BREVO_API_KEY")
 app.config["USE_BREVO_API"] = True if os.environ.get("BREVO_API_KEY") else False
 
+# Send campaigns from worker.py processes instead of the web process
+app.config["USE_SEND_WORKERS"] = os.environ.get("USE_SEND_WORKERS", "").lower() in ("1", "true", "yes")
+# Set by worker.py; send workers run neither the scheduler nor the tracking buffer
+app.config["SEND_WORKER"] = os.environ.get("SEND_WORKER") == "1"
+
 # Initialize extensions with app
 db.init_app(app)
 login_manager.init_app(app)
@@ -91,9 +96,18 @@ with app.app_context():
 # Import routes to register them with the app
 import routes  # noqa: F401
 
-# Initialize scheduler
-try:
-    from scheduler import init_scheduler
-    init_scheduler(app)
-except ImportError:
-    pass  # Scheduler module may not exist yet
+# Write per-recipient send errors to the job log in batches
+from job_log_writer import job_log_writer
+job_log_writer.start(app)
+
+if not app.config["SEND_WORKER"]:
+    # Start writing queued open/click tracking events in the background
+    from tracking_buffer import tracking_buffer
+    tracking_buffer.start(app)
+    
+    # Initialize scheduler
+    try:
+        from scheduler import init_scheduler
+        init_scheduler(app)
+    except ImportError:
+        pass  # Scheduler module may not exist yet
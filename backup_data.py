@@ -3,7 +3,7 @@ import sys
 import json
 import datetime
 from app import app, db
-from models import User, EmailSegment, Contact, EmailTemplate, SMTPConfig, ScheduledJob
+from models import User, EmailSegment, Contact, SegmentMembership, EmailTemplate, SMTPConfig, ScheduledJob
 
 def backup_data():
     """
@@ -48,7 +48,10 @@ def backup_data():
                     'description': segment.description,
                     'created_at': str(segment.created_at),
                     'updated_at': str(segment.updated_at),
-                    'user_id': segment.user_id
+                    'user_id': segment.user_id,
+                    'rules': segment.rules,
+                    'materialize': segment.materialize,
+                    'refresh_ttl_minutes': segment.refresh_ttl_minutes
                 })
                 
             with open(f'{backup_dir}/segments_{timestamp}.json', 'w') as f:
@@ -62,13 +65,26 @@ def backup_data():
                     'id': contact.id,
                     'email': contact.email,
                     'name': contact.name,
-                    'segment_id': contact.segment_id,
+                    'user_id': contact.user_id,
                     'created_at': str(contact.created_at)
                 })
                 
             with open(f'{backup_dir}/contacts_{timestamp}.json', 'w') as f:
                 json.dump(contact_data, f, indent=2)
                 
+            # Back up Segment Memberships
+            memberships = SegmentMembership.query.all()
+            membership_data = []
+            for membership in memberships:
+                membership_data.append({
+                    'segment_id': membership.segment_id,
+                    'contact_id': membership.contact_id,
+                    'created_at': str(membership.created_at)
+                })
+                
+            with open(f'{backup_dir}/segment_memberships_{timestamp}.json', 'w') as f:
+                json.dump(membership_data, f, indent=2)
+                
             # Back up Templates
             templates = EmailTemplate.query.all()
             template_data = []
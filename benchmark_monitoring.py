@@ -0,0 +1,142 @@
+"""
+Benchmark for the monitoring dashboard's status and performance queries.
+
+Seeds a throwaway SQLite database with one user's jobs spread over segments
+and templates, then compares the query count and latency of the previous
+per-status count() calls plus per-job segment/template lazy loads against
+the GROUP BY queries in analytics.py.
+
+    python benchmark_monitoring.py [job_count]
+"""
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# Never point the benchmark at a real database
+_db_file = os.path.join(tempfile.mkdtemp(), 'benchmark.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{_db_file}'
+
+import sqlalchemy as sa
+from app import db, app
+from models import User, EmailSegment, EmailTemplate, SMTPConfig, ScheduledJob
+import analytics
+
+SEGMENTS = 50
+TEMPLATES = 50
+RUNS = 5
+
+def seed(job_count):
+    """Create one user with job_count jobs over the last 30 days"""
+    user = User(username='benchmark', email='benchmark@example.com', password_hash='x', is_active=True)
+    db.session.add(user)
+    db.session.flush()
+
+    segments = [EmailSegment(name=f'Segment {i}', user_id=user.id) for i in range(SEGMENTS)]
+    templates = [EmailTemplate(name=f'Template {i}', subject='Hi', content='<p>Hi</p>', type='newsletter', user_id=user.id)
+                 for i in range(TEMPLATES)]
+    smtp = SMTPConfig(name='smtp', host='localhost', port=25, username='u', password='p', from_email='f@example.com', user_id=user.id)
+    db.session.add_all(segments + templates + [smtp])
+    db.session.flush()
+
+    statuses = analytics.JOB_STATUSES
+    now = datetime.utcnow()
+    db.session.execute(sa.insert(ScheduledJob), [{
+        'name': f'Job {i}',
+        'scheduled_time': now - timedelta(minutes=i * 4),
+        'status': statuses[i % len(statuses)],
+        'user_id': user.id,
+        'template_id': templates[i % TEMPLATES].id,
+        'segment_id': segments[(i * 7) % SEGMENTS].id,
+        'smtp_config_id': smtp.id,
+        'total_emails': 1000,
+        'sent_emails': 990,
+        'failed_emails': 10,
+        'opened_emails': 400,
+        'clicked_emails': 60,
+        'unique_opens': 300,
+        'unique_clicks': 50,
+    } for i in range(job_count)])
+    db.session.commit()
+    return user.id
+
+def before(user_id, from_date, to_date):
+    """The monitoring route's previous approach"""
+    jobs = ScheduledJob.query.filter(
+        ScheduledJob.user_id == user_id
+    ).filter(
+        ScheduledJob.scheduled_time >= from_date
+    ).filter(
+        ScheduledJob.scheduled_time <= to_date
+    ).order_by(ScheduledJob.scheduled_time.desc()).all()
+
+    status_counts = {}
+    for status in analytics.JOB_STATUSES:
+        status_counts[status] = ScheduledJob.query.filter(
+            ScheduledJob.user_id == user_id
+        ).filter(
+            ScheduledJob.status == status
+        ).filter(
+            ScheduledJob.scheduled_time >= from_date
+        ).filter(
+            ScheduledJob.scheduled_time <= to_date
+        ).count()
+
+    segment_performance = {}
+    template_performance = {}
+    for job in jobs:
+        segment = segment_performance.setdefault(job.segment_id, {'segment_name': job.segment.name, 'sent': 0, 'opened': 0})
+        segment['sent'] += job.sent_emails
+        segment['opened'] += job.unique_opens
+        template = template_performance.setdefault(job.template_id, {'template_name': job.template.name, 'sent': 0, 'opened': 0})
+        template['sent'] += job.sent_emails
+        template['opened'] += job.unique_opens
+
+    return status_counts, segment_performance, template_performance
+
+def after(user_id, from_date, to_date):
+    """The analytics.py queries"""
+    return (
+        analytics.get_status_counts(user_id, from_date, to_date),
+        analytics.get_segment_performance(user_id, from_date, to_date),
+        analytics.get_template_performance(user_id, from_date, to_date),
+    )
+
+def measure(func, *args):
+    """Return (queries, best wall time in ms) over RUNS fresh sessions"""
+    queries = []
+
+    def count(*_):
+        queries.append(1)
+
+    best = None
+    for _ in range(RUNS):
+        db.session.remove()
+        queries.clear()
+        sa.event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            started = time.perf_counter()
+            func(*args)
+            elapsed = (time.perf_counter() - started) * 1000
+        finally:
+            sa.event.remove(db.engine, 'before_cursor_execute', count)
+        best = elapsed if best is None else min(best, elapsed)
+
+    return len(queries), best
+
+def run_benchmark(job_count=10000):
+    with app.app_context():
+        print(f"Seeding {job_count} jobs into {_db_file}")
+        user_id = seed(job_count)
+
+        to_date = datetime.utcnow()
+        from_date = to_date - timedelta(days=30)
+
+        print(f"{'':<8}{'queries':>10}{'ms':>12}")
+        for name, func in (('before', before), ('after', after)):
+            queries, ms = measure(func, user_id, from_date, to_date)
+            print(f"{name:<8}{queries:>10}{ms:>12.1f}")
+
+if __name__ == "__main__":
+    run_benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
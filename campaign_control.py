@@ -0,0 +1,82 @@
+"""Cooperative pause/resume/stop control for running campaigns.
+
+``routes.job_control`` changes ``ScheduledJob.status``; a running sender checks
+for that change between batches. Changes made in this process are delivered
+through an in-memory registry, so the check normally costs nothing. Changes
+made by another process are picked up by reading the job's status at most
+once every POLL_INTERVAL seconds.
+
+A sender that sees a pause or stop finishes its current batch and returns,
+leaving its checkpoint in the delivery ledger. Resuming schedules the job
+again, which continues from that checkpoint.
+"""
+import threading
+import time
+
+from app import db
+from models import ScheduledJob
+
+# Seconds between database status checks made by a running sender
+POLL_INTERVAL = 15
+
+_registry = {}
+_lock = threading.Lock()
+
+
+class JobControl:
+    """Control channel between job_control and one running sender"""
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.status = 'running'
+        self.last_poll = time.monotonic()
+
+    def should_continue(self):
+        """Called between batches. False once the job is paused, stopped or cancelled."""
+        if self.status == 'running' and time.monotonic() - self.last_poll >= POLL_INTERVAL:
+            self.last_poll = time.monotonic()
+            before = self.status
+            status = db.session.query(ScheduledJob.status).filter_by(id=self.job_id).scalar()
+
+            with _lock:
+                # Don't overwrite a signal that arrived while we were polling
+                if self.status == before:
+                    self.status = status or 'cancelled'
+
+        with _lock:
+            if self.status == 'running':
+                return True
+
+            # Deregister under the lock so a later resume() falls through to
+            # the scheduler instead of signalling a sender that is exiting
+            if _registry.get(self.job_id) is self:
+                del _registry[self.job_id]
+            return False
+
+
+def register(job_id):
+    """Register a sender for job_id and return its control channel"""
+    control = JobControl(job_id)
+    with _lock:
+        _registry[job_id] = control
+    return control
+
+
+def unregister(control):
+    with _lock:
+        if _registry.get(control.job_id) is control:
+            del _registry[control.job_id]
+
+
+def signal(job_id, status):
+    """Deliver a status change to a sender running in this process.
+
+    Returns:
+        bool: True if a sender in this process received the signal
+    """
+    with _lock:
+        control = _registry.get(job_id)
+        if control is None:
+            return False
+        control.status = status
+        return True
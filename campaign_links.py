@@ -0,0 +1,83 @@
+"""Per-job link table for click tracking.
+
+When a campaign starts, every distinct URL its template links to is stored
+once as a CampaignLink and given a small per-job index. Tracked links then
+carry only a signed token with that index instead of the full URL, which
+keeps both the outgoing messages and email_click rows small.
+
+The click route resolves (job, link index) to a URL through an in-process
+LRU cache, so only the first click on each link reads the database.
+"""
+import threading
+from collections import OrderedDict, namedtuple
+
+from app import db
+from models import CampaignLink
+from sql_helpers import insert_ignore
+import tracking_tokens
+
+# Resolved links kept in memory per process
+LINK_CACHE_SIZE = 10000
+
+ResolvedLink = namedtuple('ResolvedLink', ['id', 'url'])
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+def register_links(job_id, urls):
+    """Make sure every URL has a CampaignLink for the job.
+
+    URLs registered by an earlier run of the job keep their index, so
+    resuming a job after its template changed still resolves old links.
+    Runs in the current session; the caller commits.
+
+    Returns:
+        dict: URL to link index for all of the job's links
+    """
+    links = _load(job_id)
+
+    new_urls = [url for url in dict.fromkeys(urls) if url not in links]
+    if new_urls:
+        next_index = max(links.values(), default=-1) + 1
+        rows = [
+            {'job_id': job_id, 'link_index': next_index + offset, 'url': url}
+            for offset, url in enumerate(new_urls)
+            if next_index + offset < tracking_tokens.NO_LINK
+        ]
+        if rows:
+            db.session.execute(insert_ignore(CampaignLink), rows)
+            links = _load(job_id)
+
+    return links
+
+
+def _load(job_id):
+    rows = db.session.query(CampaignLink.url, CampaignLink.link_index).filter(CampaignLink.job_id == job_id)
+    return {url: link_index for url, link_index in rows}
+
+
+def resolve_link(job_id, link_index):
+    """Return the ResolvedLink for a job's link index, or None if there is none"""
+    key = (job_id, link_index)
+    with _lock:
+        link = _cache.get(key)
+        if link is not None:
+            _cache.move_to_end(key)
+            return link
+
+    row = db.session.query(CampaignLink.id, CampaignLink.url).filter(
+        CampaignLink.job_id == job_id,
+        CampaignLink.link_index == link_index
+    ).first()
+    if row is None:
+        return None
+
+    # A link's URL never changes once registered, so entries never go stale
+    link = ResolvedLink(row.id, row.url)
+    with _lock:
+        _cache[key] = link
+        while len(_cache) > LINK_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+    return link
@@ -0,0 +1,249 @@
+"""Streaming bulk import of contacts from CSV.
+
+The import routes used to read the whole upload into memory, build one ORM
+object per row and commit once at the end, so a large file held every row in
+memory and one transaction open until the request timed out.
+
+The importer reads the upload as a text stream, validates rows in batches of
+IMPORT_BATCH_SIZE and writes each batch in its own transaction: on
+PostgreSQL by COPY into a temporary staging table and one INSERT ... SELECT,
+elsewhere with a single executemany INSERT. Either way the insert is ON
+CONFLICT DO NOTHING against the contact table's unique (owner or list,
+normalized email) index, so addresses already present are skipped rather
+than failing the batch. Segment imports then add the batch's contacts, new
+or existing, to the segment with one INSERT ... SELECT into
+segment_membership, again skipping those already in it. Memory use is
+bounded by the batch size, and a failure part-way keeps the batches already
+committed. ImportStats reports rows read, inserted, rejected and duplicate
+and the rate.
+"""
+import csv
+import io
+import logging
+import time
+from datetime import datetime
+
+from sqlalchemy import literal
+
+from app import db
+from models import EmailSegment, Contact, SegmentMembership, AdminEmailContact, normalize_email
+from sql_helpers import insert_ignore, chunked
+
+# Rows validated and written per transaction
+IMPORT_BATCH_SIZE = 5000
+
+
+class ImportStats:
+    """Counters for one import"""
+
+    def __init__(self):
+        self.rows_read = 0
+        self.inserted = 0
+        self.rejected = 0
+        self.duplicates = 0
+        self.started = time.monotonic()
+        self.elapsed = 0.0
+
+    @property
+    def rows_per_second(self):
+        return self.rows_read / self.elapsed if self.elapsed > 0 else 0.0
+
+    def summary(self):
+        return (f"{self.inserted:,} contacts imported, {self.rejected:,} rows rejected, "
+                f"{self.duplicates:,} duplicates skipped "
+                f"({self.rows_read:,} rows in {self.elapsed:.1f}s, {self.rows_per_second:,.0f} rows/s)")
+
+
+class _Target:
+    """Where imported rows go: a contact model, its CSV columns and fixed values"""
+
+    def __init__(self, model, columns, fixed, segment_id=None):
+        self.model = model
+        self.columns = columns
+        self.fixed = fixed
+        # Segment the contacts are added to, for the owner's contacts
+        self.segment_id = segment_id
+        # Columns of the model's unique index on the list and normalized address
+        self.conflict = list(fixed) + ['email_normalized']
+        self.lengths = {name: getattr(model.__table__.c[name].type, 'length', None) for name in columns}
+
+
+def import_segment_contacts(segment_id, source, progress=None):
+    """Import email,name rows into a segment.
+
+    Args:
+        segment_id: EmailSegment to add the contacts to
+        source: text stream or string of CSV lines, without a header
+        progress: optional callable given the ImportStats after each batch
+
+    Returns:
+        ImportStats
+    """
+    user_id = db.session.query(EmailSegment.user_id).filter(EmailSegment.id == segment_id).scalar()
+    target = _Target(Contact, ('email', 'name'), {'user_id': user_id}, segment_id=segment_id)
+    # A name may contain unquoted commas; keep everything after the email
+    return _import(target, source, lambda row: [row[0], ','.join(row[1:])], progress=progress)
+
+
+def import_admin_list_contacts(list_id, source, has_header=False, progress=None):
+    """Import email,name,company,phone rows into an admin email list.
+
+    Args:
+        list_id: AdminEmailList to add the contacts to
+        source: text stream or string of CSV lines
+        has_header: skip the first row
+        progress: optional callable given the ImportStats after each batch
+
+    Returns:
+        ImportStats
+    """
+    target = _Target(AdminEmailContact, ('email', 'name', 'company', 'phone'), {'list_id': list_id})
+    return _import(target, source, lambda row: row[:4], has_header=has_header, progress=progress)
+
+
+def _import(target, source, split, has_header=False, progress=None):
+    if isinstance(source, str):
+        source = io.StringIO(source)
+
+    stats = ImportStats()
+    reader = csv.reader(source)
+    if has_header:
+        next(reader, None)
+
+    batch = {}
+    try:
+        for row in reader:
+            if not any(field.strip() for field in row):
+                continue
+
+            stats.rows_read += 1
+            values = _validate(target, split(row))
+            if values is None:
+                stats.rejected += 1
+                continue
+
+            key = values['email_normalized']
+            if key in batch:
+                stats.duplicates += 1
+                continue
+
+            batch[key] = values
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                _write_batch(target, batch.values(), stats, progress)
+                batch = {}
+
+        if batch:
+            _write_batch(target, batch.values(), stats, progress)
+    finally:
+        stats.elapsed = time.monotonic() - stats.started
+
+    logging.info(f"{target.model.__name__} import: {stats.summary()}")
+    return stats
+
+
+def _validate(target, fields):
+    """Return the row's column values, or None if the row is rejected"""
+    values = {}
+    for name, value in zip(target.columns, fields):
+        values[name] = value.strip() or None
+
+    email = values.get('email')
+    # Basic email validation; an over-long address would fail the whole batch
+    if not email or '@' not in email or len(email) > target.lengths['email']:
+        return None
+    values['email_normalized'] = normalize_email(email)
+
+    for name in target.columns[1:]:
+        value = values.get(name)
+        length = target.lengths[name]
+        values[name] = value[:length] if value and length else value
+    return values
+
+
+def _write_batch(target, batch, stats, progress):
+    """Insert one batch in its own transaction"""
+    now = datetime.utcnow()
+    rows = [dict(values, created_at=now, **target.fixed) for values in batch]
+
+    try:
+        if db.engine.dialect.name == 'postgresql':
+            inserted = _copy_rows(target, rows)
+        else:
+            # A Core execute, as the ORM's bulk insert result has no rowcount
+            inserted = db.session.connection().execute(
+                insert_ignore(target.model, index_elements=target.conflict), rows
+            ).rowcount
+        if target.segment_id is not None:
+            # Contacts the owner already had count once they join the segment
+            inserted = _add_to_segment(target, rows, now)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    stats.inserted += inserted
+    stats.duplicates += len(rows) - inserted
+    stats.elapsed = time.monotonic() - stats.started
+    if progress:
+        progress(stats)
+
+
+def _copy_rows(target, rows):
+    """Load rows with COPY ... FROM STDIN in the session's transaction.
+
+    COPY can't skip conflicting rows, so the rows are copied into a staging
+    table first (a temporary table emptied at commit and kept for the
+    connection's next import) and moved across with INSERT ... SELECT ...
+    ON CONFLICT DO NOTHING.
+
+    Returns:
+        int: the number of rows inserted
+    """
+    columns = list(rows[0])
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        # \N is COPY's NULL marker; an empty string would be stored as ''
+        writer.writerow(['\\N' if row[name] is None else row[name] for name in columns])
+    buffer.seek(0)
+
+    table = target.model.__table__.name
+    stage = f"import_stage_{table}"
+    column_list = ', '.join(columns)
+    cursor = db.session.connection().connection.driver_connection.cursor()
+    try:
+        cursor.execute(
+            f"CREATE TEMP TABLE IF NOT EXISTS {stage} ON COMMIT DELETE ROWS "
+            f"AS SELECT {column_list} FROM {table} WITH NO DATA"
+        )
+        cursor.copy_expert(
+            f"COPY {stage} ({column_list}) FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+            buffer
+        )
+        cursor.execute(
+            f"INSERT INTO {table} ({column_list}) SELECT {column_list} FROM {stage} "
+            f"ON CONFLICT ({', '.join(target.conflict)}) DO NOTHING"
+        )
+        return cursor.rowcount
+    finally:
+        cursor.close()
+
+
+def _add_to_segment(target, rows, now):
+    """Add the batch's contacts to the segment.
+
+    Returns:
+        int: the number of contacts that weren't in the segment yet
+    """
+    added = 0
+    for chunk in chunked([row['email_normalized'] for row in rows]):
+        contacts = db.session.query(
+            literal(target.segment_id), Contact.id, literal(now)
+        ).filter(
+            Contact.user_id == target.fixed['user_id'],
+            Contact.email_normalized.in_(chunk)
+        )
+        added += db.session.connection().execute(
+            insert_ignore(SegmentMembership).from_select(['segment_id', 'contact_id', 'created_at'], contacts)
+        ).rowcount
+    return added
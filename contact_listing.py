@@ -0,0 +1,147 @@
+"""Paginated contact listings for the segment and admin list pages.
+
+Both pages used to render every contact of a segment or list, so a large
+segment meant a page of several megabytes that took seconds to build.
+
+Pages are now CONTACTS_PAGE_SIZE contacts long and continue from a cursor
+rather than an offset, so every page is one short index range scan however
+far into the listing it is:
+
+- browsing goes in contact id order along the segment_membership primary
+  key, or the (list_id, id) index of an admin list; live dynamic segments
+  go along the contact primary key, checking each contact against the rules
+- searching matches a prefix of the normalized email and goes in email
+  order along the unique (owner or list, normalized email) index
+
+Totals come from an in-process cache that keeps each count for
+COUNT_CACHE_SECONDS; this process forgets a count as soon as it changes
+the contacts, other processes catch up when it expires.
+"""
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from app import db
+from models import Contact, AdminEmailContact, normalize_email
+import segment_rules
+
+# Contacts per page
+CONTACTS_PAGE_SIZE = 50
+
+# Seconds a contact count is reused
+COUNT_CACHE_SECONDS = 60
+
+# Counts kept in memory per process
+COUNT_CACHE_SIZE = 10000
+
+ContactPage = namedtuple('ContactPage', ['contacts', 'next_cursor'])
+
+_counts = OrderedDict()
+_lock = threading.Lock()
+
+
+def segment_contact_page(segment, cursor=None, search=None):
+    """Return a ContactPage of a segment's contacts.
+
+    Args:
+        segment: EmailSegment to list
+        cursor: next_cursor of the previous page, or None for the first page
+        search: optional email prefix
+
+    Returns:
+        ContactPage: next_cursor is None on the last page
+    """
+    query, contact_id = segment_rules.contact_query(segment, Contact)
+
+    prefix = normalize_email(search)
+    if prefix:
+        # The owner's contacts with the prefix, checked against the segment by primary key
+        query = query.filter(Contact.user_id == segment.user_id, *_prefix_range(Contact.email_normalized, prefix))
+        if cursor:
+            query = query.filter(Contact.email_normalized > cursor)
+        return _page(query.order_by(Contact.email_normalized), lambda contact: contact.email_normalized)
+
+    if cursor:
+        query = query.filter(contact_id > _int_cursor(cursor))
+    return _page(query.order_by(contact_id), lambda contact: str(contact.id))
+
+
+def list_contact_page(email_list, cursor=None, search=None):
+    """Return a ContactPage of an admin email list's contacts, like segment_contact_page"""
+    query = AdminEmailContact.query.filter(AdminEmailContact.list_id == email_list.id)
+
+    prefix = normalize_email(search)
+    if prefix:
+        query = query.filter(*_prefix_range(AdminEmailContact.email_normalized, prefix))
+        if cursor:
+            query = query.filter(AdminEmailContact.email_normalized > cursor)
+        return _page(query.order_by(AdminEmailContact.email_normalized), lambda contact: contact.email_normalized)
+
+    if cursor:
+        query = query.filter(AdminEmailContact.id > _int_cursor(cursor))
+    return _page(query.order_by(AdminEmailContact.id), lambda contact: str(contact.id))
+
+
+def _page(query, cursor_of):
+    # One extra row tells whether there is a next page
+    contacts = query.limit(CONTACTS_PAGE_SIZE + 1).all()
+    if len(contacts) <= CONTACTS_PAGE_SIZE:
+        return ContactPage(contacts, None)
+
+    contacts = contacts[:CONTACTS_PAGE_SIZE]
+    return ContactPage(contacts, cursor_of(contacts[-1]))
+
+
+def _prefix_range(column, prefix):
+    """Conditions matching values that start with prefix, as an index range.
+
+    Normalized emails compare byte by byte, so the values starting with a
+    prefix are exactly those from the prefix up to the prefix with its last
+    character incremented.
+    """
+    end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return column >= prefix, column < end
+
+
+def _int_cursor(cursor):
+    try:
+        return int(cursor)
+    except ValueError:
+        return 0
+
+
+def segment_contact_count(segment):
+    """Number of contacts segment_contact_page lists for a segment, cached for COUNT_CACHE_SECONDS"""
+    query, contact_id = segment_rules.contact_id_query(segment)
+    return _cached_count(('segment', segment.id), query.count)
+
+
+def list_contact_count(list_id):
+    """Number of contacts in an admin email list, cached for COUNT_CACHE_SECONDS"""
+    return _cached_count(('admin_list', list_id), lambda: AdminEmailContact.query.filter_by(
+        list_id=list_id
+    ).count())
+
+
+def invalidate_count(target_type, target_id):
+    """Forget a cached count after changing the contacts of a 'segment' or 'admin_list'"""
+    with _lock:
+        _counts.pop((target_type, target_id), None)
+
+
+def _cached_count(key, count):
+    now = time.monotonic()
+    with _lock:
+        entry = _counts.get(key)
+        if entry is not None and entry[1] > now:
+            _counts.move_to_end(key)
+            return entry[0]
+
+    value = count()
+    with _lock:
+        _counts[key] = (value, now + COUNT_CACHE_SECONDS)
+        _counts.move_to_end(key)
+        while len(_counts) > COUNT_CACHE_SIZE:
+            _counts.popitem(last=False)
+
+    return value
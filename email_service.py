@@ -1,10 +1,16 @@
 import logging
 from flask_mail import Mail, Message
-from models import ScheduledJob, SMTPConfig, EmailSegment, EmailTemplate, Contact, JobLog
+from models import ScheduledJob, SMTPConfig, EmailSegment, EmailTemplate, Contact, JobLog, JobDelivery
 from app import db, mail
+from sqlalchemy import func, insert, update
+from smtp_pool import smtp_pool
+from send_engine import CampaignSender, Recipient
+import campaign_control
+import campaign_links
+import segment_rules
+from job_log_writer import job_log_writer
+from template_compiler import get_compiled_template
 import time
-from bs4 import BeautifulSoup
-import uuid
 import traceback
 from datetime import datetime
 
@@ -39,63 +45,75 @@ def send_campaign_emails(app, job):
             db.session.commit()
             return False, 0, 0, 0
         
-        # Update mail settings
-        update_mail_settings(app, smtp_config)
+        # Snapshot pool counters so the job log reports this job's share
+        pool_stats_before = smtp_pool.get_stats(smtp_config.id)
         
-        # Get contacts for this segment
-        contacts = Contact.query.filter_by(segment_id=segment.id).all()
+        # Pick up from the delivery ledger if this job was interrupted
+        sent, failed = get_delivery_counts(job.id)
+        checkpoint = get_checkpoint(job.id)
         
-        total = len(contacts)
-        sent = 0
-        failed = 0
+        # A stale materialized segment is rebuilt when a send starts, not
+        # when it resumes, so an interrupted send keeps its contacts
+        if not checkpoint:
+            segment_rules.refresh_if_stale(segment, job_id=job.id)
         
-        # Log start of sending
-        log_entry = JobLog(job_id=job.id, message=f"Starting to send {total} emails", level='info')
+        # Count contacts up front; the contacts themselves are streamed below
+        total = segment_rules.count_contacts(segment)
+        
+        if checkpoint:
+            message = f"Resuming after contact {checkpoint}: {sent} sent and {failed} failed before interruption"
+        else:
+            message = f"Starting to send {total} emails"
+            job.sending_started_at = datetime.utcnow()
+            job.current_batch = 0
+        
+        job.heartbeat_at = datetime.utcnow()
+        log_entry = JobLog(job_id=job.id, message=message, level='info')
         db.session.add(log_entry)
         db.session.commit()
         
-        # Send emails to each contact
-        for contact in contacts:
-            try:
-                # Personalize the email content
-                personalized_content = personalize_email(template.content, contact)
-                
-                # Add tracking if enabled for this template
-                if template.has_open_tracking:
-                    personalized_content = add_open_tracking(personalized_content, job.id, contact.id)
-                
-                if template.has_click_tracking:
-                    personalized_content = add_click_tracking(personalized_content, job.id, contact.id)
-                
-                # Set the sender (use custom sender if available, otherwise use SMTP config)
-                sender_email = job.from_email if job.from_email else smtp_config.from_email
-                sender_name = job.from_name if job.from_name else smtp_config.from_name
-                sender = f"{sender_name} <{sender_email}>" if sender_name else sender_email
-                
-                # Create the email message
-                msg = Message(
-                    subject=template.subject,
-                    recipients=[contact.email],
-                    html=personalized_content,
-                    sender=sender
-                )
-                
-                # Send the email
-                mail.send(msg)
-                sent += 1
-                
-                # Add small delay to avoid overloading the SMTP server
-                time.sleep(0.1)
-                
-            except Exception as e:
-                logging.error(f"Error sending email to {contact.email}: {str(e)}")
-                failed += 1
+        sender = create_campaign_sender(app, job, template, smtp_config)
+        control = campaign_control.register(job.id)
+        interrupted = False
+        
+        try:
+            # Stream contacts in chunks and send each chunk over parallel SMTP sessions
+            for recipients in iter_contact_batches(segment, job.batch_size or 100, after_id=checkpoint):
+                batch_sent, batch_failed = send_contact_batch(job, sender, recipients)
+                sent += batch_sent
+                failed += batch_failed
                 
-                # Log the error
-                error_msg = f"Failed to send email to {contact.email}: {str(e)}"
-                log_entry = JobLog(job_id=job.id, message=error_msg, level='error')
-                db.session.add(log_entry)
+                # Commit the ledger rows together with progress and measured
+                # throughput, so the checkpoint always matches the counters
+                ScheduledJob.increment_counters(job.id, sent_emails=batch_sent, failed_emails=batch_failed)
+                job.current_batch = (job.current_batch or 0) + 1
+                job.avg_sending_rate = sender.rate
+                job.heartbeat_at = datetime.utcnow()
                 db.session.commit()
+                
+                # Honour pause/stop from job_control between batches
+                if not control.should_continue():
+                    interrupted = True
+                    break
+        finally:
+            campaign_control.unregister(control)
+            sender.close()
+            # Log this run's send errors ahead of the summary below
+            job_log_writer.finish_job(job.id)
+        
+        job.avg_sending_rate = sender.rate
+        
+        if interrupted:
+            log_entry = JobLog(
+                job_id=job.id,
+                message=f"Email sending {control.status} after batch {job.current_batch}. Sent: {sent}, Failed: {failed}",
+                level='info'
+            )
+            db.session.add(log_entry)
+            db.session.commit()
+            return True, total, sent, failed
+        
+        job.sending_completed_at = datetime.utcnow()
         
         # Log completion
         log_entry = JobLog(
@@ -104,6 +122,18 @@ def send_campaign_emails(app, job):
             level='info'
         )
         db.session.add(log_entry)
+        
+        pool_stats = smtp_pool.get_stats(smtp_config.id)
+        opened = pool_stats['opened'] - pool_stats_before['opened']
+        reused = pool_stats['reused'] - pool_stats_before['reused']
+        reconnects = pool_stats['reconnects'] - pool_stats_before['reconnects']
+        log_entry = JobLog(
+            job_id=job.id,
+            message=f"SMTP pool: {opened} connections opened, {reused} reused, "
+                    f"{reconnects} reconnects, {pool_stats['pool_size']} pooled",
+            level='info'
+        )
+        db.session.add(log_entry)
         db.session.commit()
         
         return True, total, sent, failed
@@ -113,62 +143,126 @@ def send_campaign_emails(app, job):
         logging.error(traceback.format_exc())
         
         # Log the error
+        db.session.rollback()
         log_entry = JobLog(job_id=job.id, message=f"Email campaign failed: {str(e)}", level='error')
         db.session.add(log_entry)
         db.session.commit()
         
-        return False, 0, 0, job.total_emails
+        # Report what the ledger recorded before the failure
+        sent, failed = get_delivery_counts(job.id)
+        return False, job.total_emails, sent, failed
 
-def personalize_email(content, contact):
-    """Replace personalization tokens in email content"""
-    personalized = content
+def create_campaign_sender(app, job, template, smtp_config):
+    """Return a CampaignSender rendering the job's template.
     
-    # Replace name if available
-    if contact.name:
-        personalized = personalized.replace('{{name}}', contact.name)
-    else:
-        personalized = personalized.replace('{{name}}', 'Valued Customer')
+    Commits the job's CampaignLink rows, since tracked URLs refer to them.
+    """
+    # Parse the template once (or reuse it from the cache); each recipient is then a single join
+    compiled = get_compiled_template(template, link_table=True)
+    job_id = job.id
     
-    # Replace email
-    personalized = personalized.replace('{{email}}', contact.email)
+    # Number the template's links once so tracked URLs carry only the link index
+    links = campaign_links.register_links(job.id, compiled.links)
+    db.session.commit()
     
-    return personalized
+    def render(recipient):
+        return compiled.render(job_id, recipient, links)
+    
+    return CampaignSender(app, job, template, smtp_config, render)
 
-def add_open_tracking(content, job_id, contact_id):
-    """Add open tracking pixel to email"""
-    # Create a tracking pixel
-    tracking_id = str(uuid.uuid4())
+def send_contact_batch(job, sender, recipients):
+    """Send one batch of recipients and record the outcome in the delivery ledger.
     
-    # Use request.url_root to get the domain of the current application
-    # For now, we'll use a relative URL which will resolve correctly 
-    # regardless of the domain the application is deployed on
-    tracking_pixel = f'<img src="/track/open/{job_id}/{contact_id}/{tracking_id}" width="1" height="1" alt="" style="display:none" />'
+    Contacts the ledger already marks as sent are skipped, so a batch can be
+    replayed safely. Ledger rows are added to the session; the caller commits.
     
-    # Add tracking pixel before closing body tag
-    if '</body>' in content:
-        return content.replace('</body>', f'{tracking_pixel}</body>')
-    else:
-        return content + tracking_pixel
-
-def add_click_tracking(content, job_id, contact_id):
-    """Add click tracking to all links in the email"""
-    soup = BeautifulSoup(content, 'html.parser')
+    Returns:
+        tuple: (sent, failed) changes to the job's counters, so they keep
+        matching the ledger: a contact that failed before and is sent now
+        moves from failed to sent, one that fails again changes neither
+    """
+    previous = {
+        row.contact_id: row for row in db.session.query(
+            JobDelivery.contact_id, JobDelivery.status, JobDelivery.attempts
+        ).filter(
+            JobDelivery.job_id == job.id,
+            JobDelivery.contact_id.in_([r.id for r in recipients])
+        )
+    }
+    pending = [r for r in recipients if r.id not in previous or previous[r.id].status != 'sent']
     
-    # Find all links
-    for link in soup.find_all('a'):
-        if link.has_attr('href'):
-            original_url = link['href']
-            # Skip empty or javascript links
-            if not original_url or original_url.startswith('javascript:') or original_url.startswith('#'):
-                continue
-                
-            tracking_id = str(uuid.uuid4())
+    sent = 0
+    failed = 0
+    new_rows = []
+    retried_rows = []
+    
+    for recipient, error in sender.send_batch(pending):
+        if error is None:
+            sent += 1
+            status = 'sent'
+        else:
+            logging.error(f"Error sending email to {recipient.email}: {str(error)}")
+            failed += 1
+            status = 'failed'
             
-            # Use a relative URL which will resolve correctly regardless of the domain
-            tracked_url = f"/track/click/{job_id}/{contact_id}/{tracking_id}?url={original_url}"
-            link['href'] = tracked_url
+            # Aggregated with the job's other errors and written in batches
+            job_log_writer.record_error(job.id, recipient.email, error)
+        
+        row = {'job_id': job.id, 'contact_id': recipient.id, 'status': status}
+        if recipient.id in previous:
+            # Only failed contacts are sent again; this attempt replaces that failure
+            failed -= 1
+            row['attempts'] = (previous[recipient.id].attempts or 1) + 1
+            retried_rows.append(row)
+        else:
+            row['attempts'] = 1
+            new_rows.append(row)
+    
+    # Write the ledger with one executemany per statement
+    if new_rows:
+        db.session.execute(insert(JobDelivery), new_rows)
+    if retried_rows:
+        db.session.execute(update(JobDelivery), retried_rows)
     
-    return str(soup)
+    return sent, failed
+
+def get_checkpoint(job_id):
+    """Return the id of the last contact committed to the job's ledger, or 0"""
+    return db.session.query(func.max(JobDelivery.contact_id)).filter(
+        JobDelivery.job_id == job_id
+    ).scalar() or 0
+
+def get_delivery_counts(job_id):
+    """Return (sent, failed) totals recorded in the job's ledger"""
+    counts = dict(db.session.query(JobDelivery.status, func.count()).filter(
+        JobDelivery.job_id == job_id
+    ).group_by(JobDelivery.status).all())
+    return counts.get('sent', 0), counts.get('failed', 0)
+
+def iter_contact_batches(segment, batch_size, after_id=0, last_id=None):
+    """Yield a segment's contacts as lists of Recipient, batch_size at a time.
+    
+    Uses keyset pagination on contact id so each query is a range scan of the
+    segment_membership primary key joined to the contacts by id, and memory
+    stays flat regardless of segment size. A live dynamic segment is scanned
+    along the contact primary key with its rules compiled once for the whole
+    run. With last_id, stops after that contact.
+    """
+    contacts, contact_id = segment_rules.contact_query(segment, Contact.id, Contact.email, Contact.name)
+    while True:
+        query = contacts.filter(contact_id > after_id)
+        if last_id is not None:
+            query = query.filter(contact_id <= last_id)
+        rows = query.order_by(contact_id).limit(batch_size).all()
+        
+        if not rows:
+            return
+        
+        yield [Recipient(*row) for row in rows]
+        
+        if len(rows) < batch_size:
+            return
+        after_id = rows[-1].id
 
 def send_test_email(app, template_id, recipient_email, smtp_config_id, custom_smtp_config=None):
     """
@@ -201,27 +295,13 @@ def send_test_email(app, template_id, recipient_email, smtp_config_id, custom_sm
         if not custom_smtp_config:  # Only update if we're not using a custom config that's already been applied
             update_mail_settings(app, smtp_config)
         
-        # Create sample data for personalization
-        sample_contact = {
-            'name': 'Sample Recipient',
-            'email': recipient_email
-        }
-        
-        # Personalize the content
-        content = template.content
-        content = content.replace('{{name}}', sample_contact['name'])
-        content = content.replace('{{email}}', sample_contact['email'])
-        
-        # Create test tracking IDs (not recorded in database)
+        # Create sample data for personalization; test tracking IDs are
+        # not recorded in database
         test_job_id = 0
-        test_contact_id = 0
-        
-        # Add tracking for preview purposes if enabled
-        if template.has_open_tracking:
-            content = add_open_tracking(content, test_job_id, test_contact_id)
+        sample_contact = Recipient(0, recipient_email, 'Sample Recipient')
         
-        if template.has_click_tracking:
-            content = add_click_tracking(content, test_job_id, test_contact_id)
+        # Personalize the content, adding tracking for preview purposes if enabled
+        content = get_compiled_template(template).render(test_job_id, sample_contact)
             
         # Set the sender
         sender_email = smtp_config.from_email
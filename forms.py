@@ -1,7 +1,7 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, BooleanField, SubmitField, TextAreaField, SelectField, DateTimeField, IntegerField, HiddenField, FileField, MultipleFileField
-from wtforms.validators import DataRequired, Length, Email, EqualTo, ValidationError, Optional, URL
-from models import User, UserRegistrationRequest
+from wtforms import StringField, PasswordField, BooleanField, SubmitField, TextAreaField, SelectField, DateTimeField, IntegerField, FloatField, HiddenField, FileField, MultipleFileField
+from wtforms.validators import DataRequired, Length, Email, EqualTo, ValidationError, Optional, URL, NumberRange
+from models import User, UserRegistrationRequest, DEFAULT_MAX_CONNECTIONS, DEFAULT_SEND_RATE_LIMIT
 
 class LoginForm(FlaskForm):
     username = StringField('Username or Email', validators=[DataRequired()])
@@ -118,6 +118,12 @@ class AdminContactImportForm(FlaskForm):
 class SegmentForm(FlaskForm):
     name = StringField('Segment Name', validators=[DataRequired(), Length(max=100)])
     description = TextAreaField('Description', validators=[Optional(), Length(max=500)])
+    rules = TextAreaField('Rules', validators=[Optional(), Length(max=20000)],
+                          description='JSON rules that pick the contacts; leave empty to add contacts yourself')
+    materialize = BooleanField('Cache Matching Contacts',
+                               description='Store the matching contacts and reuse them until they are older than the refresh time')
+    refresh_ttl_minutes = IntegerField('Refresh After (minutes)', default=60, validators=[Optional(), NumberRange(min=1)],
+                                       description='Age at which cached contacts are matched again')
     submit = SubmitField('Save Segment')
 
 class ContactForm(FlaskForm):
@@ -126,8 +132,19 @@ class ContactForm(FlaskForm):
     submit = SubmitField('Add Contact')
 
 class ContactImportForm(FlaskForm):
-    contacts = TextAreaField('Contacts (one email per line, format: email,name)', validators=[DataRequired()])
+    contacts_file = FileField('CSV File', validators=[Optional()])
+    contacts = TextAreaField('Contacts (one email per line, format: email,name)', validators=[Optional()])
     submit = SubmitField('Import Contacts')
+    
+    def validate(self, extra_validators=None):
+        if not super().validate(extra_validators):
+            return False
+        
+        # Either field may be left empty, but not both
+        if not self.contacts_file.data and not (self.contacts.data or '').strip():
+            self.contacts.errors.append('Choose a CSV file or paste some contacts to import.')
+            return False
+        return True
 
 class TemplateForm(FlaskForm):
     name = StringField('Template Name', validators=[DataRequired(), Length(max=100)])
@@ -183,6 +200,10 @@ class SMTPConfigForm(FlaskForm):
     use_ssl = BooleanField('Use SSL')
     from_email = StringField('From Email', validators=[DataRequired(), Email()])
     from_name = StringField('From Name', validators=[Optional(), Length(max=120)])
+    max_connections = IntegerField('Parallel Connections', default=DEFAULT_MAX_CONNECTIONS, validators=[Optional(), NumberRange(min=1, max=50)],
+                                   description='Number of SMTP sessions open at once, shared by all campaigns sending through this configuration')
+    send_rate_limit = FloatField('Rate Limit (emails/sec)', default=DEFAULT_SEND_RATE_LIMIT, validators=[Optional(), NumberRange(min=0)],
+                                 description='Maximum sending rate, shared by all campaigns sending through this configuration; 0 for unlimited')
     submit = SubmitField('Save Configuration')
 
 class EmailEditorForm(FlaskForm):
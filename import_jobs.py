@@ -0,0 +1,174 @@
+"""Contact imports run in the background.
+
+Importing used to happen inside the upload request, so a large CSV held a
+web worker until the proxy gave up on it. The upload is now saved to a
+temporary file, recorded as an ImportJob and handed to a small thread pool
+in the same process; the request returns straight away and the contacts page
+polls the job's progress.
+
+The importer reports after every batch, and each report updates the
+ImportJob's counters and updated_at. A running import with no report for
+STALE_MINUTES (or one left queued for QUEUED_TIMEOUT_MINUTES) belonged to a
+process that went away, and is marked failed the next time it is looked at.
+"""
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from app import db
+from models import ImportJob
+from contact_import import import_segment_contacts, import_admin_list_contacts
+import contact_listing
+
+# Imports run at once per process; more wait in the pool's queue
+IMPORT_WORKERS = 2
+
+# A running import with no progress for this long was interrupted
+STALE_MINUTES = 10
+
+# A queued import not started within this long was lost
+QUEUED_TIMEOUT_MINUTES = 60
+
+# A finished import stays on its contacts page for this long
+RECENT_MINUTES = 60
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=IMPORT_WORKERS, thread_name_prefix='contact-import')
+        return _executor
+
+
+def start_import(app, user_id, target_type, target_id, file_storage=None, text=None, has_header=False):
+    """Save an upload or pasted text and import it in the background.
+
+    Args:
+        target_type: 'segment' or 'admin_list'
+        target_id: EmailSegment or AdminEmailList id
+        file_storage: uploaded CSV file, if any
+        text: pasted CSV lines, used when there's no file
+        has_header: skip the first row
+
+    Returns:
+        ImportJob
+    """
+    fd, path = tempfile.mkstemp(prefix='contact-import-', suffix='.csv')
+    try:
+        if file_storage:
+            with os.fdopen(fd, 'wb') as f:
+                file_storage.save(f)
+        else:
+            with os.fdopen(fd, 'w', encoding='utf-8', newline='') as f:
+                f.write(text or '')
+
+        import_job = ImportJob(
+            user_id=user_id,
+            target_type=target_type,
+            target_id=target_id,
+            filename=file_storage.filename if file_storage else None
+        )
+        db.session.add(import_job)
+        db.session.commit()
+
+        _get_executor().submit(_run_import, app, import_job.id, path, has_header)
+    except Exception:
+        db.session.rollback()
+        os.unlink(path)
+        raise
+
+    return import_job
+
+
+def _run_import(app, import_id, path, has_header):
+    with app.app_context():
+        import_job = None
+        try:
+            import_job = db.session.get(ImportJob, import_id)
+            target = (import_job.target_type, import_job.target_id)
+            import_job.status = 'running'
+            import_job.started_at = datetime.utcnow()
+            db.session.commit()
+
+            def progress(stats):
+                _record_stats(import_job, stats)
+                db.session.commit()
+
+            # newline='' lets the csv module handle line breaks inside quoted fields
+            with open(path, encoding='utf-8-sig', newline='') as source:
+                if import_job.target_type == 'segment':
+                    stats = import_segment_contacts(import_job.target_id, source, progress=progress)
+                else:
+                    stats = import_admin_list_contacts(import_job.target_id, source,
+                                                       has_header=has_header, progress=progress)
+
+            _record_stats(import_job, stats)
+            import_job.status = 'completed'
+            import_job.completed_at = datetime.utcnow()
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logging.exception(f"Error in contact import {import_id}: {e}")
+            if import_job is not None:
+                # Batches committed before the error stay imported
+                import_job.status = 'failed'
+                import_job.error = str(e)
+                import_job.completed_at = datetime.utcnow()
+                db.session.commit()
+        finally:
+            if import_job is not None:
+                contact_listing.invalidate_count(*target)
+            db.session.remove()
+            os.unlink(path)
+
+
+def _record_stats(import_job, stats):
+    import_job.rows_read = stats.rows_read
+    import_job.inserted = stats.inserted
+    import_job.rejected = stats.rejected
+    import_job.duplicates = stats.duplicates
+    import_job.rows_per_second = stats.rows_per_second
+
+
+def check_stale(import_job):
+    """Mark an import failed if the process running it went away.
+
+    Returns:
+        ImportJob: the same import
+    """
+    now = datetime.utcnow()
+    if import_job.status == 'running':
+        abandoned = import_job.updated_at < now - timedelta(minutes=STALE_MINUTES)
+    elif import_job.status == 'queued':
+        abandoned = import_job.created_at < now - timedelta(minutes=QUEUED_TIMEOUT_MINUTES)
+    else:
+        abandoned = False
+
+    if abandoned:
+        import_job.status = 'failed'
+        import_job.error = 'Import was interrupted'
+        import_job.completed_at = now
+        db.session.commit()
+    return import_job
+
+
+def latest_import(target_type, target_id):
+    """Return the target's newest import if it's unfinished or recently finished"""
+    import_job = ImportJob.query.filter_by(
+        target_type=target_type,
+        target_id=target_id
+    ).order_by(ImportJob.id.desc()).first()
+    if import_job is None:
+        return None
+
+    check_stale(import_job)
+    if import_job.finished and import_job.completed_at < datetime.utcnow() - timedelta(minutes=RECENT_MINUTES):
+        return None
+    return import_job
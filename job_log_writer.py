@@ -0,0 +1,220 @@
+"""Buffered, aggregating writer for per-recipient send errors in the job log.
+
+Sending used to add one JobLog row for every failed recipient, so an SMTP
+relay outage filled job_log with hundreds of thousands of identical rows.
+
+Senders now hand each failure to the writer, which groups them by job and
+error class (the error text with addresses taken out) and writes one entry
+per group, e.g. "4,312 × 550 mailbox unavailable (e.g. a@example.com, ...)".
+Only the first MAX_SAMPLES recipients of each group are ever listed. A
+background thread writes pending groups every FLUSH_INTERVAL seconds in a
+single commit; a group whose samples are all used up gets a new entry only
+every SUMMARY_INTERVAL seconds while the failures go on.
+
+Counts still pending when the process dies without a clean shutdown are
+lost; the delivery ledger and the job's failed_emails counter are not
+affected.
+"""
+import atexit
+import logging
+import re
+import smtplib
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import insert
+
+from app import db
+from models import JobLog
+
+# Seconds between writes
+FLUSH_INTERVAL = 1
+
+# Seconds between entries for a group whose samples are used up
+SUMMARY_INTERVAL = 60
+
+# Recipients listed per job and error class
+MAX_SAMPLES = 5
+
+# Consecutive failed writes before pending entries are discarded
+MAX_FLUSH_ATTEMPTS = 5
+
+# Longest error text kept as an error class
+MAX_ERROR_LENGTH = 200
+
+_ADDRESS = re.compile(r'<?[\w.+-]+@[\w-]+(?:\.[\w-]+)+>?')
+
+
+def error_class(error):
+    """Describe an error without the recipient-specific parts, for grouping"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused) and error.recipients:
+        code, message = next(iter(error.recipients.values()))
+        text = f"{code} {message.decode(errors='replace') if isinstance(message, bytes) else message}"
+    elif isinstance(error, smtplib.SMTPResponseException):
+        message = error.smtp_error
+        text = f"{error.smtp_code} {message.decode(errors='replace') if isinstance(message, bytes) else message}"
+    else:
+        text = str(error) or type(error).__name__
+
+    text = _ADDRESS.sub('<address>', ' '.join(text.split()))
+    return text[:MAX_ERROR_LENGTH]
+
+
+class _ErrorGroup:
+    __slots__ = ('count', 'samples', 'samples_written', 'first_seen', 'last_written')
+
+    def __init__(self):
+        self.count = 0
+        self.samples = []
+        self.samples_written = 0
+        self.first_seen = None
+        self.last_written = time.monotonic()
+
+
+class JobLogWriter:
+    """Collects send errors and writes them to the job log in batches"""
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL, summary_interval=SUMMARY_INTERVAL, max_samples=MAX_SAMPLES):
+        self.flush_interval = flush_interval
+        self.summary_interval = summary_interval
+        self.max_samples = max_samples
+        self.app = None
+        self._groups = {}
+        self._retry = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self._failed_attempts = 0
+
+    def start(self, app):
+        """Start the background writer for this app"""
+        self.app = app
+        if self._thread is not None:
+            return
+
+        self._thread = threading.Thread(target=self._run, name='job-log-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Stop the writer and write out everything still pending"""
+        self._stopping = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+        self.flush(force=True)
+
+    def record_error(self, job_id, email, error):
+        """Count a failed send to email"""
+        key = (job_id, error_class(error))
+        with self._lock:
+            group = self._groups.get(key)
+            if group is None:
+                group = self._groups[key] = _ErrorGroup()
+            if group.count == 0:
+                group.first_seen = datetime.utcnow()
+            group.count += 1
+            if group.samples_written + len(group.samples) < self.max_samples:
+                group.samples.append(email)
+
+    def finish_job(self, job_id):
+        """Write a job's pending errors now and forget its groups.
+
+        Called when a sender is done with the job, so its errors are logged
+        ahead of the summary that follows.
+        """
+        self.flush(job_id=job_id)
+
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.wait(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Error writing job log entries: {str(e)}")
+
+    def flush(self, force=False, job_id=None):
+        """Write pending groups to the job log.
+
+        Groups with new samples are written every time; the others wait for
+        SUMMARY_INTERVAL unless force is set. With job_id, writes all of that
+        job's groups and drops them.
+
+        Returns:
+            int: Number of entries written
+        """
+        if self.app is None:
+            return 0
+
+        with self._flush_lock:
+            rows = self._take(force, job_id)
+            if not rows:
+                return 0
+
+            with self.app.app_context():
+                try:
+                    db.session.execute(insert(JobLog), rows)
+                    db.session.commit()
+                except Exception as e:
+                    db.session.rollback()
+                    self._failed_attempts += 1
+
+                    if self._failed_attempts >= MAX_FLUSH_ATTEMPTS:
+                        logging.error(f"Discarding {len(rows)} job log entries after {self._failed_attempts} failed writes: {str(e)}")
+                        self._failed_attempts = 0
+                        return 0
+
+                    logging.warning(f"Error writing {len(rows)} job log entries, will retry: {str(e)}")
+                    with self._lock:
+                        self._retry = rows + self._retry
+                    return 0
+
+            self._failed_attempts = 0
+            return len(rows)
+
+    def _take(self, force, job_id):
+        """Turn due groups into JobLog rows and reset them"""
+        now = time.monotonic()
+        with self._lock:
+            rows, self._retry = self._retry, []
+
+            for key in list(self._groups):
+                group = self._groups[key]
+                finishing = job_id is not None and key[0] == job_id
+                if finishing:
+                    del self._groups[key]
+                if group.count == 0:
+                    continue
+                if not (finishing or force or group.samples or now - group.last_written >= self.summary_interval):
+                    continue
+
+                rows.append({
+                    'job_id': key[0],
+                    'timestamp': group.first_seen,
+                    'message': self._message(key[1], group),
+                    'level': 'error',
+                })
+                group.samples_written += len(group.samples)
+                group.samples = []
+                group.count = 0
+                group.last_written = now
+
+            return rows
+
+    @staticmethod
+    def _message(error, group):
+        if group.count == 1 and group.samples:
+            return f"Failed to send email to {group.samples[0]}: {error}"
+
+        message = f"{group.count:,} × {error}"
+        if group.samples:
+            message += f" (e.g. {', '.join(group.samples)})"
+        return message
+
+
+# Shared by every sender in this process
+job_log_writer = JobLogWriter()
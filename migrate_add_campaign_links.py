@@ -0,0 +1,83 @@
+"""
+This migration script adds the campaign_link table used for click tracking.
+
+It creates campaign_link, adds the link_id column to the EmailClick model and
+makes email_click.url nullable, since clicks on a CampaignLink no longer
+store the URL. SQLite can't drop NOT NULL, so there the table is rebuilt.
+"""
+import sys
+import sqlalchemy as sa
+from app import db, app
+from models import CampaignLink
+
+# email_click's columns, copied over when the table is rebuilt on SQLite
+CLICK_COLUMNS = "id, job_id, contact_id, tracking_id, url, link_id, timestamp, ip_address, user_agent"
+
+def rebuild_click_table(indexes):
+    # legacy_alter_table keeps other tables' foreign keys pointing at "email_click"
+    db.session.execute(sa.text("PRAGMA legacy_alter_table = ON"))
+    db.session.execute(sa.text("ALTER TABLE email_click RENAME TO email_click_old"))
+    db.session.execute(sa.text("""
+        CREATE TABLE email_click (
+            id INTEGER NOT NULL PRIMARY KEY,
+            job_id INTEGER NOT NULL REFERENCES scheduled_job (id),
+            contact_id INTEGER NOT NULL REFERENCES contact (id),
+            tracking_id VARCHAR(64) NOT NULL,
+            url TEXT,
+            link_id INTEGER REFERENCES campaign_link (id),
+            timestamp DATETIME,
+            ip_address VARCHAR(45),
+            user_agent VARCHAR(255)
+        )
+    """))
+    db.session.execute(sa.text(
+        f"INSERT INTO email_click ({CLICK_COLUMNS}) SELECT {CLICK_COLUMNS} FROM email_click_old"
+    ))
+    db.session.execute(sa.text("DROP TABLE email_click_old"))
+
+    # Dropping the old table dropped its indexes
+    for index in indexes:
+        unique = "UNIQUE " if index['unique'] else ""
+        db.session.execute(sa.text(
+            f"CREATE {unique}INDEX {index['name']} ON email_click ({', '.join(index['column_names'])})"
+        ))
+
+def run_migration():
+    """Create campaign_link and point email_click at it"""
+    print("Starting migration: Adding campaign links")
+
+    with app.app_context():
+        # Create the new table if it doesn't exist yet
+        CampaignLink.__table__.create(db.engine, checkfirst=True)
+
+        # Check which columns already exist
+        inspector = sa.inspect(db.engine)
+        columns = {col['name']: col for col in inspector.get_columns('email_click')}
+
+        try:
+            if 'link_id' in columns:
+                print("Column 'link_id' already exists in email_click table")
+            else:
+                print("Adding link_id column to email_click table")
+                db.session.execute(sa.text(
+                    "ALTER TABLE email_click ADD COLUMN link_id INTEGER REFERENCES campaign_link (id)"
+                ))
+
+            if columns['url']['nullable']:
+                print("Column 'url' is already nullable")
+            elif db.engine.dialect.name == 'postgresql':
+                print("Making email_click.url nullable")
+                db.session.execute(sa.text("ALTER TABLE email_click ALTER COLUMN url DROP NOT NULL"))
+            else:
+                print("Rebuilding email_click to make url nullable")
+                rebuild_click_table(inspector.get_indexes('email_click'))
+
+            db.session.commit()
+            print("Migration successful!")
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error during migration: {str(e)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    run_migration()
@@ -0,0 +1,58 @@
+"""
+This migration script prepares the contact tables for the paginated
+contact listings (contact_listing.py).
+
+It adds the (list_id, id) index that admin list pages are walked along and,
+on PostgreSQL, switches email_normalized to the "C" collation so that email
+prefix searches are range scans of the unique email indexes. Changing the
+collation rebuilds those indexes and locks the table while it does.
+"""
+import sys
+import sqlalchemy as sa
+from app import db, app
+
+# Tables whose email_normalized is searched by prefix
+SEARCHED_TABLES = ["contact", "admin_email_contact"]
+
+def run_migration():
+    """Add ix_admin_email_contact_list_id_id and the email_normalized collation"""
+    print("Starting migration: Adding contact listing indexes")
+
+    with app.app_context():
+        inspector = sa.inspect(db.engine)
+        indexes = [index['name'] for index in inspector.get_indexes('admin_email_contact')]
+
+        try:
+            if 'ix_admin_email_contact_list_id_id' not in indexes:
+                print("Creating ix_admin_email_contact_list_id_id index")
+                db.session.execute(sa.text(
+                    "CREATE INDEX ix_admin_email_contact_list_id_id ON admin_email_contact (list_id, id)"
+                ))
+            else:
+                print("Index ix_admin_email_contact_list_id_id already exists")
+
+            # SQLite always compares strings byte by byte
+            if db.engine.dialect.name == 'postgresql':
+                for table in SEARCHED_TABLES:
+                    collation = db.session.execute(sa.text("""
+                        SELECT collation_name FROM information_schema.columns
+                        WHERE table_name = :table AND column_name = 'email_normalized'
+                    """), {"table": table}).scalar()
+                    if collation == 'C':
+                        print(f"{table}.email_normalized already uses the C collation")
+                        continue
+
+                    print(f"Switching {table}.email_normalized to the C collation")
+                    db.session.execute(sa.text(
+                        f'ALTER TABLE {table} ALTER COLUMN email_normalized TYPE VARCHAR(120) COLLATE "C"'
+                    ))
+
+            db.session.commit()
+            print("Migration successful!")
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error during migration: {str(e)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    run_migration()
@@ -0,0 +1,32 @@
+"""
+This migration script adds the (segment_id, id) index used to stream a segment's contacts.
+"""
+import sys
+import sqlalchemy as sa
+from app import db, app
+
+def run_migration():
+    """Add ix_contact_segment_id_id index to the Contact table"""
+    print("Starting migration: Adding (segment_id, id) index to Contact table")
+    
+    with app.app_context():
+        # Check if the index already exists
+        inspector = sa.inspect(db.engine)
+        indexes = [index['name'] for index in inspector.get_indexes('contact')]
+        
+        if 'ix_contact_segment_id_id' not in indexes:
+            print("Creating ix_contact_segment_id_id index")
+            
+            try:
+                db.session.execute(sa.text("CREATE INDEX ix_contact_segment_id_id ON contact (segment_id, id)"))
+                db.session.commit()
+                print("Migration successful!")
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error during migration: {str(e)}")
+                sys.exit(1)
+        else:
+            print("Migration already applied - ix_contact_segment_id_id index already exists")
+
+if __name__ == "__main__":
+    run_migration()
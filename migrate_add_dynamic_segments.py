@@ -0,0 +1,78 @@
+"""
+This migration script adds rule-based dynamic segments (segment_rules.py).
+
+It adds the rules and materialization columns to email_segment, and the
+(contact_id, timestamp) indexes on email_open and email_click that the
+engagement rules look contacts up by. The indexes are built CONCURRENTLY on
+PostgreSQL so tracking carries on while they build.
+"""
+import sys
+import sqlalchemy as sa
+from app import db, app
+
+# (column, type) added to email_segment
+SEGMENT_COLUMNS = [
+    ("rules", "TEXT"),
+    ("materialize", "BOOLEAN DEFAULT FALSE"),
+    ("refresh_ttl_minutes", "INTEGER"),
+    ("materialized_at", "TIMESTAMP"),
+]
+
+# (table, index) on (contact_id, timestamp)
+ENGAGEMENT_INDEXES = [
+    ("email_open", "ix_email_open_contact_id_timestamp"),
+    ("email_click", "ix_email_click_contact_id_timestamp"),
+]
+
+def add_columns(columns):
+    for column, column_type in SEGMENT_COLUMNS:
+        if column in columns:
+            print(f"Column '{column}' already exists in email_segment table")
+            continue
+
+        print(f"Adding {column} column to email_segment table")
+        db.session.execute(sa.text(f"ALTER TABLE email_segment ADD COLUMN {column} {column_type}"))
+    db.session.commit()
+
+def create_index(table, index_name):
+    columns = f"{table} (contact_id, timestamp)"
+    print(f"Creating {index_name} index")
+
+    if db.engine.dialect.name != "postgresql":
+        db.session.execute(sa.text(f"CREATE INDEX {index_name} ON {columns}"))
+        db.session.commit()
+        return
+
+    # CONCURRENTLY can't run inside a transaction
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        try:
+            connection.execute(sa.text(f"CREATE INDEX CONCURRENTLY {index_name} ON {columns}"))
+        except Exception:
+            # A failed concurrent build leaves an invalid index behind
+            connection.execute(sa.text(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}"))
+            raise
+
+def run_migration():
+    """Add the dynamic segment columns and engagement indexes"""
+    print("Starting migration: Adding dynamic segments")
+
+    with app.app_context():
+        inspector = sa.inspect(db.engine)
+
+        try:
+            add_columns([col['name'] for col in inspector.get_columns('email_segment')])
+
+            for table, index_name in ENGAGEMENT_INDEXES:
+                if index_name in [index['name'] for index in inspector.get_indexes(table)]:
+                    print(f"Index {index_name} already exists")
+                    continue
+                create_index(table, index_name)
+
+            print("Migration successful!")
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error during migration: {str(e)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    run_migration()
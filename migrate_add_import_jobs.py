@@ -0,0 +1,23 @@
+"""
+This migration script adds the import_job table that records contact
+imports running in the background (import_jobs.py).
+"""
+import sys
+from app import db, app
+from models import ImportJob
+
+def run_migration():
+    """Create the import_job table and its index"""
+    print("Starting migration: Adding import jobs")
+
+    with app.app_context():
+        try:
+            # Creates the table with its (target_type, target_id, id) index if it doesn't exist yet
+            ImportJob.__table__.create(db.engine, checkfirst=True)
+            print("Migration successful!")
+        except Exception as e:
+            print(f"Error during migration: {str(e)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    run_migration()
@@ -0,0 +1,35 @@
+"""
+This migration script adds the heartbeat_at column to the ScheduledJob model.
+
+The send loop updates heartbeat_at after every batch, and interrupted jobs
+are detected from it rather than from updated_at, which tracking counters
+also bump.
+"""
+import sys
+import sqlalchemy as sa
+from app import db, app
+
+def run_migration():
+    """Add heartbeat_at to the scheduled_job table"""
+    print("Starting migration: Adding job heartbeat")
+
+    with app.app_context():
+        inspector = sa.inspect(db.engine)
+        columns = [col['name'] for col in inspector.get_columns('scheduled_job')]
+
+        if 'heartbeat_at' in columns:
+            print("Column 'heartbeat_at' already exists in scheduled_job table")
+            return
+
+        try:
+            print("Adding heartbeat_at column to scheduled_job table")
+            db.session.execute(sa.text("ALTER TABLE scheduled_job ADD COLUMN heartbeat_at TIMESTAMP"))
+            db.session.commit()
+            print("Migration successful!")
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error during migration: {str(e)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    run_migration()
@@ -0,0 +1,32 @@
+"""
+This migration script adds the (job_id, id) index used to page through a job's log.
+"""
+import sys
+import sqlalchemy as sa
+from app import db, app
+
+def run_migration():
+    """Add ix_job_log_job_id_id index to the JobLog table"""
+    print("Starting migration: Adding (job_id, id) index to JobLog table")
+    
+    with app.app_context():
+        # Check if the index already exists
+        inspector = sa.inspect(db.engine)
+        indexes = [index['name'] for index in inspector.get_indexes('job_log')]
+        
+        if 'ix_job_log_job_id_id' not in indexes:
+            print("Creating ix_job_log_job_id_id index")
+            
+            try:
+                db.session.execute(sa.text("CREATE INDEX ix_job_log_job_id_id ON job_log (job_id, id)"))
+                db.session.commit()
+                print("Migration successful!")
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error during migration: {str(e)}")
+                sys.exit(1)
+        else:
+            print("Migration already applied - ix_job_log_job_id_id index already exists")
+
+if __name__ == "__main__":
+    run_migration()
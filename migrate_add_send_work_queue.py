@@ -0,0 +1,23 @@
+"""
+This migration script adds the send_work_item table that send workers
+(worker.py) take campaign work from when USE_SEND_WORKERS is set.
+"""
+import sys
+from app import db, app
+from models import SendWorkItem
+
+def run_migration():
+    """Create the send_work_item table and its indexes"""
+    print("Starting migration: Adding send work queue")
+
+    with app.app_context():
+        try:
+            # Creates the table with its (status, id) and job_id indexes if it doesn't exist yet
+            SendWorkItem.__table__.create(db.engine, checkfirst=True)
+            print("Migration successful!")
+        except Exception as e:
+            print(f"Error during migration: {str(e)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    run_migration()
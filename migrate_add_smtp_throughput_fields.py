@@ -0,0 +1,40 @@
+"""
+This migration script adds the sending throughput fields to the SMTPConfig model.
+"""
+import sys
+import sqlalchemy as sa
+from app import db, app
+from models import DEFAULT_MAX_CONNECTIONS, DEFAULT_SEND_RATE_LIMIT
+
+COLUMNS = [
+    ("max_connections", f"INTEGER DEFAULT {DEFAULT_MAX_CONNECTIONS}"),
+    ("send_rate_limit", f"FLOAT DEFAULT {DEFAULT_SEND_RATE_LIMIT}"),
+]
+
+def run_migration():
+    """Add max_connections and send_rate_limit fields to the SMTPConfig table"""
+    print("Starting migration: Adding throughput fields to SMTPConfig table")
+
+    with app.app_context():
+        # Check which columns already exist
+        inspector = sa.inspect(db.engine)
+        columns = [col['name'] for col in inspector.get_columns('smtp_config')]
+
+        try:
+            for column_name, column_type in COLUMNS:
+                if column_name in columns:
+                    print(f"Column '{column_name}' already exists in smtp_config table")
+                    continue
+
+                print(f"Adding {column_name} column to smtp_config table")
+                db.session.execute(sa.text(f"ALTER TABLE smtp_config ADD COLUMN {column_name} {column_type}"))
+
+            db.session.commit()
+            print("Migration successful!")
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error during migration: {str(e)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    run_migration()
@@ -0,0 +1,74 @@
+"""
+This migration script adds unique open/click tracking.
+
+It creates the email_unique_open and email_unique_click tables, adds the
+unique_opens and unique_clicks counters to the ScheduledJob model, and
+backfills both from the open and click events already recorded.
+"""
+import sys
+import sqlalchemy as sa
+from app import db, app
+from models import EmailUniqueOpen, EmailUniqueClick
+
+COLUMNS = [
+    ("unique_opens", "INTEGER DEFAULT 0"),
+    ("unique_clicks", "INTEGER DEFAULT 0"),
+]
+
+# (unique table, first-event column, counter, raw event table)
+BACKFILLS = [
+    ("email_unique_open", "first_opened_at", "unique_opens", "email_open"),
+    ("email_unique_click", "first_clicked_at", "unique_clicks", "email_click"),
+]
+
+def run_migration():
+    """Create the unique engagement tables and counters and backfill them"""
+    print("Starting migration: Adding unique open/click tracking")
+
+    with app.app_context():
+        # Create the new tables if they don't exist yet
+        EmailUniqueOpen.__table__.create(db.engine, checkfirst=True)
+        EmailUniqueClick.__table__.create(db.engine, checkfirst=True)
+
+        # Check which columns already exist
+        inspector = sa.inspect(db.engine)
+        columns = [col['name'] for col in inspector.get_columns('scheduled_job')]
+
+        try:
+            for column_name, column_type in COLUMNS:
+                if column_name in columns:
+                    print(f"Column '{column_name}' already exists in scheduled_job table")
+                    continue
+
+                print(f"Adding {column_name} column to scheduled_job table")
+                db.session.execute(sa.text(f"ALTER TABLE scheduled_job ADD COLUMN {column_name} {column_type}"))
+
+            for unique_table, first_column, counter, event_table in BACKFILLS:
+                print(f"Backfilling {unique_table} from {event_table}")
+                db.session.execute(sa.text(f"""
+                    INSERT INTO {unique_table} (job_id, contact_id, {first_column})
+                    SELECT e.job_id, e.contact_id, MIN(e.timestamp)
+                    FROM {event_table} e
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM {unique_table} u
+                        WHERE u.job_id = e.job_id AND u.contact_id = e.contact_id
+                    )
+                    GROUP BY e.job_id, e.contact_id
+                """))
+
+                print(f"Recounting scheduled_job.{counter}")
+                db.session.execute(sa.text(f"""
+                    UPDATE scheduled_job SET {counter} = (
+                        SELECT COUNT(*) FROM {unique_table} u WHERE u.job_id = scheduled_job.id
+                    )
+                """))
+
+            db.session.commit()
+            print("Migration successful!")
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error during migration: {str(e)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    run_migration()
@@ -0,0 +1,170 @@
+"""
+This migration script deduplicates contacts and adds the unique
+(segment, normalized email) indexes.
+
+For both contact and admin_email_contact it:
+1. adds the email_normalized column (trimmed, lowercased email)
+2. fills it in batches of BATCH_SIZE rows by id range
+3. removes duplicate addresses in each segment or list, keeping the oldest
+   contact and moving the duplicates' sends, opens and clicks onto it;
+   each duplicate's id is kept in contact_alias so tracking links already
+   sent to it count for the contact kept; each batch of BATCH_SIZE
+   duplicates is its own short transaction
+4. creates the unique index, CONCURRENTLY on PostgreSQL so inserts carry on
+
+Each step only locks the rows it touches, so the app can stay up. Contacts
+added while it runs may create new duplicates and make step 4 fail; running
+the script again picks them up. On existing databases email_normalized is
+left nullable, as SET NOT NULL would lock the table for a full scan; the
+app always fills it in.
+"""
+import sys
+import sqlalchemy as sa
+from app import db, app
+from models import ContactAlias
+
+# Rows updated, or duplicates removed, per transaction
+BATCH_SIZE = 5000
+
+# (table, list column, unique index)
+TABLES = [
+    ("contact", "segment_id", "uq_contact_segment_email"),
+    ("admin_email_contact", "list_id", "uq_admin_email_contact_list_email"),
+]
+
+# Tables whose rows for a duplicate contact move to the contact kept.
+# Each (job_id, contact_id) is unique in the keyed tables, so rows the kept
+# contact already has for a job are dropped instead.
+CONTACT_EVENTS = ["email_open", "email_click"]
+CONTACT_KEYED = ["job_delivery", "email_unique_open", "email_unique_click"]
+
+def add_column(table, columns):
+    if "email_normalized" in columns:
+        print(f"Column 'email_normalized' already exists in {table} table")
+        return
+
+    print(f"Adding email_normalized column to {table} table")
+    db.session.execute(sa.text(f"ALTER TABLE {table} ADD COLUMN email_normalized VARCHAR(120)"))
+    db.session.commit()
+
+def backfill(table):
+    max_id = db.session.execute(sa.text(f"SELECT MAX(id) FROM {table}")).scalar() or 0
+    print(f"Filling {table}.email_normalized for ids up to {max_id}")
+
+    for start in range(0, max_id, BATCH_SIZE):
+        db.session.execute(sa.text(f"""
+            UPDATE {table} SET email_normalized = LOWER(TRIM(email))
+            WHERE id > :start AND id <= :end AND email_normalized IS NULL
+        """), {"start": start, "end": start + BATCH_SIZE})
+        db.session.commit()
+
+def dedupe(table, list_column, existing_tables):
+    list_ids = [row[0] for row in db.session.execute(sa.text(f"""
+        SELECT DISTINCT {list_column} FROM {table}
+        GROUP BY {list_column}, email_normalized
+        HAVING COUNT(*) > 1
+    """))]
+    print(f"{len(list_ids)} {list_column} values in {table} have duplicate addresses")
+
+    removed = 0
+    for list_id in list_ids:
+        # (duplicate id, id of the oldest contact with the same address)
+        pairs = [{"dup": row[0], "keep": row[1]} for row in db.session.execute(sa.text(f"""
+            SELECT id, keep_id FROM (
+                SELECT id, MIN(id) OVER (PARTITION BY email_normalized) AS keep_id
+                FROM {table} WHERE {list_column} = :list_id
+            ) grouped
+            WHERE id <> keep_id
+        """), {"list_id": list_id})]
+
+        for start in range(0, len(pairs), BATCH_SIZE):
+            batch = pairs[start:start + BATCH_SIZE]
+            if table == "contact":
+                move_contact_rows(batch, existing_tables)
+            db.session.execute(sa.text(f"DELETE FROM {table} WHERE id = :dup"), batch)
+            db.session.commit()
+            removed += len(batch)
+
+    print(f"Removed {removed} duplicate rows from {table}")
+
+def move_contact_rows(batch, existing_tables):
+    # Tracking tokens in sent emails carry the duplicate's id; aliases of
+    # the duplicate itself move to the contact kept as well
+    db.session.execute(sa.text(
+        "INSERT INTO contact_alias (old_contact_id, contact_id) VALUES (:dup, :keep) ON CONFLICT DO NOTHING"
+    ), batch)
+    db.session.execute(sa.text("UPDATE contact_alias SET contact_id = :keep WHERE contact_id = :dup"), batch)
+
+    for event_table in CONTACT_EVENTS:
+        if event_table in existing_tables:
+            db.session.execute(sa.text(
+                f"UPDATE {event_table} SET contact_id = :keep WHERE contact_id = :dup"
+            ), batch)
+
+    for keyed_table in CONTACT_KEYED:
+        if keyed_table in existing_tables:
+            db.session.execute(sa.text(f"""
+                DELETE FROM {keyed_table} WHERE contact_id = :dup AND job_id IN (
+                    SELECT job_id FROM {keyed_table} WHERE contact_id = :keep
+                )
+            """), batch)
+            db.session.execute(sa.text(
+                f"UPDATE {keyed_table} SET contact_id = :keep WHERE contact_id = :dup"
+            ), batch)
+
+def create_unique_index(table, list_column, index_name):
+    columns = f"{table} ({list_column}, email_normalized)"
+    print(f"Creating {index_name} index")
+
+    if db.engine.dialect.name != "postgresql":
+        db.session.execute(sa.text(f"CREATE UNIQUE INDEX {index_name} ON {columns}"))
+        db.session.commit()
+        return
+
+    # CONCURRENTLY can't run inside a transaction
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        try:
+            connection.execute(sa.text(f"CREATE UNIQUE INDEX CONCURRENTLY {index_name} ON {columns}"))
+        except Exception:
+            # A failed concurrent build leaves an invalid index behind
+            connection.execute(sa.text(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}"))
+            raise
+
+def run_migration():
+    """Add email_normalized, remove duplicate contacts and add the unique indexes"""
+    print("Starting migration: Deduplicating contacts")
+
+    with app.app_context():
+        inspector = sa.inspect(db.engine)
+        existing_tables = inspector.get_table_names()
+
+        try:
+            ContactAlias.__table__.create(db.engine, checkfirst=True)
+
+            for table, list_column, index_name in TABLES:
+                indexes = [index['name'] for index in inspector.get_indexes(table)]
+                if index_name in indexes:
+                    print(f"Migration already applied - {index_name} index already exists")
+                    continue
+
+                columns = [col['name'] for col in inspector.get_columns(table)]
+                if list_column not in columns:
+                    # migrate_global_contacts replaced contact.segment_id with
+                    # memberships and its own unique index
+                    print(f"Migration already applied - {table}.{list_column} already removed")
+                    continue
+
+                add_column(table, columns)
+                backfill(table)
+                dedupe(table, list_column, existing_tables)
+                create_unique_index(table, list_column, index_name)
+
+            print("Migration successful!")
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error during migration: {str(e)}")
+            print("Run the script again to pick up contacts added while it ran.")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    run_migration()
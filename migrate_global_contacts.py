@@ -0,0 +1,175 @@
+"""
+This migration script moves contacts from per-segment copies to one contact
+per user plus a segment_membership table.
+
+Run migrate_dedupe_contacts.py first, and run this with no campaigns
+sending. It:
+1. creates the segment_membership table
+2. adds contact.user_id and fills it from each contact's segment
+3. records each contact's segment in segment_membership
+4. merges each user's contacts with the same address into the oldest one,
+   moving memberships, sends, opens and clicks onto it, and keeps each
+   merged id in contact_alias
+5. drops contact.segment_id with its indexes and adds the unique
+   (user_id, email_normalized) index
+
+Steps 2-4 run in batches of BATCH_SIZE rows per transaction and can be
+repeated. Tracking links already sent to a merged contact carry its old id;
+the tracking buffer looks it up in contact_alias and counts them for the
+contact kept.
+"""
+import sys
+import sqlalchemy as sa
+from app import db, app
+from models import SegmentMembership, ContactAlias
+from migrate_dedupe_contacts import move_contact_rows
+
+# Rows updated, or contacts merged, per transaction
+BATCH_SIZE = 5000
+
+def add_user_id(columns):
+    if "user_id" not in columns:
+        print("Adding user_id column to contact table")
+        db.session.execute(sa.text("ALTER TABLE contact ADD COLUMN user_id INTEGER REFERENCES \"user\" (id)"))
+        db.session.commit()
+
+    max_id = db.session.execute(sa.text("SELECT MAX(id) FROM contact")).scalar() or 0
+    print(f"Filling contact.user_id and segment_membership for ids up to {max_id}")
+
+    for start in range(0, max_id, BATCH_SIZE):
+        params = {"start": start, "end": start + BATCH_SIZE}
+        db.session.execute(sa.text("""
+            UPDATE contact SET user_id = (
+                SELECT user_id FROM email_segment WHERE email_segment.id = contact.segment_id
+            )
+            WHERE id > :start AND id <= :end AND user_id IS NULL
+        """), params)
+        db.session.execute(sa.text("""
+            INSERT INTO segment_membership (segment_id, contact_id, created_at)
+            SELECT segment_id, id, created_at FROM contact
+            WHERE id > :start AND id <= :end
+            ON CONFLICT DO NOTHING
+        """), params)
+        db.session.commit()
+
+def merge_contacts(existing_tables):
+    user_ids = [row[0] for row in db.session.execute(sa.text("""
+        SELECT DISTINCT user_id FROM contact
+        GROUP BY user_id, email_normalized
+        HAVING COUNT(*) > 1
+    """))]
+    print(f"{len(user_ids)} users have the same address in several segments")
+
+    merged = 0
+    for user_id in user_ids:
+        # (duplicate id, id of the user's oldest contact with the same address)
+        pairs = [{"dup": row[0], "keep": row[1]} for row in db.session.execute(sa.text("""
+            SELECT id, keep_id FROM (
+                SELECT id, MIN(id) OVER (PARTITION BY email_normalized) AS keep_id
+                FROM contact WHERE user_id = :user_id
+            ) grouped
+            WHERE id <> keep_id
+        """), {"user_id": user_id})]
+
+        for start in range(0, len(pairs), BATCH_SIZE):
+            batch = pairs[start:start + BATCH_SIZE]
+            db.session.execute(sa.text("""
+                INSERT INTO segment_membership (segment_id, contact_id, created_at)
+                SELECT segment_id, :keep, created_at FROM segment_membership
+                WHERE contact_id = :dup
+                ON CONFLICT DO NOTHING
+            """), batch)
+            db.session.execute(sa.text("DELETE FROM segment_membership WHERE contact_id = :dup"), batch)
+            move_contact_rows(batch, existing_tables)
+            db.session.execute(sa.text("DELETE FROM contact WHERE id = :dup"), batch)
+            db.session.commit()
+            merged += len(batch)
+
+    print(f"Merged {merged} contact rows")
+
+def drop_segment_id():
+    print("Dropping contact.segment_id")
+
+    if db.engine.dialect.name == "postgresql":
+        # Drops the column's indexes and foreign key with it
+        db.session.execute(sa.text("ALTER TABLE contact DROP COLUMN segment_id"))
+        db.session.execute(sa.text("ALTER TABLE contact ALTER COLUMN user_id SET NOT NULL"))
+        db.session.commit()
+        return
+
+    # SQLite can't drop a column with a foreign key, so rebuild the table.
+    # legacy_alter_table keeps other tables' foreign keys pointing at "contact".
+    db.session.execute(sa.text("PRAGMA legacy_alter_table = ON"))
+    db.session.execute(sa.text("ALTER TABLE contact RENAME TO contact_old"))
+    for index in ("ix_contact_segment_id_id", "uq_contact_segment_email"):
+        db.session.execute(sa.text(f"DROP INDEX IF EXISTS {index}"))
+    db.session.execute(sa.text("""
+        CREATE TABLE contact (
+            id INTEGER NOT NULL PRIMARY KEY,
+            user_id INTEGER NOT NULL REFERENCES user (id),
+            email VARCHAR(120) NOT NULL,
+            email_normalized VARCHAR(120) NOT NULL,
+            name VARCHAR(120),
+            created_at DATETIME
+        )
+    """))
+    db.session.execute(sa.text("""
+        INSERT INTO contact (id, user_id, email, email_normalized, name, created_at)
+        SELECT id, user_id, email, email_normalized, name, created_at FROM contact_old
+    """))
+    db.session.execute(sa.text("DROP TABLE contact_old"))
+    db.session.commit()
+
+def create_unique_index():
+    print("Creating uq_contact_user_email index")
+
+    if db.engine.dialect.name != "postgresql":
+        db.session.execute(sa.text("CREATE UNIQUE INDEX uq_contact_user_email ON contact (user_id, email_normalized)"))
+        db.session.commit()
+        return
+
+    # CONCURRENTLY can't run inside a transaction
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        try:
+            connection.execute(sa.text(
+                "CREATE UNIQUE INDEX CONCURRENTLY uq_contact_user_email ON contact (user_id, email_normalized)"
+            ))
+        except Exception:
+            # A failed concurrent build leaves an invalid index behind
+            connection.execute(sa.text("DROP INDEX CONCURRENTLY IF EXISTS uq_contact_user_email"))
+            raise
+
+def run_migration():
+    """Move contacts to one per user with segment memberships"""
+    print("Starting migration: Global contacts with segment memberships")
+
+    with app.app_context():
+        inspector = sa.inspect(db.engine)
+        columns = [col['name'] for col in inspector.get_columns('contact')]
+
+        if "segment_id" not in columns:
+            print("Migration already applied - contact.segment_id already removed")
+            return
+
+        if "email_normalized" not in columns:
+            print("Error: run migrate_dedupe_contacts.py first")
+            sys.exit(1)
+
+        try:
+            SegmentMembership.__table__.create(db.engine, checkfirst=True)
+            ContactAlias.__table__.create(db.engine, checkfirst=True)
+
+            add_user_id(columns)
+            merge_contacts(inspector.get_table_names())
+            drop_segment_id()
+            create_unique_index()
+
+            print("Migration successful!")
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error during migration: {str(e)}")
+            print("Run the script again to continue.")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    run_migration()
@@ -2,11 +2,31 @@ from datetime import datetime, timedelta
 from app import db, login_manager
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import func, update
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import validates
+from sql_helpers import upsert_increment
 
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
 
+def normalize_email(email):
+    """Trim and lowercase an address, the form the unique contact indexes compare"""
+    return email.strip().lower() if email else email
+
+def _email_normalized_default(context):
+    # Fills email_normalized for Core inserts that only give the email
+    return normalize_email(context.get_current_parameters().get('email'))
+
+# Normalized addresses compare byte by byte on PostgreSQL too (SQLite always
+# does), so a prefix search is a range scan of the unique index
+NormalizedEmail = db.String(120).with_variant(postgresql.VARCHAR(120, collation='C'), 'postgresql')
+
+# Sending throughput of an SMTP configuration that doesn't set its own
+DEFAULT_MAX_CONNECTIONS = 4
+DEFAULT_SEND_RATE_LIMIT = 10.0
+
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), unique=True, nullable=False)
@@ -35,6 +55,7 @@ class User(UserMixin, db.Model):
     segments = db.relationship('EmailSegment', backref='owner', lazy='dynamic')
     templates = db.relationship('EmailTemplate', backref='owner', lazy='dynamic')
     scheduled_jobs = db.relationship('ScheduledJob', backref='owner', lazy='dynamic')
+    contacts = db.relationship('Contact', backref='owner', lazy='dynamic')
     
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
@@ -90,23 +111,85 @@ class EmailSegment(db.Model):
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     
+    # Dynamic segments (segment_rules.py); rules is JSON, NULL for a static segment
+    rules = db.Column(db.Text, nullable=True)
+    materialize = db.Column(db.Boolean, default=False)  # keep matching contacts in segment_membership
+    refresh_ttl_minutes = db.Column(db.Integer, nullable=True)  # age at which the materialization is rebuilt
+    materialized_at = db.Column(db.DateTime, nullable=True)
+    
     # Relationships
-    emails = db.relationship('Contact', backref='segment', lazy='dynamic', cascade='all, delete-orphan')
+    memberships = db.relationship('SegmentMembership', backref='segment', lazy='dynamic', cascade='all, delete-orphan')
+    emails = db.relationship('Contact', secondary='segment_membership', lazy='dynamic', viewonly=True)
     jobs = db.relationship('ScheduledJob', backref='segment', lazy='dynamic')
     
+    @property
+    def is_dynamic(self):
+        return self.rules is not None
+    
+    @property
+    def is_live(self):
+        """Whether the rules are evaluated on every read rather than read from segment_membership"""
+        return self.is_dynamic and not self.materialize
+    
+    def get_rules(self):
+        import json
+        try:
+            return json.loads(self.rules) if self.rules else None
+        except ValueError:
+            return None
+    
+    def set_rules(self, rules):
+        import json
+        self.rules = json.dumps(rules) if rules is not None else None
+    
     def __repr__(self):
         return f'<EmailSegment {self.name}>'
 
 class Contact(db.Model):
+    """A user's contact, stored once however many of their segments it is in"""
+    # An address is stored once per user
+    __table_args__ = (db.Index('uq_contact_user_email', 'user_id', 'email_normalized', unique=True),)
+    
     id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     email = db.Column(db.String(120), nullable=False)
+    email_normalized = db.Column(NormalizedEmail, nullable=False, default=_email_normalized_default)
     name = db.Column(db.String(120), nullable=True)
-    segment_id = db.Column(db.Integer, db.ForeignKey('email_segment.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    @validates('email')
+    def _normalize_email(self, key, email):
+        self.email_normalized = normalize_email(email)
+        return email
+    
     def __repr__(self):
         return f'<Contact {self.email}>'
 
+class SegmentMembership(db.Model):
+    """A contact's membership of a segment"""
+    __tablename__ = 'segment_membership'
+    # The primary key also serves keyset pagination over a segment's contacts
+    __table_args__ = (db.Index('ix_segment_membership_contact_id', 'contact_id'),)
+    
+    segment_id = db.Column(db.Integer, db.ForeignKey('email_segment.id'), primary_key=True)
+    contact_id = db.Column(db.Integer, db.ForeignKey('contact.id'), primary_key=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    contact = db.relationship('Contact', backref=db.backref('memberships', lazy='dynamic'))
+    
+    def __repr__(self):
+        return f'<SegmentMembership {self.segment_id}:{self.contact_id}>'
+
+class ContactAlias(db.Model):
+    """Id of a contact merged into another, so tracking links sent to it still count"""
+    __tablename__ = 'contact_alias'
+    
+    old_contact_id = db.Column(db.Integer, primary_key=True)  # no longer exists in contact
+    contact_id = db.Column(db.Integer, db.ForeignKey('contact.id'), nullable=False)
+    
+    def __repr__(self):
+        return f'<ContactAlias {self.old_contact_id}->{self.contact_id}>'
+
 class EmailTemplate(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
@@ -190,11 +273,16 @@ class ScheduledJob(db.Model):
     failed_emails = db.Column(db.Integer, default=0)
     opened_emails = db.Column(db.Integer, default=0)
     clicked_emails = db.Column(db.Integer, default=0)
+    unique_opens = db.Column(db.Integer, default=0)  # contacts who opened at least once
+    unique_clicks = db.Column(db.Integer, default=0)  # contacts who clicked at least once
     
     # Added timing statistics
     sending_started_at = db.Column(db.DateTime, nullable=True)
     sending_completed_at = db.Column(db.DateTime, nullable=True)
     avg_sending_rate = db.Column(db.Float, default=0.0)  # emails per second
+    # Last progress of the process sending the job; unlike updated_at, not
+    # touched by tracking counters
+    heartbeat_at = db.Column(db.DateTime, nullable=True)
     
     # Optimal send time fields
     use_optimal_time = db.Column(db.Boolean, default=False)
@@ -203,10 +291,91 @@ class ScheduledJob(db.Model):
     optimal_day_preference = db.Column(db.String(50), default='weekday')  # weekday, weekend, any
     actual_send_time = db.Column(db.DateTime, nullable=True)  # The actual optimized time when emails will be sent
     
+    # Statistics only ever changed through increment_counters
+    COUNTERS = ('sent_emails', 'failed_emails', 'opened_emails', 'clicked_emails', 'unique_opens', 'unique_clicks')
+    
+    @classmethod
+    def increment_counters(cls, job_id, **deltas):
+        """Add to a job's statistics with a single UPDATE ... SET x = x + :n
+        
+        The addition happens in the database, so concurrent increments are
+        never lost and the row lock is held for one statement. The job's
+        CampaignDailyStats row is updated in the same transaction. Runs in the
+        current session; the caller commits.
+        """
+        values = {}
+        for name, delta in deltas.items():
+            if name not in cls.COUNTERS:
+                raise ValueError(f"Unknown job counter: {name}")
+            if delta:
+                column = getattr(cls, name)
+                values[name] = func.coalesce(column, 0) + delta
+        
+        if not values:
+            return
+        
+        job = db.session.execute(
+            update(cls).where(cls.id == job_id).values(**values)
+            .returning(cls.user_id, cls.scheduled_time, cls.template_id, cls.segment_id)
+            .execution_options(synchronize_session=False)
+        ).first()
+        
+        if job:
+            CampaignDailyStats.increment(job, **{name: deltas[name] for name in values})
+    
     def __repr__(self):
         return f'<ScheduledJob {self.name}>'
 
+class CampaignDailyStats(db.Model):
+    """Campaign totals per user, day, template and segment for the monitoring dashboard.
+    
+    A job counts towards the day it was scheduled for. Rows are kept up to
+    date by ScheduledJob.increment_counters and rebuilt from scratch by
+    rebuild_campaign_daily_stats.py.
+    """
+    __tablename__ = 'campaign_daily_stats'
+    
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    template_id = db.Column(db.Integer, db.ForeignKey('email_template.id'), primary_key=True)
+    segment_id = db.Column(db.Integer, db.ForeignKey('email_segment.id'), primary_key=True)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    sent = db.Column(db.Integer, nullable=False, default=0)
+    failed = db.Column(db.Integer, nullable=False, default=0)
+    opened = db.Column(db.Integer, nullable=False, default=0)  # unique opens
+    clicked = db.Column(db.Integer, nullable=False, default=0)  # unique clicks
+    
+    # ScheduledJob column rolled up into each stats column
+    JOB_COLUMNS = {
+        'total_emails': 'total',
+        'sent_emails': 'sent',
+        'failed_emails': 'failed',
+        'unique_opens': 'opened',
+        'unique_clicks': 'clicked',
+    }
+    
+    @classmethod
+    def increment(cls, job, **deltas):
+        """Add a job's counter deltas (keyed by ScheduledJob column) to its day"""
+        changes = {cls.JOB_COLUMNS[name]: delta for name, delta in deltas.items() if name in cls.JOB_COLUMNS and delta}
+        if not changes:
+            return
+        
+        keys = {
+            'user_id': job.user_id,
+            'day': job.scheduled_time.date(),
+            'template_id': job.template_id,
+            'segment_id': job.segment_id,
+        }
+        db.session.execute(upsert_increment(cls, keys, changes))
+    
+    def __repr__(self):
+        return f'<CampaignDailyStats {self.user_id} {self.day}>'
+
 class JobLog(db.Model):
+    # Pages of a job's log are read newest first by id
+    __table_args__ = (db.Index('ix_job_log_job_id_id', 'job_id', 'id'),)
+    
     id = db.Column(db.Integer, primary_key=True)
     job_id = db.Column(db.Integer, db.ForeignKey('scheduled_job.id'), nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
@@ -219,7 +388,43 @@ class JobLog(db.Model):
     def __repr__(self):
         return f'<JobLog {self.id}>'
         
+class JobDelivery(db.Model):
+    """Delivery ledger: one row per contact a job has attempted to send to"""
+    job_id = db.Column(db.Integer, db.ForeignKey('scheduled_job.id'), primary_key=True)
+    contact_id = db.Column(db.Integer, db.ForeignKey('contact.id'), primary_key=True)
+    status = db.Column(db.String(20), nullable=False)  # sent, failed
+    attempts = db.Column(db.Integer, default=1)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<JobDelivery {self.job_id}:{self.contact_id} {self.status}>'
+
+class SendWorkItem(db.Model):
+    """A range of a job's contacts queued for a send worker (see worker.py)"""
+    __tablename__ = 'send_work_item'
+    __table_args__ = (db.Index('ix_send_work_item_status_id', 'status', 'id'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.Integer, db.ForeignKey('scheduled_job.id'), nullable=False, index=True)
+    # Covers the segment's contacts with after_contact_id < id <= last_contact_id
+    after_contact_id = db.Column(db.Integer, nullable=False)
+    last_contact_id = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20), default='pending')  # pending, claimed, done
+    claimed_by = db.Column(db.String(100), nullable=True)  # host:pid of the worker
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    attempts = db.Column(db.Integer, default=0)
+    sent_emails = db.Column(db.Integer, default=0)
+    failed_emails = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    completed_at = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f'<SendWorkItem {self.job_id}:{self.after_contact_id}-{self.last_contact_id} {self.status}>'
+
 class EmailOpen(db.Model):
+    # Serves the engagement rules of dynamic segments
+    __table_args__ = (db.Index('ix_email_open_contact_id_timestamp', 'contact_id', 'timestamp'),)
+    
     id = db.Column(db.Integer, primary_key=True)
     job_id = db.Column(db.Integer, db.ForeignKey('scheduled_job.id'), nullable=False)
     contact_id = db.Column(db.Integer, db.ForeignKey('contact.id'), nullable=False)
@@ -236,11 +441,15 @@ class EmailOpen(db.Model):
         return f'<EmailOpen {self.id}>'
         
 class EmailClick(db.Model):
+    # Serves the engagement rules of dynamic segments
+    __table_args__ = (db.Index('ix_email_click_contact_id_timestamp', 'contact_id', 'timestamp'),)
+    
     id = db.Column(db.Integer, primary_key=True)
     job_id = db.Column(db.Integer, db.ForeignKey('scheduled_job.id'), nullable=False)
     contact_id = db.Column(db.Integer, db.ForeignKey('contact.id'), nullable=False)
     tracking_id = db.Column(db.String(64), nullable=False)
-    url = db.Column(db.Text, nullable=False)
+    url = db.Column(db.Text, nullable=True)  # only set for links not in the job's CampaignLinks
+    link_id = db.Column(db.Integer, db.ForeignKey('campaign_link.id'), nullable=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     ip_address = db.Column(db.String(45), nullable=True)
     user_agent = db.Column(db.String(255), nullable=True)
@@ -248,10 +457,48 @@ class EmailClick(db.Model):
     # Relationships
     job = db.relationship('ScheduledJob', backref=db.backref('clicks', lazy='dynamic'))
     contact = db.relationship('Contact', backref=db.backref('clicks', lazy='dynamic'))
+    link = db.relationship('CampaignLink')
+    
+    @property
+    def target_url(self):
+        """The URL the click went to"""
+        return self.url if self.url is not None else (self.link.url if self.link else None)
     
     def __repr__(self):
         return f'<EmailClick {self.id}>'
 
+class CampaignLink(db.Model):
+    """A click-tracked URL in a job's emails, numbered once per job"""
+    __tablename__ = 'campaign_link'
+    __table_args__ = (db.UniqueConstraint('job_id', 'link_index', name='uq_campaign_link_job_index'),)
+    
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.Integer, db.ForeignKey('scheduled_job.id'), nullable=False)
+    link_index = db.Column(db.Integer, nullable=False)
+    url = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<CampaignLink {self.job_id}:{self.link_index}>'
+
+class EmailUniqueOpen(db.Model):
+    """First open of a job's email by each contact; every open is still kept in EmailOpen"""
+    job_id = db.Column(db.Integer, db.ForeignKey('scheduled_job.id'), primary_key=True)
+    contact_id = db.Column(db.Integer, db.ForeignKey('contact.id'), primary_key=True)
+    first_opened_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<EmailUniqueOpen {self.job_id}:{self.contact_id}>'
+
+class EmailUniqueClick(db.Model):
+    """First click in a job's email by each contact; every click is still kept in EmailClick"""
+    job_id = db.Column(db.Integer, db.ForeignKey('scheduled_job.id'), primary_key=True)
+    contact_id = db.Column(db.Integer, db.ForeignKey('contact.id'), primary_key=True)
+    first_clicked_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<EmailUniqueClick {self.job_id}:{self.contact_id}>'
+
 class SMTPConfig(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
@@ -267,6 +514,10 @@ class SMTPConfig(db.Model):
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     
+    # Sending throughput limits
+    max_connections = db.Column(db.Integer, default=DEFAULT_MAX_CONNECTIONS)  # parallel SMTP sessions across all jobs
+    send_rate_limit = db.Column(db.Float, default=DEFAULT_SEND_RATE_LIMIT)  # emails per second across all jobs, 0 = unlimited
+    
     # Relationships
     jobs = db.relationship('ScheduledJob', backref='smtp_config', lazy='dynamic')
     
@@ -305,8 +556,16 @@ class AdminEmailList(db.Model):
 
 class AdminEmailContact(db.Model):
     """Contact in an admin-only email list"""
+    __table_args__ = (
+        # Keyset pagination over a list's contacts walks this index
+        db.Index('ix_admin_email_contact_list_id_id', 'list_id', 'id'),
+        # An address is in a list at most once
+        db.Index('uq_admin_email_contact_list_email', 'list_id', 'email_normalized', unique=True),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(120), nullable=False)
+    email_normalized = db.Column(NormalizedEmail, nullable=False, default=_email_normalized_default)
     name = db.Column(db.String(120), nullable=True)
     company = db.Column(db.String(120), nullable=True)
     phone = db.Column(db.String(50), nullable=True)
@@ -314,9 +573,43 @@ class AdminEmailContact(db.Model):
     list_id = db.Column(db.Integer, db.ForeignKey('admin_email_list.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    @validates('email')
+    def _normalize_email(self, key, email):
+        self.email_normalized = normalize_email(email)
+        return email
+    
     def __repr__(self):
         return f'<AdminEmailContact {self.email}>'
 
+class ImportJob(db.Model):
+    """A contact import running in the background (see import_jobs.py)"""
+    __tablename__ = 'import_job'
+    __table_args__ = (db.Index('ix_import_job_target', 'target_type', 'target_id', 'id'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    target_type = db.Column(db.String(20), nullable=False)  # segment, admin_list
+    target_id = db.Column(db.Integer, nullable=False)
+    filename = db.Column(db.String(255), nullable=True)
+    status = db.Column(db.String(20), default='queued')  # queued, running, completed, failed
+    rows_read = db.Column(db.Integer, default=0)
+    inserted = db.Column(db.Integer, default=0)
+    rejected = db.Column(db.Integer, default=0)  # rows without a valid address
+    duplicates = db.Column(db.Integer, default=0)  # addresses already imported
+    rows_per_second = db.Column(db.Float, default=0.0)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    completed_at = db.Column(db.DateTime, nullable=True)
+
+    @property
+    def finished(self):
+        return self.status in ('completed', 'failed')
+
+    def __repr__(self):
+        return f'<ImportJob {self.id} {self.target_type}:{self.target_id} {self.status}>'
+
 class UserRegistrationRequest(db.Model):
     """Stores pending user registration requests that need admin approval"""
     id = db.Column(db.Integer, primary_key=True)
@@ -0,0 +1,60 @@
+"""
+This script rebuilds the campaign_daily_stats rollup from the ScheduledJob table.
+
+The rollup is normally kept up to date as jobs send and tracking events come
+in. Run this once after deploying it to backfill history, or at any time to
+repair it. Pass a user id to rebuild only that user's rows.
+
+    python rebuild_campaign_daily_stats.py [user_id]
+"""
+import sys
+import sqlalchemy as sa
+from app import db, app
+from models import CampaignDailyStats, ScheduledJob
+
+def run_rebuild(user_id=None):
+    """Recompute campaign_daily_stats from the per-job counters"""
+    print("Rebuilding campaign_daily_stats" + (f" for user {user_id}" if user_id else ""))
+
+    with app.app_context():
+        # Create the table if it doesn't exist yet
+        CampaignDailyStats.__table__.create(db.engine, checkfirst=True)
+
+        day = sa.func.date(ScheduledJob.scheduled_time)
+        totals = sa.select(
+            ScheduledJob.user_id,
+            day,
+            ScheduledJob.template_id,
+            ScheduledJob.segment_id,
+            sa.func.sum(sa.func.coalesce(ScheduledJob.total_emails, 0)),
+            sa.func.sum(sa.func.coalesce(ScheduledJob.sent_emails, 0)),
+            sa.func.sum(sa.func.coalesce(ScheduledJob.failed_emails, 0)),
+            sa.func.sum(sa.func.coalesce(ScheduledJob.unique_opens, 0)),
+            sa.func.sum(sa.func.coalesce(ScheduledJob.unique_clicks, 0)),
+        ).group_by(ScheduledJob.user_id, day, ScheduledJob.template_id, ScheduledJob.segment_id)
+
+        clear = sa.delete(CampaignDailyStats)
+        if user_id:
+            totals = totals.where(ScheduledJob.user_id == user_id)
+            clear = clear.where(CampaignDailyStats.user_id == user_id)
+
+        try:
+            # Replace the rows in one transaction so the dashboard never sees a partial rollup
+            deleted = db.session.execute(clear).rowcount
+            print(f"Removed {deleted} existing rows")
+
+            inserted = db.session.execute(sa.insert(CampaignDailyStats).from_select(
+                ['user_id', 'day', 'template_id', 'segment_id', 'total', 'sent', 'failed', 'opened', 'clicked'],
+                totals
+            )).rowcount
+            print(f"Inserted {inserted} rows")
+
+            db.session.commit()
+            print("Rebuild successful!")
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error during rebuild: {str(e)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    run_rebuild(int(sys.argv[1]) if len(sys.argv) > 1 else None)
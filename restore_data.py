@@ -5,7 +5,7 @@ import datetime
 import getpass
 from werkzeug.security import generate_password_hash
 from app import app, db
-from models import User, EmailSegment, Contact, EmailTemplate, SMTPConfig, ScheduledJob
+from models import User, EmailSegment, Contact, SegmentMembership, EmailTemplate, SMTPConfig, ScheduledJob
 
 def restore_data(backup_timestamp=None):
     """
@@ -39,6 +39,7 @@ def restore_data(backup_timestamp=None):
         ('users', User),
         ('segments', EmailSegment),
         ('contacts', Contact),
+        ('segment_memberships', SegmentMembership),
         ('templates', EmailTemplate), 
         ('smtp_configs', SMTPConfig),
         ('jobs', ScheduledJob)
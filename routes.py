@@ -6,8 +6,9 @@ from datetime import datetime, timedelta
 from flask import render_template, flash, redirect, url_for, request, jsonify, session, Response
 from flask_login import login_user, logout_user, current_user, login_required
 from urllib.parse import urlparse
+from sqlalchemy.orm import joinedload
 from app import app, db, mail
-from models import User, EmailSegment, Contact, EmailTemplate, ScheduledJob, SMTPConfig, UserSession, UserRegistrationRequest, AdminEmailList, AdminEmailContact, EmailOpen, EmailClick
+from models import User, EmailSegment, Contact, EmailTemplate, ScheduledJob, JobLog, SMTPConfig, UserSession, UserRegistrationRequest, AdminEmailList, AdminEmailContact, EmailOpen, EmailClick, CampaignDailyStats, ImportJob, SegmentMembership, normalize_email, DEFAULT_MAX_CONNECTIONS, DEFAULT_SEND_RATE_LIMIT
 from forms import (
     LoginForm, RegistrationForm, SegmentForm, ContactForm, ContactImportForm,
     TemplateForm, ScheduleJobForm, SMTPConfigForm, EmailEditorForm, TestEmailForm,
@@ -16,10 +17,19 @@ from forms import (
     AdminEmailListForm, AdminEmailContactForm, AdminContactImportForm
 )
 from email_service import update_mail_settings, send_test_email
+from smtp_pool import smtp_pool
+from template_compiler import invalidate_template
+from tracking_buffer import tracking_buffer
+import campaign_control
+import tracking_tokens
+import campaign_links
+import analytics
+import import_jobs
+import contact_listing
+import segment_rules
+from segment_rules import SegmentRuleError
 from flask_mail import Message
 import json
-import csv
-import io
 
 # Import email services
 from brevo_service import (
@@ -285,6 +295,12 @@ def admin_email_list_contacts(id):
     import_form = AdminContactImportForm()
     
     if contact_form.validate_on_submit() and 'add_contact' in request.form:
+        # Each address may only be in the list once
+        if AdminEmailContact.query.filter_by(list_id=email_list.id,
+                                             email_normalized=normalize_email(contact_form.email.data)).first():
+            flash('This email address is already in the list.', 'warning')
+            return redirect(url_for('admin_email_list_contacts', id=email_list.id))
+        
         # Add single contact
         contact = AdminEmailContact(
             email=contact_form.email.data,
@@ -297,106 +313,38 @@ def admin_email_list_contacts(id):
         
         db.session.add(contact)
         db.session.commit()
+        contact_listing.invalidate_count('admin_list', email_list.id)
         
         flash('Contact added successfully!', 'success')
         return redirect(url_for('admin_email_list_contacts', id=email_list.id))
     
     if import_form.validate_on_submit() and 'import_contacts' in request.form:
-        # Handle CSV file upload
-        if import_form.contacts_file.data:
-            try:
-                # Read CSV file
-                file_content = import_form.contacts_file.data.read().decode('utf-8')
-                csv_data = csv.reader(io.StringIO(file_content))
-                
-                # Skip header row
-                next(csv_data, None)
-                
-                # Process rows
-                added_count = 0
-                for row in csv_data:
-                    if len(row) >= 2:  # At least email and name
-                        email = row[0].strip()
-                        name = row[1].strip() if len(row) > 1 else None
-                        company = row[2].strip() if len(row) > 2 else None
-                        phone = row[3].strip() if len(row) > 3 else None
-                        
-                        # Basic email validation
-                        if '@' not in email:
-                            continue
-                        
-                        # Create contact
-                        contact = AdminEmailContact(
-                            email=email,
-                            name=name,
-                            company=company,
-                            phone=phone,
-                            list_id=email_list.id
-                        )
-                        
-                        db.session.add(contact)
-                        added_count += 1
-                
-                if added_count > 0:
-                    db.session.commit()
-                    flash(f'{added_count} contacts imported successfully!', 'success')
-                else:
-                    flash('No valid contacts found for import.', 'warning')
-            
-            except Exception as e:
-                flash(f'Error importing contacts: {str(e)}', 'danger')
-        
-        # Handle CSV text input
-        elif import_form.contacts.data:
-            try:
-                # Process CSV text
-                csv_data = csv.reader(io.StringIO(import_form.contacts.data))
-                
-                # Process rows
-                added_count = 0
-                for row in csv_data:
-                    if len(row) >= 1:  # At least email
-                        email = row[0].strip()
-                        name = row[1].strip() if len(row) > 1 else None
-                        company = row[2].strip() if len(row) > 2 else None
-                        phone = row[3].strip() if len(row) > 3 else None
-                        
-                        # Basic email validation
-                        if '@' not in email:
-                            continue
-                        
-                        # Create contact
-                        contact = AdminEmailContact(
-                            email=email,
-                            name=name,
-                            company=company,
-                            phone=phone,
-                            list_id=email_list.id
-                        )
-                        
-                        db.session.add(contact)
-                        added_count += 1
-                
-                if added_count > 0:
-                    db.session.commit()
-                    flash(f'{added_count} contacts imported successfully!', 'success')
-                else:
-                    flash('No valid contacts found for import.', 'warning')
-            
-            except Exception as e:
-                flash(f'Error importing contacts: {str(e)}', 'danger')
+        # Import the CSV file (which has a header row) or the pasted CSV text in the background
+        try:
+            import_jobs.start_import(app, current_user.id, 'admin_list', email_list.id,
+                                     file_storage=import_form.contacts_file.data,
+                                     text=import_form.contacts.data,
+                                     has_header=bool(import_form.contacts_file.data))
+            flash('Import started. Contacts will appear as they are imported.', 'info')
+        except Exception as e:
+            flash(f'Error importing contacts: {str(e)}', 'danger')
         
         return redirect(url_for('admin_email_list_contacts', id=email_list.id))
     
-    # Get contacts for this list
-    contacts = AdminEmailContact.query.filter_by(list_id=email_list.id).all()
+    # Get one page of this list's contacts, optionally matching an email prefix
+    search = request.args.get('q', '').strip()
+    page = contact_listing.list_contact_page(email_list, cursor=request.args.get('after'), search=search)
     
     return render_template('admin_email_list_contacts.html',
                            title=f'Admin Email List - {email_list.name}',
                            email_list=email_list,
-                           contacts=contacts,
+                           contacts=page.contacts,
+                           next_cursor=page.next_cursor,
+                           search=search,
+                           total_contacts=contact_listing.list_contact_count(email_list.id),
                            contact_form=contact_form,
-                           import_form=import_form)
+                           import_form=import_form,
+                           import_job=import_jobs.latest_import('admin_list', email_list.id))
 
 @app.route('/admin/email-lists/<int:list_id>/contacts/<int:contact_id>/delete', methods=['POST'])
 @login_required
@@ -420,6 +368,7 @@ def admin_delete_contact(list_id, contact_id):
     # Delete contact
     db.session.delete(contact)
     db.session.commit()
+    contact_listing.invalidate_count('admin_list', email_list.id)
     
     flash('Contact deleted successfully!', 'success')
     return redirect(url_for('admin_email_list_contacts', id=email_list.id))
@@ -784,7 +733,17 @@ def admin_create_user():
 @login_required
 def segments():
     segments = EmailSegment.query.filter_by(user_id=current_user.id).all()
-    return render_template('segments.html', title='Email Segments', segments=segments)
+    
+    # Count every segment's contacts in one query on the membership table;
+    # materialized segments show their cached contacts, and live ones are
+    # only counted on their own page
+    segment_sizes = dict(db.session.query(
+        SegmentMembership.segment_id, db.func.count()
+    ).filter(
+        SegmentMembership.segment_id.in_([segment.id for segment in segments if not segment.is_live])
+    ).group_by(SegmentMembership.segment_id).all())
+    
+    return render_template('segments.html', title='Email Segments', segments=segments, segment_sizes=segment_sizes)
 
 @app.route('/segments/new', methods=['GET', 'POST'])
 @login_required
@@ -796,10 +755,13 @@ def new_segment():
             description=form.description.data,
             user_id=current_user.id
         )
-        db.session.add(segment)
-        db.session.commit()
-        flash('Segment created successfully!', 'success')
-        return redirect(url_for('segments'))
+        error = _set_segment_rules(segment, form)
+        if error is None:
+            db.session.add(segment)
+            db.session.commit()
+            flash('Segment created successfully!', 'success')
+            return redirect(url_for('segments'))
+        form.rules.errors.append(error)
     
     return render_template('segment_editor.html', title='New Segment', form=form)
 
@@ -815,19 +777,99 @@ def edit_segment(id):
     
     form = SegmentForm()
     if form.validate_on_submit():
-        segment.name = form.name.data
-        segment.description = form.description.data
-        db.session.commit()
-        flash('Segment updated successfully!', 'success')
-        return redirect(url_for('segments'))
+        error = _set_segment_rules(segment, form)
+        if error is None:
+            segment.name = form.name.data
+            segment.description = form.description.data
+            db.session.commit()
+            contact_listing.invalidate_count('segment', segment.id)
+            flash('Segment updated successfully!', 'success')
+            return redirect(url_for('segments'))
+        form.rules.errors.append(error)
     
     # Pre-populate form with segment data
     if request.method == 'GET':
         form.name.data = segment.name
         form.description.data = segment.description
+        form.rules.data = json.dumps(segment.get_rules(), indent=2) if segment.is_dynamic else ''
+        form.materialize.data = bool(segment.materialize)
+        form.refresh_ttl_minutes.data = segment.refresh_ttl_minutes or segment_rules.DEFAULT_REFRESH_TTL_MINUTES
     
     return render_template('segment_editor.html', title='Edit Segment', form=form, segment=segment)
 
+def _set_segment_rules(segment, form):
+    """Set a segment's rules and caching from the segment form.
+    
+    Returns:
+        str: why the rules were rejected, or None
+    """
+    text = (form.rules.data or '').strip()
+    rules = None
+    materialize = False
+    if text:
+        try:
+            rules = segment_rules.parse_rules(text)
+            segment_rules.compile_rules(rules, segment.user_id, segment.id)
+        except SegmentRuleError as e:
+            return str(e)
+        
+        if segment.id is not None and not segment.is_dynamic and segment.memberships.first() is not None:
+            return 'Only a segment without contacts can be given rules. Create a new segment instead.'
+        materialize = bool(form.materialize.data)
+    
+    changed = rules != segment.get_rules() or materialize != bool(segment.materialize)
+    if changed and segment.id is not None:
+        # A job partway through the segment would skip or repeat contacts
+        job = segment_rules.active_job(segment)
+        if job is not None:
+            return f'Job "{job.name}" is sending this segment. Change its rules once the job has finished or been cancelled.'
+    
+    if rules is None:
+        # Contacts cached for a dynamic segment stay as its members
+        segment.rules = None
+        segment.materialize = False
+        segment.materialized_at = None
+        return None
+    
+    if changed:
+        # Match the contacts again the next time the segment is used
+        segment.materialized_at = None
+        if segment.id is not None:
+            SegmentMembership.query.filter_by(segment_id=segment.id).delete(synchronize_session=False)
+    
+    segment.set_rules(rules)
+    segment.materialize = materialize
+    segment.refresh_ttl_minutes = form.refresh_ttl_minutes.data
+    return None
+
+@app.route('/segments/<int:id>/refresh', methods=['POST'])
+@login_required
+def refresh_segment(id):
+    segment = EmailSegment.query.get_or_404(id)
+    
+    # Check if the segment belongs to the current user
+    if segment.user_id != current_user.id:
+        flash('You do not have permission to modify this segment.', 'danger')
+        return redirect(url_for('segments'))
+    
+    if not (segment.is_dynamic and segment.materialize):
+        flash('Only dynamic segments with cached contacts can be refreshed.', 'warning')
+        return redirect(url_for('segment_contacts', id=segment.id))
+    
+    job = segment_rules.active_job(segment)
+    if job is not None:
+        flash(f'Job "{job.name}" is sending this segment. Refresh it once the job has finished or been cancelled.', 'warning')
+        return redirect(url_for('segment_contacts', id=segment.id))
+    
+    try:
+        added, removed = segment_rules.refresh(segment)
+        flash(f'Segment refreshed: {added} contacts added, {removed} removed.', 'success')
+    except SegmentRuleError as e:
+        db.session.rollback()
+        flash(f'Error refreshing segment: {str(e)}', 'danger')
+    
+    return redirect(url_for('segment_contacts', id=segment.id))
+
 @app.route('/segments/<int:id>/delete', methods=['POST'])
 @login_required
 def delete_segment(id):
@@ -838,6 +880,16 @@ def delete_segment(id):
         flash('You do not have permission to delete this segment.', 'danger')
         return redirect(url_for('segments'))
     
+    # Segments whose rules read this one would stop working
+    referring = segment_rules.referring_segments(segment)
+    if referring:
+        names = ', '.join(f'"{other.name}"' for other in referring)
+        flash(f'This segment can\'t be deleted while the rules of {names} refer to it.', 'danger')
+        return redirect(url_for('segments'))
+    
+    # Remove the memberships in one statement rather than loading them; the
+    # contacts themselves stay with the user
+    SegmentMembership.query.filter_by(segment_id=segment.id).delete(synchronize_session=False)
     db.session.delete(segment)
     db.session.commit()
     flash('Segment deleted successfully!', 'success')
@@ -856,59 +908,98 @@ def segment_contacts(id):
     contact_form = ContactForm()
     import_form = ContactImportForm()
     
-    if contact_form.validate_on_submit() and 'add_contact' in request.form:
-        contact = Contact(
-            email=contact_form.email.data,
-            name=contact_form.name.data,
-            segment_id=segment.id
-        )
-        db.session.add(contact)
-        db.session.commit()
-        flash('Contact added successfully!', 'success')
+    if request.method == 'POST' and segment.is_dynamic:
+        flash('The contacts of a dynamic segment come from its rules.', 'warning')
         return redirect(url_for('segment_contacts', id=segment.id))
     
-    if import_form.validate_on_submit() and 'import_contacts' in request.form:
-        contacts_data = import_form.contacts.data.strip().split('\n')
-        added_count = 0
-        
-        for line in contacts_data:
-            line = line.strip()
-            if not line:
-                continue
-                
-            parts = line.split(',', 1)
-            email = parts[0].strip()
-            name = parts[1].strip() if len(parts) > 1 else None
-            
-            # Basic email validation
-            if '@' not in email:
-                continue
-            
+    if contact_form.validate_on_submit() and 'add_contact' in request.form:
+        # Reuse the user's contact with this address if there is one
+        contact = Contact.query.filter_by(user_id=current_user.id,
+                                          email_normalized=normalize_email(contact_form.email.data)).first()
+        if contact is None:
             contact = Contact(
-                email=email,
-                name=name,
-                segment_id=segment.id
+                email=contact_form.email.data,
+                name=contact_form.name.data,
+                user_id=current_user.id
             )
             db.session.add(contact)
-            added_count += 1
+            db.session.flush()
+        elif db.session.get(SegmentMembership, (segment.id, contact.id)):
+            # Each address may only be in the segment once
+            flash('This email address is already in the segment.', 'warning')
+            return redirect(url_for('segment_contacts', id=segment.id))
         
-        if added_count > 0:
-            db.session.commit()
-            flash(f'{added_count} contacts imported successfully!', 'success')
-        else:
-            flash('No valid contacts found for import.', 'warning')
+        db.session.add(SegmentMembership(segment_id=segment.id, contact_id=contact.id))
+        db.session.commit()
+        contact_listing.invalidate_count('segment', segment.id)
+        flash('Contact added successfully!', 'success')
+        return redirect(url_for('segment_contacts', id=segment.id))
+    
+    if import_form.validate_on_submit() and 'import_contacts' in request.form:
+        # Import the CSV file or the pasted lines in the background; neither has a header row
+        try:
+            import_jobs.start_import(app, current_user.id, 'segment', segment.id,
+                                     file_storage=import_form.contacts_file.data,
+                                     text=import_form.contacts.data)
+            flash('Import started. Contacts will appear as they are imported.', 'info')
+        except Exception as e:
+            flash(f'Error importing contacts: {str(e)}', 'danger')
             
         return redirect(url_for('segment_contacts', id=segment.id))
     
-    # Get contacts for this segment
-    contacts = Contact.query.filter_by(segment_id=segment.id).all()
+    # Get one page of this segment's contacts, optionally matching an email
+    # prefix; cached contacts are shown as they are, and only refreshed by a
+    # send or the Refresh button
+    search = request.args.get('q', '').strip()
+    try:
+        page = contact_listing.segment_contact_page(segment, cursor=request.args.get('after'), search=search)
+        total_contacts = contact_listing.segment_contact_count(segment)
+    except SegmentRuleError as e:
+        db.session.rollback()
+        flash(f'The rules of this segment no longer work: {str(e)}', 'danger')
+        page = contact_listing.ContactPage([], None)
+        total_contacts = 0
     
     return render_template('segment_contacts.html', 
                            title=f'Contacts - {segment.name}', 
                            segment=segment, 
-                           contacts=contacts, 
+                           contacts=page.contacts, 
+                           next_cursor=page.next_cursor,
+                           search=search,
+                           total_contacts=total_contacts,
+                           stale=segment_rules.is_stale(segment),
                            contact_form=contact_form,
-                           import_form=import_form)
+                           import_form=import_form,
+                           import_job=import_jobs.latest_import('segment', segment.id))
+
+@app.route('/imports/<int:import_id>')
+@login_required
+def import_progress(import_id):
+    """Return a contact import's progress as JSON for polling"""
+    import_job = ImportJob.query.get_or_404(import_id)
+    
+    # Check if the import belongs to the current user
+    if import_job.user_id != current_user.id:
+        return jsonify({'error': 'Permission denied'}), 403
+    
+    import_jobs.check_stale(import_job)
+    
+    data = {
+        'id': import_job.id,
+        'status': import_job.status,
+        'finished': import_job.finished,
+        'filename': import_job.filename,
+        'rows_read': import_job.rows_read,
+        'inserted': import_job.inserted,
+        'rejected': import_job.rejected,
+        'duplicates': import_job.duplicates,
+        'rows_per_second': import_job.rows_per_second,
+        'error': import_job.error,
+        'started_at': import_job.started_at.isoformat() if import_job.started_at else None,
+        'completed_at': import_job.completed_at.isoformat() if import_job.completed_at else None
+    }
+    
+    return jsonify(data)
 
 @app.route('/segments/<int:segment_id>/contacts/<int:contact_id>/delete', methods=['POST'])
 @login_required
@@ -920,16 +1011,22 @@ def delete_contact(segment_id, contact_id):
         flash('You do not have permission to modify this segment.', 'danger')
         return redirect(url_for('segments'))
     
-    contact = Contact.query.get_or_404(contact_id)
+    if segment.is_dynamic:
+        flash('The contacts of a dynamic segment come from its rules.', 'warning')
+        return redirect(url_for('segment_contacts', id=segment.id))
+    
+    membership = db.session.get(SegmentMembership, (segment.id, contact_id))
     
     # Check if the contact belongs to the segment
-    if contact.segment_id != segment.id:
+    if membership is None:
         flash('This contact does not belong to the specified segment.', 'danger')
         return redirect(url_for('segment_contacts', id=segment.id))
     
-    db.session.delete(contact)
+    # Only the membership goes; the contact and its history stay with the user
+    db.session.delete(membership)
     db.session.commit()
-    flash('Contact deleted successfully!', 'success')
+    contact_listing.invalidate_count('segment', segment.id)
+    flash('Contact removed from the segment!', 'success')
     return redirect(url_for('segment_contacts', id=segment.id))
 
 # Email Templates Routes
@@ -999,6 +1096,7 @@ def edit_template(id):
         template.version += 1  # Increment version on edit
         template.updated_at = datetime.utcnow()
         db.session.commit()
+        invalidate_template(template.id)
         flash('Template updated successfully!', 'success')
         return redirect(url_for('templates'))
     
@@ -1177,6 +1275,7 @@ def delete_template(id):
     
     db.session.delete(template)
     db.session.commit()
+    invalidate_template(id)
     flash('Template deleted successfully!', 'success')
     return redirect(url_for('templates'))
 
@@ -1203,6 +1302,8 @@ def new_smtp_config():
             use_ssl=form.use_ssl.data,
             from_email=form.from_email.data,
             from_name=form.from_name.data,
+            max_connections=form.max_connections.data or DEFAULT_MAX_CONNECTIONS,
+            send_rate_limit=form.send_rate_limit.data if form.send_rate_limit.data is not None else DEFAULT_SEND_RATE_LIMIT,
             user_id=current_user.id
         )
         db.session.add(config)
@@ -1238,8 +1339,15 @@ def edit_smtp_config(id):
         config.use_ssl = form.use_ssl.data
         config.from_email = form.from_email.data
         config.from_name = form.from_name.data
+        config.max_connections = form.max_connections.data or DEFAULT_MAX_CONNECTIONS
+        if form.send_rate_limit.data is not None:
+            config.send_rate_limit = form.send_rate_limit.data
         
         db.session.commit()
+        
+        # Drop pooled connections that were opened with the old settings
+        smtp_pool.close(config.id)
+        
         flash('SMTP Configuration updated successfully!', 'success')
         return redirect(url_for('smtp_config'))
     
@@ -1254,6 +1362,8 @@ def edit_smtp_config(id):
         form.use_ssl.data = config.use_ssl
         form.from_email.data = config.from_email
         form.from_name.data = config.from_name
+        form.max_connections.data = config.max_connections
+        form.send_rate_limit.data = config.send_rate_limit
     
     return render_template('smtp_form.html', title='Edit SMTP Configuration', form=form, config=config)
 
@@ -1269,6 +1379,7 @@ def delete_smtp_config(id):
     
     db.session.delete(config)
     db.session.commit()
+    smtp_pool.close(id)
     flash('SMTP Configuration deleted successfully!', 'success')
     return redirect(url_for('smtp_config'))
 
@@ -1380,7 +1491,12 @@ def new_job():
     if form.validate_on_submit():
         # Verify that selected segment has contacts
         segment = EmailSegment.query.get(form.segment_id.data)
-        if segment.emails.count() == 0:
+        try:
+            total_emails = segment_rules.count_contacts(segment)
+        except SegmentRuleError as e:
+            flash(f'The rules of the selected segment no longer work: {str(e)}', 'danger')
+            return render_template('job_form.html', title='New Email Job', form=form, smtp_configs=smtp_configs)
+        if total_emails == 0:
             flash('The selected segment has no contacts. Please add contacts before scheduling a job.', 'danger')
             return render_template('job_form.html', title='New Email Job', form=form, smtp_configs=smtp_configs)
         
@@ -1393,7 +1509,7 @@ def new_job():
             smtp_config_id=form.smtp_config_id.data,
             from_email=form.from_email.data if form.from_email.data else None,
             from_name=form.from_name.data if form.from_name.data else None,
-            total_emails=segment.emails.count(),
+            total_emails=total_emails,
             # Optimal send time settings
             use_optimal_time=form.use_optimal_time.data,
             optimal_time_window_start=form.optimal_time_window_start.data,
@@ -1401,7 +1517,11 @@ def new_job():
             optimal_day_preference=form.optimal_day_preference.data
         )
         db.session.add(job)
+        CampaignDailyStats.increment(job, total_emails=job.total_emails)
         db.session.commit()
+        
+        from scheduler import notify_job_changed
+        notify_job_changed(job.id)
         flash('Email job scheduled successfully!', 'success')
         return redirect(url_for('jobs'))
     return render_template('job_form.html', title='New Email Job', form=form, smtp_configs=smtp_configs)
@@ -1417,13 +1537,14 @@ def job_monitoring(job_id):
         flash('You do not have permission to view this job.', 'danger')
         return redirect(url_for('jobs'))
     
-    # Get job logs
-    logs = JobLog.query.filter_by(job_id=job_id).order_by(JobLog.timestamp.desc()).all()
+    # Show the newest log entries; older ones are loaded on demand
+    logs, has_older = get_job_log_page(job_id)
     
     return render_template('job_monitoring.html', 
                           title=f'Job Monitoring - {job.name}',
                           job=job,
-                          logs=logs)
+                          logs=logs,
+                          has_older_logs=has_older)
 
 @app.route('/job/<int:job_id>/data')
 @login_required
@@ -1446,6 +1567,8 @@ def get_job_data(job_id):
         'failed_emails': job.failed_emails,
         'opened_emails': job.opened_emails,
         'clicked_emails': job.clicked_emails,
+        'unique_opens': job.unique_opens,
+        'unique_clicks': job.unique_clicks,
         'current_batch': job.current_batch,
         'batch_size': job.batch_size,
         'avg_sending_rate': job.avg_sending_rate
@@ -1453,17 +1576,51 @@ def get_job_data(job_id):
     
     return jsonify(data)
 
+# Job log entries per page, and the most a client may ask for at once
+JOB_LOG_PAGE_SIZE = 100
+JOB_LOG_MAX_LIMIT = 500
+
+def get_job_log_page(job_id, since_id=None, before_id=None, limit=JOB_LOG_PAGE_SIZE):
+    """Return (logs newest first, more) for one page of a job's log.
+    
+    With since_id, the page holds the oldest entries newer than since_id and
+    more means newer entries are left; otherwise it holds the newest entries
+    (older than before_id, if given) and more means older entries are left.
+    Each page is a range scan of the (job_id, id) index.
+    """
+    query = JobLog.query.filter(JobLog.job_id == job_id)
+    
+    if since_id is not None:
+        logs = query.filter(JobLog.id > since_id).order_by(JobLog.id.asc()).limit(limit + 1).all()
+        more = len(logs) > limit
+        return list(reversed(logs[:limit])), more
+    
+    if before_id is not None:
+        query = query.filter(JobLog.id < before_id)
+    logs = query.order_by(JobLog.id.desc()).limit(limit + 1).all()
+    return logs[:limit], len(logs) > limit
+
 @app.route('/job/<int:job_id>/logs')
 @login_required
 def get_job_logs(job_id):
-    """Return job logs as JSON for AJAX updates"""
+    """Return a page of job logs as JSON for AJAX updates.
+    
+    Query parameters: since_id for entries added after the newest one the
+    client has, before_id for older entries, and limit (at most
+    JOB_LOG_MAX_LIMIT).
+    """
     job = ScheduledJob.query.get_or_404(job_id)
     
     # Check if the job belongs to the current user
     if job.user_id != current_user.id:
         return jsonify({'error': 'Permission denied'}), 403
     
-    logs = JobLog.query.filter_by(job_id=job_id).order_by(JobLog.timestamp.desc()).all()
+    since_id = request.args.get('since_id', type=int)
+    before_id = request.args.get('before_id', type=int)
+    limit = request.args.get('limit', JOB_LOG_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, JOB_LOG_MAX_LIMIT))
+    
+    logs, more = get_job_log_page(job_id, since_id=since_id, before_id=before_id, limit=limit)
     logs_data = [
         {
             'id': log.id,
@@ -1474,7 +1631,7 @@ def get_job_logs(job_id):
         for log in logs
     ]
     
-    return jsonify({'logs': logs_data})
+    return jsonify({'logs': logs_data, 'has_more': more})
 
 @app.route('/job/<int:job_id>/control/<action>')
 @login_required
@@ -1488,17 +1645,20 @@ def job_control(job_id, action):
         return redirect(url_for('jobs'))
     
     if action == 'start':
-        # Only scheduled jobs can be started
-        if job.status != 'scheduled':
+        from scheduler import claim_job, notify_job_changed
+        # Only scheduled jobs can be started; the claim moves the job to
+        # running atomically, so the scheduler can't start it at the same time
+        if not claim_job(job_id):
             flash('Only scheduled jobs can be started.', 'danger')
         else:
-            job.status = 'running'
-            job.started_at = datetime.utcnow()
             job.sending_started_at = datetime.utcnow()
             # Add a log entry
             log = JobLog(job_id=job_id, level='info', message='Job started manually.')
             db.session.add(log)
             db.session.commit()
+            
+            # Have the scheduler send it now instead of at its scheduled time
+            notify_job_changed(job_id)
             flash('Job started successfully!', 'success')
             
     elif action == 'pause':
@@ -1511,6 +1671,9 @@ def job_control(job_id, action):
             log = JobLog(job_id=job_id, level='info', message='Job paused by user.')
             db.session.add(log)
             db.session.commit()
+            
+            # The sender stops after its current batch
+            campaign_control.signal(job_id, 'paused')
             flash('Job paused successfully!', 'success')
             
     elif action == 'resume':
@@ -1523,6 +1686,12 @@ def job_control(job_id, action):
             log = JobLog(job_id=job_id, level='info', message='Job resumed by user.')
             db.session.add(log)
             db.session.commit()
+            
+            # Wake the sender if it is still winding down, otherwise schedule
+            # the job to continue from its checkpoint
+            if not campaign_control.signal(job_id, 'running'):
+                from scheduler import notify_job_changed
+                notify_job_changed(job_id)
             flash('Job resumed successfully!', 'success')
             
     elif action == 'stop':
@@ -1536,6 +1705,7 @@ def job_control(job_id, action):
             log = JobLog(job_id=job_id, level='info', message='Job stopped by user.')
             db.session.add(log)
             db.session.commit()
+            campaign_control.signal(job_id, 'completed')
             flash('Job stopped successfully!', 'success')
             
     elif action == 'cancel':
@@ -1548,6 +1718,10 @@ def job_control(job_id, action):
             log = JobLog(job_id=job_id, level='info', message='Job cancelled by user.')
             db.session.add(log)
             db.session.commit()
+            
+            # Drop it from the scheduler's job store
+            from scheduler import notify_job_changed
+            notify_job_changed(job_id)
             flash('Job cancelled successfully!', 'success')
     else:
         flash(f'Invalid action: {action}', 'danger')
@@ -1575,34 +1749,30 @@ def cancel_job(id):
     
     job.status = 'cancelled'
     db.session.commit()
+    campaign_control.signal(id, 'cancelled')
+    
+    from scheduler import notify_job_changed
+    notify_job_changed(id)
     flash('Job cancelled successfully!', 'success')
     return redirect(url_for('jobs'))
 
 # Email Tracking Routes
+# The /track/... routes serve links in emails sent before signed tracking
+# tokens; new emails use /o/<token> and /c/<token> below
 @app.route('/track/open/<int:job_id>/<int:contact_id>/<tracking_id>')
 def track_email_open(job_id, contact_id, tracking_id):
     """Record an email open event"""
     try:
-        # Check if job and contact exist
-        job = ScheduledJob.query.get_or_404(job_id)
-        contact = Contact.query.get_or_404(contact_id)
-        
-        # Record the open
-        email_open = EmailOpen(
-            job_id=job_id,
-            contact_id=contact_id,
-            tracking_id=tracking_id,
+        # Queue the open; the tracking buffer checks the job and contact and
+        # updates job statistics when it writes the event
+        tracking_buffer.record_open(
+            job_id,
+            contact_id,
+            tracking_id,
             ip_address=request.remote_addr,
             user_agent=request.user_agent.string if request.user_agent else None
         )
         
-        db.session.add(email_open)
-        
-        # Update job statistics
-        job.opened_emails = job.opened_emails + 1 if job.opened_emails else 1
-        
-        db.session.commit()
-        
         # Return a transparent 1x1 pixel GIF
         transparent_pixel = base64.b64decode('R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7')
         return Response(transparent_pixel, mimetype='image/gif')
@@ -1621,27 +1791,17 @@ def track_email_click(job_id, contact_id, tracking_id):
         if not original_url:
             return redirect(url_for('index'))
         
-        # Check if job and contact exist
-        job = ScheduledJob.query.get_or_404(job_id)
-        contact = Contact.query.get_or_404(contact_id)
-        
-        # Record the click
-        email_click = EmailClick(
-            job_id=job_id,
-            contact_id=contact_id,
-            tracking_id=tracking_id,
-            url=original_url,
+        # Queue the click; the tracking buffer checks the job and contact and
+        # updates job statistics when it writes the event
+        tracking_buffer.record_click(
+            job_id,
+            contact_id,
+            tracking_id,
+            original_url,
             ip_address=request.remote_addr,
             user_agent=request.user_agent.string if request.user_agent else None
         )
         
-        db.session.add(email_click)
-        
-        # Update job statistics
-        job.clicked_emails = job.clicked_emails + 1 if job.clicked_emails else 1
-        
-        db.session.commit()
-        
         # Redirect to the original URL
         return redirect(original_url)
         
@@ -1649,6 +1809,69 @@ def track_email_click(job_id, contact_id, tracking_id):
         logging.error(f"Error tracking email click: {str(e)}")
         return redirect(url_for('index'))
 
+TRACKING_PIXEL = base64.b64decode('R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7')
+
+@app.route('/o/<token>')
+def track_open(token):
+    """Record an email open identified by a signed tracking token"""
+    try:
+        # The signature proves the ids were issued by us, so no lookup is needed
+        parsed = tracking_tokens.verify_token(tracking_tokens.OPEN, token)
+        if parsed and not parsed.expired:
+            tracking_buffer.record_open(
+                parsed.job_id,
+                parsed.contact_id,
+                token,
+                ip_address=request.remote_addr,
+                user_agent=request.user_agent.string if request.user_agent else None
+            )
+    except Exception as e:
+        logging.error(f"Error tracking email open: {str(e)}")
+    
+    # Always return the transparent 1x1 pixel GIF
+    return Response(TRACKING_PIXEL, mimetype='image/gif')
+
+@app.route('/c/<token>')
+def track_click(token):
+    """Record an email click identified by a signed tracking token and redirect to the original URL"""
+    # A token for a URL outside the job's CampaignLinks is only valid with that URL
+    parsed = tracking_tokens.verify_token(tracking_tokens.CLICK, token, url=request.args.get('url'))
+    
+    # Don't redirect on forged tokens
+    if not parsed:
+        return redirect(url_for('index'))
+    
+    if parsed.link_index == tracking_tokens.NO_LINK:
+        # Personalized links and test sends carry the URL in the query string,
+        # checked against the token's signature above
+        original_url = request.args.get('url')
+        link_id = None
+    else:
+        # Everything else is one of the job's CampaignLinks
+        link = campaign_links.resolve_link(parsed.job_id, parsed.link_index)
+        original_url = link.url if link else None
+        link_id = link.id if link else None
+    
+    if not original_url:
+        return redirect(url_for('index'))
+    
+    if not parsed.expired:
+        try:
+            tracking_buffer.record_click(
+                parsed.job_id,
+                parsed.contact_id,
+                token,
+                None if link_id else original_url,
+                ip_address=request.remote_addr,
+                user_agent=request.user_agent.string if request.user_agent else None,
+                link_id=link_id
+            )
+        except Exception as e:
+            logging.error(f"Error tracking email click: {str(e)}")
+    
+    # Links in old emails keep working even once they are no longer recorded
+    return redirect(original_url)
+
 @app.route('/monitoring')
 @login_required
 def monitoring():
@@ -1675,8 +1898,11 @@ def monitoring():
         except ValueError:
             to_date = datetime.utcnow()
     
-    # Get all jobs for the current user within date range
-    jobs = ScheduledJob.query.filter(
+    # Get all jobs for the current user within date range, with the template
+    # and segment names shown in the jobs table
+    jobs = ScheduledJob.query.options(
+        joinedload(ScheduledJob.template), joinedload(ScheduledJob.segment)
+    ).filter(
         ScheduledJob.user_id == current_user.id
     ).filter(
         ScheduledJob.scheduled_time >= from_date
@@ -1684,13 +1910,23 @@ def monitoring():
         ScheduledJob.scheduled_time <= to_date
     ).order_by(ScheduledJob.scheduled_time.desc()).all()
     
-    # Get all jobs for time-series data (last 90 days)
+    # Daily totals for the time series (last 90 days) and the filtered period,
+    # read from the rollup with one range scan
     time_series_start = datetime.utcnow() - timedelta(days=90)
-    all_recent_jobs = ScheduledJob.query.filter(
-        ScheduledJob.user_id == current_user.id
+    daily_stats = db.session.query(
+        CampaignDailyStats.day,
+        db.func.sum(CampaignDailyStats.total).label('total'),
+        db.func.sum(CampaignDailyStats.sent).label('sent'),
+        db.func.sum(CampaignDailyStats.failed).label('failed'),
+        db.func.sum(CampaignDailyStats.opened).label('opened'),
+        db.func.sum(CampaignDailyStats.clicked).label('clicked')
+    ).filter(
+        CampaignDailyStats.user_id == current_user.id
     ).filter(
-        ScheduledJob.scheduled_time >= time_series_start
-    ).order_by(ScheduledJob.scheduled_time.asc()).all()
+        CampaignDailyStats.day >= min(from_date, time_series_start).date()
+    ).filter(
+        CampaignDailyStats.day <= max(to_date, datetime.utcnow()).date()
+    ).group_by(CampaignDailyStats.day).all()
     
     # Prepare time-series data (daily stats for the last 90 days)
     time_series_data = {}
@@ -1705,153 +1941,39 @@ def monitoring():
             'total': 0
         }
     
-    # Fill time series data from jobs
-    for job in all_recent_jobs:
-        day = job.scheduled_time.strftime('%Y-%m-%d')
+    # Fill time series data and the filtered period's totals from the rollup
+    total_emails = sent_emails = failed_emails = opened_emails = clicked_emails = 0
+    for stats in daily_stats:
+        day = stats.day.strftime('%Y-%m-%d')
         if day in time_series_data:
-            time_series_data[day]['sent'] += job.sent_emails
-            time_series_data[day]['opened'] += job.opened_emails
-            time_series_data[day]['clicked'] += job.clicked_emails
-            time_series_data[day]['failed'] += job.failed_emails
-            time_series_data[day]['total'] += job.total_emails
+            time_series_data[day]['sent'] += stats.sent
+            time_series_data[day]['opened'] += stats.opened
+            time_series_data[day]['clicked'] += stats.clicked
+            time_series_data[day]['failed'] += stats.failed
+            time_series_data[day]['total'] += stats.total
+        
+        if from_date.date() <= stats.day <= to_date.date():
+            total_emails += stats.total
+            sent_emails += stats.sent
+            failed_emails += stats.failed
+            opened_emails += stats.opened
+            clicked_emails += stats.clicked
     
     # Convert to list and order by date
     time_series_list = list(time_series_data.values())
     time_series_list.sort(key=lambda x: x['date'])
     
-    # Calculate statistics for filtered period
-    total_emails = sum(job.total_emails for job in jobs)
-    sent_emails = sum(job.sent_emails for job in jobs)
-    failed_emails = sum(job.failed_emails for job in jobs)
-    opened_emails = sum(job.opened_emails for job in jobs)
-    clicked_emails = sum(job.clicked_emails for job in jobs)
-    
-    # Calculate engagement metrics
+    # Calculate engagement metrics from unique opens/clicks, so repeat opens
+    # and mail client prefetches don't inflate the rates
     open_rate = (opened_emails / sent_emails * 100) if sent_emails > 0 else 0
     click_rate = (clicked_emails / opened_emails * 100) if opened_emails > 0 else 0
     click_to_open_rate = (clicked_emails / opened_emails * 100) if opened_emails > 0 else 0
     bounce_rate = (failed_emails / total_emails * 100) if total_emails > 0 else 0
     
-    # Group jobs by status for chart
-    status_counts = {
-        'scheduled': ScheduledJob.query.filter(
-            ScheduledJob.user_id == current_user.id
-        ).filter(
-            ScheduledJob.status == 'scheduled'
-        ).filter(
-            ScheduledJob.scheduled_time >= from_date
-        ).filter(
-            ScheduledJob.scheduled_time <= to_date
-        ).count(),
-        'running': ScheduledJob.query.filter(
-            ScheduledJob.user_id == current_user.id
-        ).filter(
-            ScheduledJob.status == 'running'
-        ).filter(
-            ScheduledJob.scheduled_time >= from_date
-        ).filter(
-            ScheduledJob.scheduled_time <= to_date
-        ).count(),
-        'completed': ScheduledJob.query.filter(
-            ScheduledJob.user_id == current_user.id
-        ).filter(
-            ScheduledJob.status == 'completed'
-        ).filter(
-            ScheduledJob.scheduled_time >= from_date
-        ).filter(
-            ScheduledJob.scheduled_time <= to_date
-        ).count(),
-        'failed': ScheduledJob.query.filter(
-            ScheduledJob.user_id == current_user.id
-        ).filter(
-            ScheduledJob.status == 'failed'
-        ).filter(
-            ScheduledJob.scheduled_time >= from_date
-        ).filter(
-            ScheduledJob.scheduled_time <= to_date
-        ).count(),
-        'cancelled': ScheduledJob.query.filter(
-            ScheduledJob.user_id == current_user.id
-        ).filter(
-            ScheduledJob.status == 'cancelled'
-        ).filter(
-            ScheduledJob.scheduled_time >= from_date
-        ).filter(
-            ScheduledJob.scheduled_time <= to_date
-        ).count()
-    }
-    
-    # Get segment performance data
-    segment_performance = {}
-    for job in jobs:
-        segment_id = job.segment_id
-        segment_name = job.segment.name
-        
-        if segment_id not in segment_performance:
-            segment_performance[segment_id] = {
-                'segment_name': segment_name,
-                'total': 0,
-                'sent': 0,
-                'opened': 0,
-                'clicked': 0,
-                'failed': 0
-            }
-        
-        segment_performance[segment_id]['total'] += job.total_emails
-        segment_performance[segment_id]['sent'] += job.sent_emails
-        segment_performance[segment_id]['opened'] += job.opened_emails
-        segment_performance[segment_id]['clicked'] += job.clicked_emails
-        segment_performance[segment_id]['failed'] += job.failed_emails
-    
-    # Calculate rates for each segment
-    for segment_id in segment_performance:
-        data = segment_performance[segment_id]
-        data['open_rate'] = (data['opened'] / data['sent'] * 100) if data['sent'] > 0 else 0
-        data['click_rate'] = (data['clicked'] / data['opened'] * 100) if data['opened'] > 0 else 0
-        data['bounce_rate'] = (data['failed'] / data['total'] * 100) if data['total'] > 0 else 0
-    
-    # Sort segments by open rate (descending)
-    top_segments = sorted(
-        segment_performance.values(), 
-        key=lambda x: x['open_rate'], 
-        reverse=True
-    )
-    
-    # Get template performance data
-    template_performance = {}
-    for job in jobs:
-        template_id = job.template_id
-        template_name = job.template.name
-        
-        if template_id not in template_performance:
-            template_performance[template_id] = {
-                'template_name': template_name,
-                'total': 0,
-                'sent': 0,
-                'opened': 0,
-                'clicked': 0,
-                'failed': 0
-            }
-        
-        template_performance[template_id]['total'] += job.total_emails
-        template_performance[template_id]['sent'] += job.sent_emails
-        template_performance[template_id]['opened'] += job.opened_emails
-        template_performance[template_id]['clicked'] += job.clicked_emails
-        template_performance[template_id]['failed'] += job.failed_emails
-    
-    # Calculate rates for each template
-    for template_id in template_performance:
-        data = template_performance[template_id]
-        data['open_rate'] = (data['opened'] / data['sent'] * 100) if data['sent'] > 0 else 0
-        data['click_rate'] = (data['clicked'] / data['opened'] * 100) if data['opened'] > 0 else 0
-        data['bounce_rate'] = (data['failed'] / data['total'] * 100) if data['total'] > 0 else 0
-    
-    # Sort templates by click rate (descending)
-    top_templates = sorted(
-        template_performance.values(), 
-        key=lambda x: x['click_rate'], 
-        reverse=True
-    )
+    # Status counts and segment/template performance, one GROUP BY query each
+    status_counts = analytics.get_status_counts(current_user.id, from_date, to_date)
+    top_segments = analytics.get_segment_performance(current_user.id, from_date, to_date)
+    top_templates = analytics.get_template_performance(current_user.id, from_date, to_date)
     
     return render_template('monitoring.html', 
                           title='Advanced Analytics Dashboard',
@@ -1,60 +1,164 @@
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.executors.pool import ThreadPoolExecutor
 from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from apscheduler.jobstores.base import JobLookupError
 from datetime import datetime, timedelta
 import random
-from models import ScheduledJob, JobLog
+import select
+import sqlalchemy as sa
+from models import ScheduledJob, JobLog, SendWorkItem
 from email_service import send_campaign_emails
+from scheduler_lock import SchedulerLock
+import send_queue
 from app import db
 import logging
+import threading
 
 scheduler = None
 
+# The app scheduled email jobs run under; jobs in the database job store only
+# carry the job id, since the app itself can't be pickled
+_app = None
+
+# A running job with no heartbeat for this long is assumed to have lost its
+# worker (the heartbeat is committed after every batch)
+STALE_JOB_MINUTES = 10
+
+# How often running jobs are checked for a lost worker
+RECOVERY_INTERVAL_MINUTES = 1
+
+# Jobs currently executing in this process, mapped to an event set when they finish
+_active_jobs = {}
+_active_jobs_lock = threading.Lock()
+
+# How long a resumed job waits for its previous run in this process to wind down
+RESUME_WAIT_SECONDS = 60
+
+# PostgreSQL channel used to tell the schedulers in other processes that a
+# job changed. The payload is the job id for schedulers to pick up, or empty
+# when the sender already updated the shared job store.
+NOTIFY_CHANNEL = 'scheduled_job_changed'
+
+# Without LISTEN/NOTIFY (SQLite), how often the scheduler rereads the shared
+# job store for jobs added by other processes
+STORE_POLL_SECONDS = 5
+
+# How long the listener waits on its connection before checking for shutdown
+LISTEN_TIMEOUT_SECONDS = 5
+
+# How often a standby process tries to take over the scheduler, and the
+# leader checks it still holds the lock
+LEADER_CHECK_SECONDS = 10
+
+# Only the process holding this lock runs jobs (see scheduler_lock.py)
+_leader_lock = None
+
+# Set to stop the current scheduler's background threads
+_stop = threading.Event()
+
 def init_scheduler(app):
     """Initialize the scheduler with the Flask app context"""
-    global scheduler
+    global scheduler, _app, _leader_lock, _stop
     
     if scheduler:
+        _stop.set()
         scheduler.shutdown()
+        _leader_lock.release()
+    
+    _app = app
+    _stop = threading.Event()
     
-    # Configure job stores and executors
+    # Email jobs live in the app's database so they survive restarts and are
+    # shared by every process; housekeeping jobs are per process
+    with app.app_context():
+        engine = db.engine
     jobstores = {
-        'default': MemoryJobStore()
+        'default': SQLAlchemyJobStore(engine=engine),
+        'local': MemoryJobStore()
     }
     executors = {
         'default': ThreadPoolExecutor(10)
     }
     job_defaults = {
         'coalesce': False,
-        'max_instances': 3
+        'max_instances': 3,
+        # Run jobs that came due while no scheduler was up, however late
+        'misfire_grace_time': None
     }
     
     # Create scheduler
     scheduler = BackgroundScheduler(jobstores=jobstores, executors=executors, job_defaults=job_defaults)
     
-    # Start the scheduler
-    scheduler.start()
-    
-    # Load existing jobs from database
-    with app.app_context():
-        load_jobs_from_db(app)
+    # Every process starts its scheduler paused, which is enough to add jobs
+    # to the shared store; only the leader resumes it and runs them
+    scheduler.start(paused=True)
+    _leader_lock = SchedulerLock(engine)
     
-    # Add a job to check for new scheduled jobs every minute
+    # Check for jobs whose worker went away
     scheduler.add_job(
-        check_for_new_jobs,
+        recover_interrupted_jobs,
         'interval',
         args=[app],
-        minutes=1,
-        id='job_checker',
+        minutes=RECOVERY_INTERVAL_MINUTES,
+        id='job_recovery',
+        jobstore='local',
         replace_existing=True
     )
     
+    # New and changed jobs are pushed through notify_job_changed; other
+    # processes hear about them via LISTEN/NOTIFY on PostgreSQL, and by
+    # rereading the job store (not the jobs table) elsewhere
+    if engine.dialect.name == 'postgresql':
+        threading.Thread(target=_listen, args=[engine, _stop], name='scheduler-listener', daemon=True).start()
+    else:
+        scheduler.add_job(
+            _wake,
+            'interval',
+            seconds=STORE_POLL_SECONDS,
+            id='job_store_poll',
+            jobstore='local',
+            replace_existing=True
+        )
+    
+    if _leader_lock.acquire():
+        _become_leader(app)
+    else:
+        logging.info("Another process is running the scheduler; this one is on standby")
+    threading.Thread(
+        target=_watch_leadership, args=[app, scheduler, _leader_lock, _stop], name='scheduler-leader', daemon=True
+    ).start()
+    
     logging.info("Scheduler initialized")
     
     return scheduler
 
+def _become_leader(app):
+    """Start running jobs in this process's scheduler"""
+    # Load jobs created while no scheduler was running and resume any that were interrupted
+    with app.app_context():
+        load_jobs_from_db(app)
+        recover_interrupted_jobs(app)
+    
+    scheduler.resume()
+    logging.info("This process is now running the scheduler")
+
+def _watch_leadership(app, own_scheduler, lock, stop):
+    """Take over when the leader goes away, and stand down if the lock is lost"""
+    while not stop.wait(LEADER_CHECK_SECONDS):
+        if lock.held:
+            if not lock.check():
+                logging.warning("Lost the scheduler lock; pausing this process's scheduler")
+                own_scheduler.pause()
+        elif lock.acquire():
+            _become_leader(app)
+
+def is_leader():
+    """Return whether this process runs the scheduler's jobs"""
+    return _leader_lock is not None and _leader_lock.held
+
 def load_jobs_from_db(app):
-    """Load existing jobs from database that are scheduled but not yet run"""
+    """Add scheduled jobs that are not in the job store yet, e.g. ones created while no scheduler was running"""
     with app.app_context():
         try:
             # Get jobs that are scheduled to run in the future
@@ -65,35 +169,141 @@ def load_jobs_from_db(app):
             ).all()
             
             for job in scheduled_jobs:
-                add_job_to_scheduler(app, job)
+                if not scheduler.get_job(f'email_job_{job.id}'):
+                    add_job_to_scheduler(app, job)
         except Exception as e:
             # Database tables may not exist yet during initialization
             logging.info(f"Could not load jobs from database: {e}")
             pass
 
-def check_for_new_jobs(app):
-    """Check for newly added jobs in the database"""
+def recover_interrupted_jobs(app):
+    """Resume jobs left in the running state by a worker that went away"""
     with app.app_context():
         try:
-            # Get jobs that are scheduled to run in the future and not in the scheduler
-            current_time = datetime.utcnow()
-            scheduled_jobs = ScheduledJob.query.filter(
-                ScheduledJob.status == 'scheduled',
-                ScheduledJob.scheduled_time > current_time
-            ).all()
+            stale_before = datetime.utcnow() - timedelta(minutes=STALE_JOB_MINUTES)
+            # Jobs that were running before heartbeat_at existed fall back to updated_at
+            query = ScheduledJob.query.filter(
+                ScheduledJob.status == 'running',
+                sa.func.coalesce(ScheduledJob.heartbeat_at, ScheduledJob.updated_at) < stale_before
+            )
+            if app.config.get('USE_SEND_WORKERS'):
+                # Once a job is queued, workers send it and reclaim each other's
+                # items after send_queue.CLAIM_TIMEOUT_MINUTES; only jobs lost
+                # before they were queued need resuming
+                query = query.filter(~sa.exists().where(SendWorkItem.job_id == ScheduledJob.id))
+            interrupted_jobs = query.all()
             
-            for job in scheduled_jobs:
-                # Check if this job is already in the scheduler
-                try:
-                    if not scheduler.get_job(f'email_job_{job.id}'):
-                        add_job_to_scheduler(app, job)
-                except:
-                    # If job doesn't exist, add it
-                    add_job_to_scheduler(app, job)
+            for job in interrupted_jobs:
+                with _active_jobs_lock:
+                    if job.id in _active_jobs:
+                        continue
+                
+                log_entry = JobLog(job_id=job.id, message="Job was interrupted, resuming from last checkpoint", level='warning')
+                db.session.add(log_entry)
+                db.session.commit()
+                
+                resume_job(app, job.id)
         except Exception as e:
             # Database tables may not exist yet during initialization
-            logging.debug(f"Could not check for new jobs: {e}")
-            pass
+            logging.info(f"Could not recover interrupted jobs: {e}")
+
+def resume_job(app, job_id):
+    """Schedule a running job to continue from its checkpoint right away"""
+    scheduler.add_job(
+        run_email_job,
+        'date',
+        args=[job_id],
+        kwargs={'resume': True},
+        run_date=datetime.now(),
+        id=f'email_job_{job_id}',
+        replace_existing=True
+    )
+    logging.info(f"Resuming job {job_id} from its checkpoint")
+
+def notify_job_changed(job_id):
+    """Tell the scheduler a job was created or its status changed.
+    
+    Call after committing the change. Scheduled jobs are added to the job
+    store, running jobs (started or resumed by the user) continue from their
+    checkpoint right away and any other job is dropped from the store. When
+    this process has no scheduler, the job id is handed to the schedulers in
+    other processes instead.
+    """
+    if scheduler is not None and scheduler.running:
+        sync_job(job_id)
+        _publish('')
+    else:
+        _publish(str(job_id))
+
+def sync_job(job_id):
+    """Bring the job store in line with a job's current status"""
+    with _app.app_context():
+        job = ScheduledJob.query.get(job_id)
+        if job is not None and job.status == 'scheduled':
+            add_job_to_scheduler(_app, job)
+        elif job is not None and job.status == 'running':
+            resume_job(_app, job_id)
+        else:
+            try:
+                scheduler.remove_job(f'email_job_{job_id}')
+            except JobLookupError:
+                pass
+
+def _publish(payload):
+    """NOTIFY the schedulers in other processes; a no-op without PostgreSQL"""
+    with _app.app_context():
+        engine = db.engine
+    if engine.dialect.name != 'postgresql':
+        return
+    
+    try:
+        with engine.begin() as connection:
+            connection.execute(sa.text("SELECT pg_notify(:channel, :payload)"),
+                               {'channel': NOTIFY_CHANNEL, 'payload': payload})
+    except Exception as e:
+        logging.warning(f"Could not notify schedulers: {e}")
+
+def _wake():
+    """Make the scheduler reread the job store"""
+    if scheduler is not None:
+        scheduler.wakeup()
+
+def _listen(engine, stop):
+    """LISTEN for job changes made in other processes until the scheduler is replaced"""
+    while not stop.is_set():
+        connection = None
+        try:
+            # A dedicated connection, kept out of the pool since it's in autocommit mode
+            connection = engine.raw_connection()
+            connection.detach()
+            dbapi_connection = connection.driver_connection
+            dbapi_connection.autocommit = True
+            dbapi_connection.cursor().execute(f"LISTEN {NOTIFY_CHANNEL}")
+            
+            # Pick up anything missed while the listener was down
+            _wake()
+            
+            while not stop.is_set():
+                if not select.select([dbapi_connection], [], [], LISTEN_TIMEOUT_SECONDS)[0]:
+                    continue
+                dbapi_connection.poll()
+                while dbapi_connection.notifies:
+                    notification = dbapi_connection.notifies.pop(0)
+                    if notification.payload:
+                        # Every process hears this; only the leader adds the job
+                        if is_leader():
+                            sync_job(int(notification.payload))
+                    else:
+                        _wake()
+        except Exception as e:
+            logging.warning(f"Scheduler listener lost its connection: {e}")
+            stop.wait(LISTEN_TIMEOUT_SECONDS)
+        finally:
+            if connection is not None:
+                try:
+                    connection.close()
+                except Exception:
+                    pass
 
 def add_job_to_scheduler(app, db_job):
     """Add a job to the scheduler"""
@@ -129,7 +339,7 @@ def add_job_to_scheduler(app, db_job):
     scheduler.add_job(
         run_email_job,
         'date',
-        args=[app, db_job.id],
+        args=[db_job.id],
         run_date=run_date,
         id=job_id,
         replace_existing=True
@@ -199,32 +409,84 @@ def calculate_optimal_send_time(job):
     
     return adjusted_time
 
-def run_email_job(app, job_id):
-    """Execute the email job"""
+def run_email_job(job_id, resume=False):
+    """Execute the email job, or resume an interrupted one from its checkpoint"""
+    while True:
+        with _active_jobs_lock:
+            previous_run = _active_jobs.get(job_id)
+            if previous_run is None:
+                finished = _active_jobs[job_id] = threading.Event()
+                break
+        
+        # A job resumed right after a pause may still be finishing its last batch
+        if not resume or not previous_run.wait(RESUME_WAIT_SECONDS):
+            logging.warning(f"Job {job_id} is already executing in this process")
+            return
+    
+    try:
+        _run_email_job(_app, job_id, resume)
+    finally:
+        with _active_jobs_lock:
+            del _active_jobs[job_id]
+        finished.set()
+
+def claim_job(job_id):
+    """Atomically move a job from scheduled to running.
+    
+    Returns:
+        bool: True if this call claimed the job, False if it was not (or no
+        longer) scheduled
+    """
+    result = db.session.execute(
+        sa.update(ScheduledJob)
+        .where(ScheduledJob.id == job_id, ScheduledJob.status == 'scheduled')
+        .values(status='running', heartbeat_at=datetime.utcnow(),
+                started_at=sa.func.coalesce(ScheduledJob.started_at, datetime.utcnow()))
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return result.rowcount == 1
+
+def _run_email_job(app, job_id, resume):
     with app.app_context():
+        # Claim a scheduled job by moving it to running in one statement, so
+        # of two runs racing for it exactly one goes ahead
+        if not resume and not claim_job(job_id):
+            logging.warning(f"Job {job_id} not found or not in scheduled state")
+            return
+        
         job = ScheduledJob.query.get(job_id)
         
-        if not job or job.status != 'scheduled':
-            logging.warning(f"Job {job_id} not found or not in scheduled state")
+        if not job or job.status != 'running':
+            logging.warning(f"Job {job_id} not found or not in running state")
             return
         
-        # Update job status to running
-        job.status = 'running'
-        log_entry = JobLog(job_id=job.id, message=f"Job started execution", level='info')
-        db.session.add(log_entry)
-        db.session.commit()
+        if not resume:
+            log_entry = JobLog(job_id=job.id, message=f"Job started execution", level='info')
+            db.session.add(log_entry)
+            db.session.commit()
         
         try:
+            if app.config.get('USE_SEND_WORKERS'):
+                # Send workers (worker.py) send the job and complete it
+                send_queue.enqueue_job(job)
+                return
+            
             # Send the emails
             success, total, sent, failed = send_campaign_emails(app, job)
             
-            # Update job statistics
-            job.sent_emails = sent
-            job.failed_emails = failed
+            # Pick up a pause or stop made through job_control while sending;
+            # sent/failed counters were already incremented batch by batch
+            db.session.refresh(job)
             
             # Update job status
-            if success:
+            if job.status != 'running':
+                # Paused, stopped or cancelled by the user; leave the status alone
+                log_message = f"Job {job.status} by user. Sent: {sent}, Failed: {failed}"
+                log_level = 'info'
+            elif success:
                 job.status = 'completed'
+                job.completed_at = datetime.utcnow()
                 log_message = f"Job completed successfully. Sent: {sent}, Failed: {failed}"
                 log_level = 'info'
             else:
@@ -0,0 +1,120 @@
+"""Leader election for the campaign scheduler.
+
+Every app process builds a scheduler, but only the one holding this lock
+runs jobs. The others keep theirs paused, so they can still add jobs to the
+shared job store, and keep trying to take the lock over.
+
+On PostgreSQL the lock is a session-level advisory lock held by a dedicated
+connection, so it's released as soon as the leader's process or connection
+dies. Other databases (SQLite in development) use an exclusive flock on a
+file next to the database, which the OS releases with the process.
+"""
+import fcntl
+import logging
+import os
+import tempfile
+
+# Advisory lock key shared by every process using the same database
+ADVISORY_LOCK_KEY = 0x656D6C73
+
+
+class SchedulerLock:
+    """A non-blocking, process-wide lock on running the scheduler"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._connection = None
+        self._file = None
+
+    @property
+    def held(self):
+        return self._connection is not None or self._file is not None
+
+    def acquire(self):
+        """Try to take the lock without waiting.
+
+        Returns:
+            bool: True if this process holds the lock
+        """
+        if self.held:
+            return self.check()
+
+        try:
+            if self.engine.dialect.name == 'postgresql':
+                return self._acquire_advisory_lock()
+            return self._acquire_file_lock()
+        except Exception as e:
+            logging.warning(f"Could not acquire the scheduler lock: {e}")
+            return False
+
+    def check(self):
+        """Return whether the lock is still held, dropping it if its connection died"""
+        if self._connection is None:
+            return self._file is not None
+
+        try:
+            cursor = self._connection.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            cursor.close()
+            return True
+        except Exception as e:
+            logging.warning(f"Scheduler lock connection failed: {e}")
+            self.release()
+            return False
+
+    def release(self):
+        """Give up the lock"""
+        if self._connection is not None:
+            try:
+                # Closing the session releases the advisory lock
+                self._connection.close()
+            except Exception:
+                pass
+            self._connection = None
+
+        if self._file is not None:
+            try:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+            finally:
+                self._file.close()
+                self._file = None
+
+    def _acquire_advisory_lock(self):
+        # A dedicated connection, kept out of the pool since the lock lives
+        # as long as its session
+        connection = self.engine.raw_connection()
+        connection.detach()
+        try:
+            connection.driver_connection.autocommit = True
+            cursor = connection.cursor()
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", (ADVISORY_LOCK_KEY,))
+            acquired = cursor.fetchone()[0]
+            cursor.close()
+        except Exception:
+            connection.close()
+            raise
+
+        if not acquired:
+            connection.close()
+            return False
+
+        self._connection = connection
+        return True
+
+    def _acquire_file_lock(self):
+        lock_file = open(self._lock_path(), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+
+        self._file = lock_file
+        return True
+
+    def _lock_path(self):
+        database = self.engine.url.database
+        if database and database != ':memory:':
+            return f"{database}.scheduler.lock"
+        return os.path.join(tempfile.gettempdir(), 'email_scheduler.lock')
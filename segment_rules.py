@@ -0,0 +1,411 @@
+"""Rule-based dynamic segments.
+
+A dynamic segment has no hand-picked contacts: its rules pick the owner's
+contacts by their fields and engagement history, e.g.
+
+    {"match": "all", "rules": [
+        {"type": "opened", "within_days": 30},
+        {"type": "domain_in", "domains": ["example.com", "example.org"]},
+        {"type": "clicked", "job_id": 12, "url": "https://example.com/offer", "negate": true}
+    ]}
+
+Rules compile to one WHERE clause over the contact table, with an EXISTS
+subquery per engagement rule, so the sender streams a dynamic segment with
+the same keyset queries as a static one and no contacts are matched in
+Python. The rule types are:
+
+- field: "field" email or name, "op" equals, contains, starts_with or
+  ends_with (case-insensitive), and "value"
+- domain_in: the address's domain is one of "domains"
+- opened: opened job "job_id", or any job, within the last "within_days"
+  days, or ever; both are optional
+- never_opened: the same as a negated opened rule
+- clicked: like opened, optionally only clicks on "url"
+- in_segment: in static or materialized segment "segment_id"
+- a group: "match" all or any of its "rules"
+
+Any rule takes "negate": true.
+
+Engagement rules over a large segment are expensive joins, so a segment can
+be materialized: its matching contacts are written to segment_membership and
+read from there like a static segment's until the materialization is
+refresh_ttl_minutes old. Sends refresh a stale materialization when they
+start, so repeated sends within the TTL don't evaluate the rules again.
+
+A running or paused job reads its segment's contacts as it goes, so while
+one is partway through a segment, or through a live segment whose rules
+read it, the segment's rules can't change and it isn't refreshed.
+"""
+import json
+import re
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, or_, not_, exists, func, literal, select
+
+from app import db
+from models import (EmailSegment, Contact, SegmentMembership, ScheduledJob, CampaignLink,
+                    EmailOpen, EmailClick, EmailUniqueOpen, EmailUniqueClick, normalize_email)
+from sql_helpers import insert_ignore
+
+# Rules and groups allowed in one segment
+MAX_RULES = 50
+
+# Groups nested in groups
+MAX_DEPTH = 4
+
+# Domains in one domain_in rule
+MAX_DOMAINS = 100
+
+# Age at which a materialized segment is refreshed if it has no TTL of its own
+DEFAULT_REFRESH_TTL_MINUTES = 60
+
+# Statuses of jobs partway through sending their segment
+ACTIVE_JOB_STATUSES = ('running', 'paused')
+
+RULE_TYPES = ('field', 'domain_in', 'opened', 'never_opened', 'clicked', 'in_segment')
+FIELDS = ('email', 'name')
+OPS = ('equals', 'contains', 'starts_with', 'ends_with')
+
+_DOMAIN = re.compile(r'^[a-z0-9-]+(\.[a-z0-9-]+)+$')
+
+
+class SegmentRuleError(ValueError):
+    """Rules that can't be compiled, with a message for the segment's owner"""
+
+
+def parse_rules(text):
+    """Parse rules as entered in the segment form.
+
+    A bare list of rules means all of them must match.
+
+    Returns:
+        dict: the top-level group
+
+    Raises:
+        SegmentRuleError
+    """
+    try:
+        rules = json.loads(text)
+    except ValueError as e:
+        raise SegmentRuleError(f"Rules are not valid JSON: {e}")
+
+    if isinstance(rules, list):
+        rules = {'match': 'all', 'rules': rules}
+    if not isinstance(rules, dict) or 'rules' not in rules:
+        raise SegmentRuleError('Rules must be a list or a group with "match" and "rules"')
+    return rules
+
+
+def compile_rules(rules, user_id, segment_id=None):
+    """Compile rules to a condition on Contact.
+
+    Args:
+        rules: top-level rule group
+        user_id: owner of the segment; jobs and segments in rules must be theirs
+        segment_id: the segment the rules are for, which they can't refer to
+
+    Returns:
+        ColumnElement: the condition, without the owner filter
+
+    Raises:
+        SegmentRuleError
+    """
+    return _Compiler(user_id, segment_id).compile(rules)
+
+
+class _Compiler:
+    def __init__(self, user_id, segment_id):
+        self.user_id = user_id
+        self.segment_id = segment_id
+        self.count = 0
+        self.now = datetime.utcnow()
+
+    def compile(self, rule, depth=0):
+        if not isinstance(rule, dict):
+            raise SegmentRuleError("Each rule must be an object")
+
+        self.count += 1
+        if self.count > MAX_RULES:
+            raise SegmentRuleError(f"A segment can have at most {MAX_RULES} rules")
+
+        if 'rules' in rule:
+            condition = self._group(rule, depth)
+        else:
+            rule_type = rule.get('type')
+            if rule_type not in RULE_TYPES:
+                raise SegmentRuleError(f"Unknown rule type: {rule_type!r}")
+            condition = getattr(self, '_' + rule_type)(rule)
+
+        return not_(condition) if rule.get('negate') else condition
+
+    def _group(self, rule, depth):
+        if depth >= MAX_DEPTH:
+            raise SegmentRuleError(f"Rule groups can be nested at most {MAX_DEPTH} deep")
+
+        match = rule.get('match', 'all')
+        if match not in ('all', 'any'):
+            raise SegmentRuleError(f"A group must match \"all\" or \"any\", not {match!r}")
+
+        rules = rule['rules']
+        if not isinstance(rules, list) or not rules:
+            raise SegmentRuleError("A rule group needs a non-empty list of rules")
+
+        conditions = [self.compile(child, depth + 1) for child in rules]
+        return and_(*conditions) if match == 'all' else or_(*conditions)
+
+    def _field(self, rule):
+        field = rule.get('field')
+        op = rule.get('op', 'equals')
+        value = rule.get('value')
+        if field not in FIELDS:
+            raise SegmentRuleError(f"field must be one of {', '.join(FIELDS)}, not {field!r}")
+        if op not in OPS:
+            raise SegmentRuleError(f"op must be one of {', '.join(OPS)}, not {op!r}")
+        if not isinstance(value, str) or not value.strip():
+            raise SegmentRuleError(f"A {field} rule needs a value")
+
+        if field == 'email':
+            column, value = Contact.email_normalized, normalize_email(value)
+        else:
+            # Contacts without a name compare as an empty one, so negated rules include them
+            column, value = func.lower(func.coalesce(Contact.name, '')), value.strip().lower()
+
+        if op == 'equals':
+            return column == value
+        if op == 'contains':
+            return column.contains(value, autoescape=True)
+        if op == 'starts_with':
+            return column.startswith(value, autoescape=True)
+        return column.endswith(value, autoescape=True)
+
+    def _domain_in(self, rule):
+        domains = rule.get('domains')
+        if not isinstance(domains, list) or not domains:
+            raise SegmentRuleError("A domain_in rule needs a list of domains")
+        if len(domains) > MAX_DOMAINS:
+            raise SegmentRuleError(f"A domain_in rule can have at most {MAX_DOMAINS} domains")
+
+        normalized = set()
+        for domain in domains:
+            value = normalize_email(domain).lstrip('@') if isinstance(domain, str) else None
+            if not value or not _DOMAIN.match(value):
+                raise SegmentRuleError(f"Invalid domain: {domain!r}")
+            normalized.add(value)
+
+        return or_(*[Contact.email_normalized.endswith('@' + domain) for domain in sorted(normalized)])
+
+    def _opened(self, rule):
+        job_id = self._job_id(rule)
+        since = self._since(rule)
+
+        if job_id is not None and since is None:
+            # One primary key lookup in the first opens
+            return exists().where(EmailUniqueOpen.job_id == job_id, EmailUniqueOpen.contact_id == Contact.id)
+
+        conditions = [EmailOpen.contact_id == Contact.id]
+        if job_id is not None:
+            conditions.append(EmailOpen.job_id == job_id)
+        if since is not None:
+            conditions.append(EmailOpen.timestamp >= since)
+        return exists().where(*conditions)
+
+    def _never_opened(self, rule):
+        return not_(self._opened(rule))
+
+    def _clicked(self, rule):
+        job_id = self._job_id(rule)
+        since = self._since(rule)
+        url = rule.get('url')
+        if url is not None and (not isinstance(url, str) or not url.strip()):
+            raise SegmentRuleError("A clicked rule's url must be a non-empty string")
+
+        if job_id is not None and since is None and url is None:
+            return exists().where(EmailUniqueClick.job_id == job_id, EmailUniqueClick.contact_id == Contact.id)
+
+        conditions = [EmailClick.contact_id == Contact.id]
+        if job_id is not None:
+            conditions.append(EmailClick.job_id == job_id)
+        if since is not None:
+            conditions.append(EmailClick.timestamp >= since)
+        if url is not None:
+            # Clicks on a job's CampaignLinks only store the link's id
+            links = select(CampaignLink.id).where(CampaignLink.url == url.strip())
+            if job_id is not None:
+                links = links.where(CampaignLink.job_id == job_id)
+            conditions.append(or_(EmailClick.link_id.in_(links), EmailClick.url == url.strip()))
+        return exists().where(*conditions)
+
+    def _in_segment(self, rule):
+        segment_id = self._id(rule, 'segment_id')
+        if segment_id is None:
+            raise SegmentRuleError("An in_segment rule needs a segment_id")
+        if segment_id == self.segment_id:
+            raise SegmentRuleError("A segment's rules can't refer to the segment itself")
+
+        segment = db.session.get(EmailSegment, segment_id)
+        if segment is None or segment.user_id != self.user_id:
+            raise SegmentRuleError(f"Segment {segment_id} not found")
+        if segment.is_live:
+            raise SegmentRuleError(f"Segment {segment.name!r} is dynamic and not materialized, so rules can't refer to it")
+
+        return exists().where(SegmentMembership.segment_id == segment_id, SegmentMembership.contact_id == Contact.id)
+
+    def _job_id(self, rule):
+        job_id = self._id(rule, 'job_id')
+        if job_id is not None and not db.session.query(ScheduledJob.id).filter(
+            ScheduledJob.id == job_id,
+            ScheduledJob.user_id == self.user_id
+        ).first():
+            raise SegmentRuleError(f"Job {job_id} not found")
+        return job_id
+
+    def _since(self, rule):
+        days = rule.get('within_days')
+        if days is None:
+            return None
+        if not isinstance(days, int) or isinstance(days, bool) or days < 1:
+            raise SegmentRuleError("within_days must be a whole number of days")
+        return self.now - timedelta(days=days)
+
+    def _id(self, rule, key):
+        value = rule.get(key)
+        if value is not None and (not isinstance(value, int) or isinstance(value, bool)):
+            raise SegmentRuleError(f"{key} must be a number")
+        return value
+
+
+def segment_condition(segment):
+    """The condition on Contact selecting a dynamic segment's contacts"""
+    rules = segment.get_rules()
+    if rules is None:
+        raise SegmentRuleError(f"Segment {segment.name!r} has no valid rules")
+    return and_(Contact.user_id == segment.user_id, compile_rules(rules, segment.user_id, segment.id))
+
+
+def contact_query(segment, *entities):
+    """Query entities of a segment's contacts.
+
+    Live dynamic segments are read with their rules, static and materialized
+    ones from segment_membership.
+
+    Returns:
+        tuple: (Query, contact id column to order and keyset by)
+    """
+    query = db.session.query(*entities)
+    if segment.is_live:
+        return query.filter(segment_condition(segment)), Contact.id
+
+    query = query.join(SegmentMembership, SegmentMembership.contact_id == Contact.id).filter(
+        SegmentMembership.segment_id == segment.id
+    )
+    return query, SegmentMembership.contact_id
+
+
+def contact_id_query(segment):
+    """Query a segment's contact ids, like contact_query; static segments don't read the contacts"""
+    if segment.is_live:
+        return db.session.query(Contact.id).filter(segment_condition(segment)), Contact.id
+
+    query = db.session.query(SegmentMembership.contact_id).filter(SegmentMembership.segment_id == segment.id)
+    return query, SegmentMembership.contact_id
+
+
+def count_contacts(segment):
+    """Number of contacts a send starting now would go to"""
+    if segment.is_dynamic and is_stale(segment):
+        return db.session.query(func.count(Contact.id)).filter(segment_condition(segment)).scalar()
+
+    query, contact_id = contact_id_query(segment)
+    return query.count()
+
+
+def is_stale(segment):
+    """Whether a materialized segment is due for a refresh"""
+    if not (segment.is_dynamic and segment.materialize):
+        return False
+    if segment.materialized_at is None:
+        return True
+
+    ttl = segment.refresh_ttl_minutes or DEFAULT_REFRESH_TTL_MINUTES
+    return segment.materialized_at < datetime.utcnow() - timedelta(minutes=ttl)
+
+
+def referring_segments(segment):
+    """The owner's dynamic segments with an in_segment rule for a segment"""
+    dynamic = EmailSegment.query.filter(
+        EmailSegment.user_id == segment.user_id,
+        EmailSegment.rules.isnot(None),
+        EmailSegment.id != segment.id
+    ).all()
+    return [other for other in dynamic if segment.id in _referenced_segment_ids(other.get_rules())]
+
+
+def _referenced_segment_ids(rule):
+    if not isinstance(rule, dict):
+        return set()
+    if 'rules' in rule:
+        rules = rule['rules'] if isinstance(rule['rules'], list) else []
+        return set().union(*(_referenced_segment_ids(child) for child in rules))
+    return {rule.get('segment_id')} if rule.get('type') == 'in_segment' else set()
+
+
+def active_job(segment, exclude_job_id=None):
+    """A running or paused job reading a segment's contacts, or None.
+
+    Besides the segment's own jobs, this includes jobs sending a live segment
+    whose rules read it.
+    """
+    segment_ids = [segment.id] + [other.id for other in referring_segments(segment) if other.is_live]
+    query = ScheduledJob.query.filter(
+        ScheduledJob.segment_id.in_(segment_ids),
+        ScheduledJob.status.in_(ACTIVE_JOB_STATUSES)
+    )
+    if exclude_job_id is not None:
+        query = query.filter(ScheduledJob.id != exclude_job_id)
+    return query.first()
+
+
+def refresh_if_stale(segment, job_id=None):
+    """Refresh a materialized segment that is due for it, as job job_id starts.
+
+    A segment another job is partway through keeps its contacts, and the
+    starting job reads them as they are.
+
+    Returns:
+        bool: whether it was refreshed
+    """
+    if not is_stale(segment) or active_job(segment, exclude_job_id=job_id) is not None:
+        return False
+    refresh(segment)
+    return True
+
+
+def refresh(segment):
+    """Rewrite a materialized segment's memberships from its rules.
+
+    Contacts that stopped matching are removed and new matches added in one
+    transaction, so anything reading the segment meanwhile sees either the
+    old members or the new ones.
+
+    Returns:
+        tuple: (added, removed)
+    """
+    import contact_listing
+
+    now = datetime.utcnow()
+    condition = segment_condition(segment)
+
+    removed = SegmentMembership.query.filter(
+        SegmentMembership.segment_id == segment.id,
+        SegmentMembership.contact_id.not_in(select(Contact.id).where(condition))
+    ).delete(synchronize_session=False)
+
+    matching = select(literal(segment.id), Contact.id, literal(now)).where(condition)
+    added = db.session.connection().execute(
+        insert_ignore(SegmentMembership).from_select(['segment_id', 'contact_id', 'created_at'], matching)
+    ).rowcount
+
+    segment.materialized_at = now
+    db.session.commit()
+    contact_listing.invalidate_count('segment', segment.id)
+    return added, removed
@@ -0,0 +1,136 @@
+"""Parallel campaign sending.
+
+A campaign is fanned out over several SMTP sessions at once. Concurrency and
+the sending rate come from the job's SMTPConfig (``max_connections`` and
+``send_rate_limit``) and hold for the configuration as a whole: every job
+sending through it in this process draws on one token bucket, and the
+connection pool opens at most ``max_connections`` sessions for it. Worker
+threads only render and send; all database work stays on the thread that
+drives the campaign.
+"""
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from flask_mail import Message
+
+from models import DEFAULT_MAX_CONNECTIONS
+from smtp_pool import smtp_pool
+
+# Plain copies of the ORM rows used by worker threads, which must not touch
+# the driving thread's database session
+Recipient = namedtuple('Recipient', ['id', 'email', 'name'])
+SMTPSettings = namedtuple('SMTPSettings', ['id', 'host', 'port', 'username', 'password', 'use_tls', 'use_ssl',
+                                           'max_connections'])
+
+# Upper bound on parallel SMTP sessions for a single SMTP configuration
+MAX_CONNECTIONS = 50
+
+# Token bucket of each SMTPConfig id, shared by the jobs sending through it
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+class TokenBucket:
+    """Token bucket rate limiter shared by the sending threads of every job on one SMTPConfig"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate or 0)
+        self.capacity = capacity or max(1.0, self.rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available. A rate of 0 means unlimited."""
+        if self.rate <= 0:
+            return
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                wait = (1 - self._tokens) / self.rate
+
+            time.sleep(wait)
+
+
+def get_bucket(config_id, rate):
+    """Return the token bucket of an SMTP configuration, replacing it if its rate changed"""
+    with _buckets_lock:
+        bucket = _buckets.get(config_id)
+        if bucket is None or bucket.rate != float(rate or 0):
+            bucket = _buckets[config_id] = TokenBucket(rate)
+        return bucket
+
+
+class CampaignSender:
+    """Renders and sends one campaign's messages over parallel SMTP sessions"""
+
+    def __init__(self, app, job, template, smtp_config, render):
+        self.app = app
+        self.job_id = job.id
+        self.subject = template.subject
+        self.render = render
+        self.concurrency = min(max(smtp_config.max_connections or DEFAULT_MAX_CONNECTIONS, 1), MAX_CONNECTIONS)
+        self.smtp = SMTPSettings(
+            smtp_config.id, smtp_config.host, smtp_config.port, smtp_config.username,
+            smtp_config.password, smtp_config.use_tls, smtp_config.use_ssl, self.concurrency
+        )
+
+        # Set the sender (use custom sender if available, otherwise use SMTP config)
+        sender_email = job.from_email if job.from_email else smtp_config.from_email
+        sender_name = job.from_name if job.from_name else smtp_config.from_name
+        self.sender = f"{sender_name} <{sender_email}>" if sender_name else sender_email
+
+        # Threads beyond the sessions the configuration has free wait in the pool
+        self.bucket = get_bucket(smtp_config.id, smtp_config.send_rate_limit)
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix=f'campaign-{job.id}')
+
+        self.sent = 0
+        self.started = time.monotonic()
+
+    def _send_one(self, recipient):
+        self.bucket.acquire()
+
+        with self.app.app_context():
+            msg = Message(
+                subject=self.subject,
+                recipients=[recipient.email],
+                html=self.render(recipient),
+                sender=self.sender
+            )
+            smtp_pool.send(self.smtp, msg)
+
+    def send_batch(self, recipients):
+        """Send to a batch of recipients in parallel.
+
+        Returns a list of (recipient, error) pairs in input order, where error
+        is None for messages the SMTP server accepted.
+        """
+        futures = [(recipient, self.executor.submit(self._send_one, recipient)) for recipient in recipients]
+
+        results = []
+        for recipient, future in futures:
+            error = future.exception()
+            if error is None:
+                self.sent += 1
+            results.append((recipient, error))
+
+        return results
+
+    @property
+    def rate(self):
+        """Measured throughput in emails per second since the sender started"""
+        elapsed = time.monotonic() - self.started
+        return self.sent / elapsed if elapsed > 0 else 0.0
+
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,244 @@
+"""Database-backed work queue for sending campaigns from worker processes.
+
+With USE_SEND_WORKERS set, the scheduler doesn't send a job itself: it
+splits the job's contacts into SendWorkItem rows of WORK_ITEM_SIZE contacts
+and leaves them to worker.py processes. Each worker claims one item at a
+time with SELECT ... FOR UPDATE SKIP LOCKED, so any number of workers on any
+number of hosts can share the queue without handing out an item twice.
+
+A worker sends an item batch by batch through the delivery ledger, adding
+each batch to the job's counters, and the worker that finishes a job's last
+item marks the job completed. Items claimed by a worker that went away are
+handed out again after CLAIM_TIMEOUT_MINUTES; the ledger skips contacts the
+previous attempt already sent.
+"""
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, func, insert, or_, update
+
+from app import db
+from models import ScheduledJob, EmailTemplate, SMTPConfig, JobLog, SendWorkItem
+from email_service import create_campaign_sender, send_contact_batch, iter_contact_batches
+from sql_helpers import chunked
+import campaign_control
+import segment_rules
+from job_log_writer import job_log_writer
+
+# Contacts per work item
+WORK_ITEM_SIZE = 1000
+
+# A claimed item with no progress for this long is handed to another worker
+CLAIM_TIMEOUT_MINUTES = 10
+
+
+def enqueue_job(job):
+    """Split a running job's contacts into work items.
+
+    Does nothing if the job was queued before, e.g. when it is resumed after
+    a pause; its remaining items are still in the queue.
+
+    Returns:
+        int: the number of items added
+    """
+    if db.session.query(SendWorkItem.id).filter(SendWorkItem.job_id == job.id).first():
+        finish_job_if_done(job.id)
+        return 0
+
+    # Items are bounded by contact id, so a materialized segment is rebuilt
+    # before it is split rather than while workers send it
+    segment_rules.refresh_if_stale(job.segment, job_id=job.id)
+
+    rows = [
+        {'job_id': job.id, 'after_contact_id': after_id, 'last_contact_id': last_id}
+        for after_id, last_id in _contact_ranges(job.segment)
+    ]
+    for chunk in chunked(rows):
+        db.session.execute(insert(SendWorkItem), chunk)
+
+    log_entry = JobLog(job_id=job.id, message=f"Queued {len(rows)} work items for send workers", level='info')
+    db.session.add(log_entry)
+    db.session.commit()
+
+    # A job with no contacts has nothing to wait for
+    finish_job_if_done(job.id)
+    return len(rows)
+
+
+def _contact_ranges(segment):
+    """Yield (after_id, last_id) bounds of WORK_ITEM_SIZE contacts each.
+
+    Each bound is found by skipping WORK_ITEM_SIZE entries of the
+    segment_membership primary key, so no contact rows are read. A live
+    dynamic segment is split by its matching contacts at the time; each
+    item's contacts are matched again when it is sent.
+    """
+    contact_ids, contact_id = segment_rules.contact_id_query(segment)
+    after_id = 0
+    while True:
+        in_range = contact_ids.filter(contact_id > after_id)
+        last_id = in_range.order_by(contact_id).offset(WORK_ITEM_SIZE - 1).limit(1).scalar()
+        if last_id is None:
+            last_id = in_range.with_entities(func.max(contact_id)).scalar()
+            if last_id is not None:
+                yield after_id, last_id
+            return
+
+        yield after_id, last_id
+        after_id = last_id
+
+
+def claim_work_item(worker_id):
+    """Claim the oldest available item of a running job.
+
+    Returns:
+        SendWorkItem, or None if there is nothing to do
+    """
+    stale_before = datetime.utcnow() - timedelta(minutes=CLAIM_TIMEOUT_MINUTES)
+    available = or_(
+        SendWorkItem.status == 'pending',
+        and_(SendWorkItem.status == 'claimed', SendWorkItem.claimed_at < stale_before)
+    )
+
+    # Workers skip each other's locked rows rather than queueing behind them
+    # (FOR UPDATE is not rendered on SQLite, where the UPDATE below decides)
+    item_id = db.session.query(SendWorkItem.id).join(
+        ScheduledJob, ScheduledJob.id == SendWorkItem.job_id
+    ).filter(
+        ScheduledJob.status == 'running',
+        available
+    ).order_by(SendWorkItem.id).limit(1).with_for_update(skip_locked=True, of=SendWorkItem).scalar()
+
+    if item_id is None:
+        db.session.rollback()
+        return None
+
+    claimed = db.session.execute(
+        update(SendWorkItem)
+        .where(SendWorkItem.id == item_id, available)
+        .values(
+            status='claimed',
+            claimed_by=worker_id,
+            claimed_at=datetime.utcnow(),
+            attempts=func.coalesce(SendWorkItem.attempts, 0) + 1
+        )
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+
+    if not claimed:
+        return None
+    return db.session.get(SendWorkItem, item_id)
+
+
+def process_work_item(app, item, senders, should_stop=None):
+    """Send a claimed item's contacts.
+
+    senders maps job ids to the CampaignSender of each job this worker is
+    sending, so the template is compiled and SMTP sessions opened once per
+    job rather than once per item. The item goes back in the queue if the
+    job is paused or stopped, or should_stop() returns True, between batches.
+
+    Returns:
+        tuple: (sent, failed) for this attempt
+    """
+    job = db.session.get(ScheduledJob, item.job_id)
+
+    sender = senders.get(job.id)
+    if sender is None:
+        template = db.session.get(EmailTemplate, job.template_id)
+        smtp_config = db.session.get(SMTPConfig, job.smtp_config_id)
+        if not template or not smtp_config or not job.segment:
+            _fail_job(job, "Missing template, segment, or SMTP configuration")
+            return 0, 0
+        sender = senders[job.id] = create_campaign_sender(app, job, template, smtp_config)
+
+    sent = 0
+    failed = 0
+    control = campaign_control.register(job.id)
+    try:
+        for recipients in iter_contact_batches(job.segment, job.batch_size or 100,
+                                               after_id=item.after_contact_id, last_id=item.last_contact_id):
+            batch_sent, batch_failed = send_contact_batch(job, sender, recipients)
+            sent += batch_sent
+            failed += batch_failed
+
+            # Commit the ledger rows together with the job's progress; claimed_at
+            # doubles as the item's heartbeat
+            ScheduledJob.increment_counters(job.id, sent_emails=batch_sent, failed_emails=batch_failed)
+            item.sent_emails = (item.sent_emails or 0) + batch_sent
+            item.failed_emails = (item.failed_emails or 0) + batch_failed
+            item.claimed_at = datetime.utcnow()
+            db.session.commit()
+
+            if not control.should_continue() or (should_stop and should_stop()):
+                item.status = 'pending'
+                item.claimed_by = None
+                db.session.commit()
+                return sent, failed
+    finally:
+        campaign_control.unregister(control)
+
+    item.status = 'done'
+    item.completed_at = datetime.utcnow()
+    db.session.commit()
+
+    if finish_job_if_done(job.id):
+        close_senders(senders, job.id)
+    return sent, failed
+
+
+def finish_job_if_done(job_id):
+    """Mark a running job completed once all of its items are done.
+
+    Every worker checks after committing its own item, so whichever commits
+    last sees the others' items done; the status UPDATE makes sure only one
+    of them completes the job.
+
+    Returns:
+        bool: True if this call completed the job
+    """
+    remaining = db.session.query(SendWorkItem.id).filter(
+        SendWorkItem.job_id == job_id,
+        SendWorkItem.status != 'done'
+    ).first()
+    if remaining:
+        return False
+
+    # Log this process's pending send errors ahead of the completion entry
+    job_log_writer.finish_job(job_id)
+
+    now = datetime.utcnow()
+    finished = db.session.execute(
+        update(ScheduledJob)
+        .where(ScheduledJob.id == job_id, ScheduledJob.status == 'running')
+        .values(status='completed', completed_at=now, sending_completed_at=now)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not finished:
+        db.session.rollback()
+        return False
+
+    sent, failed = db.session.query(ScheduledJob.sent_emails, ScheduledJob.failed_emails).filter(
+        ScheduledJob.id == job_id
+    ).one()
+    log_entry = JobLog(job_id=job_id, message=f"Job completed successfully. Sent: {sent}, Failed: {failed}", level='info')
+    db.session.add(log_entry)
+    db.session.commit()
+    logging.info(f"Job {job_id} executed. Status: completed")
+    return True
+
+
+def _fail_job(job, message):
+    job.status = 'failed'
+    log_entry = JobLog(job_id=job.id, message=message, level='error')
+    db.session.add(log_entry)
+    db.session.commit()
+
+
+def close_senders(senders, job_id=None):
+    """Close the cached sender of one job, or of all jobs"""
+    for key in [job_id] if job_id is not None else list(senders):
+        sender = senders.pop(key, None)
+        if sender is not None:
+            sender.close()
@@ -0,0 +1,268 @@
+"""Pooled SMTP connections for campaign sending.
+
+Flask-Mail opens a new connection (TCP connect, STARTTLS and AUTH) for every
+message passed to ``mail.send``. Campaigns send thousands of messages through
+the same SMTP configuration, so this module keeps authenticated connections
+open per ``SMTPConfig`` and hands them out again for the next message.
+
+The pool also caps the sessions in use per configuration at its
+``max_connections``, however many jobs send through it at once; a thread
+asking for one more waits until another is released. Each process has its
+own pool, so send worker processes each get that many.
+"""
+import atexit
+import logging
+import smtplib
+import socket
+import threading
+import time
+from collections import deque
+
+from flask import current_app
+from flask_mail import BadHeaderError, email_dispatched, sanitize_address, sanitize_addresses
+
+# Seconds to wait on any single SMTP socket operation
+SMTP_TIMEOUT = 30
+
+# Idle connections older than this are closed instead of reused; most relays
+# drop idle sessions after a minute or two anyway
+MAX_IDLE_SECONDS = 60
+
+# Relays commonly cap the number of messages per session, so connections are
+# recycled after this many messages
+MAX_MESSAGES_PER_CONNECTION = 500
+
+# Idle connections kept per SMTP configuration
+MAX_IDLE_PER_CONFIG = 10
+
+# SMTP reply codes that mean the server is closing the session
+RECONNECT_CODES = (421,)
+
+# Counters kept per SMTP configuration
+COUNTERS = ('opened', 'reused', 'reconnects', 'closed', 'sent')
+
+
+class PooledConnection:
+    """An authenticated SMTP session owned by the pool"""
+
+    def __init__(self, config_id, fingerprint, host):
+        self.config_id = config_id
+        self.fingerprint = fingerprint
+        self.host = host
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.messages_sent = 0
+
+    def close(self):
+        try:
+            self.host.quit()
+        except Exception:
+            try:
+                self.host.close()
+            except Exception:
+                pass
+
+
+class SMTPConnectionPool:
+    """Thread-safe pool of SMTP connections keyed by SMTPConfig id"""
+
+    def __init__(self, max_idle_per_config=MAX_IDLE_PER_CONFIG):
+        self.max_idle_per_config = max_idle_per_config
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+        self._idle = {}
+        self._in_use = {}
+        self._stats = {}
+
+    @staticmethod
+    def fingerprint(smtp_config):
+        """Settings that must match for a pooled connection to be reusable"""
+        return (
+            smtp_config.host,
+            smtp_config.port,
+            smtp_config.username,
+            smtp_config.password,
+            bool(smtp_config.use_tls),
+            bool(smtp_config.use_ssl),
+        )
+
+    def _connect(self, smtp_config):
+        if smtp_config.use_ssl:
+            host = smtplib.SMTP_SSL(smtp_config.host, smtp_config.port, timeout=SMTP_TIMEOUT)
+        else:
+            host = smtplib.SMTP(smtp_config.host, smtp_config.port, timeout=SMTP_TIMEOUT)
+
+        try:
+            if smtp_config.use_tls:
+                host.starttls()
+
+            if smtp_config.username and smtp_config.password:
+                host.login(smtp_config.username, smtp_config.password)
+        except Exception:
+            host.close()
+            raise
+
+        with self._lock:
+            self._count(smtp_config.id, 'opened')
+
+        logging.debug(f"Opened SMTP connection to {smtp_config.host}:{smtp_config.port}")
+        return PooledConnection(smtp_config.id, self.fingerprint(smtp_config), host)
+
+    def acquire(self, smtp_config):
+        """Return an idle connection for this configuration, or open a new one.
+
+        Waits while the configuration already has max_connections in use.
+        """
+        fingerprint = self.fingerprint(smtp_config)
+        limit = smtp_config.max_connections
+        stale = []
+        conn = None
+
+        with self._released:
+            while limit and self._in_use.get(smtp_config.id, 0) >= limit:
+                self._released.wait()
+            # Counted as in use from here, so connections being opened count too
+            self._in_use[smtp_config.id] = self._in_use.get(smtp_config.id, 0) + 1
+
+            idle = self._idle.setdefault(smtp_config.id, deque())
+            now = time.monotonic()
+            while idle:
+                candidate = idle.pop()
+                if candidate.fingerprint != fingerprint or now - candidate.last_used > MAX_IDLE_SECONDS:
+                    stale.append(candidate)
+                    continue
+                conn = candidate
+                self._count(smtp_config.id, 'reused')
+                break
+
+        for candidate in stale:
+            self._discard(candidate)
+
+        if conn is None:
+            try:
+                conn = self._connect(smtp_config)
+            except Exception:
+                with self._lock:
+                    self._free(smtp_config.id)
+                raise
+
+        return conn
+
+    def _free(self, config_id):
+        # Caller must hold self._lock
+        self._in_use[config_id] = max(self._in_use.get(config_id, 1) - 1, 0)
+        self._released.notify()
+
+    def release(self, conn, discard=False):
+        """Hand a connection back to the pool, closing it if it is no longer usable"""
+        with self._lock:
+            self._free(conn.config_id)
+
+            idle = self._idle.setdefault(conn.config_id, deque())
+            keep = (
+                not discard
+                and conn.messages_sent < MAX_MESSAGES_PER_CONNECTION
+                and len(idle) < self.max_idle_per_config
+            )
+            if keep:
+                conn.last_used = time.monotonic()
+                idle.append(conn)
+                return
+
+        self._discard(conn)
+
+    def _discard(self, conn):
+        conn.close()
+        with self._lock:
+            self._count(conn.config_id, 'closed')
+
+    def _count(self, config_id, counter):
+        # Caller must hold self._lock
+        stats = self._stats.setdefault(config_id, dict.fromkeys(COUNTERS, 0))
+        stats[counter] += 1
+
+    def send(self, smtp_config, message, envelope_from=None):
+        """Send a Flask-Mail message over a pooled connection.
+
+        A connection the server has dropped (421 reply, disconnect or socket
+        timeout) is discarded and the message is retried once on a fresh one.
+        """
+        assert message.send_to, "No recipients have been added"
+        assert message.sender, "The message does not specify a sender"
+
+        if message.has_bad_headers():
+            raise BadHeaderError
+
+        if message.date is None:
+            message.date = time.time()
+
+        app = current_app._get_current_object()
+
+        if app.config.get('MAIL_SUPPRESS_SEND', app.testing):
+            email_dispatched.send(app, message=message)
+            return
+
+        from_addr = sanitize_address(envelope_from or message.sender)
+        to_addrs = list(sanitize_addresses(message.send_to))
+        payload = message.as_bytes()
+
+        for attempt in range(2):
+            conn = self.acquire(smtp_config)
+            try:
+                conn.host.sendmail(from_addr, to_addrs, payload, message.mail_options, message.rcpt_options)
+            except Exception as e:
+                broken = _is_connection_error(e)
+                self.release(conn, discard=broken)
+                if not broken or attempt > 0:
+                    raise
+                with self._lock:
+                    self._count(smtp_config.id, 'reconnects')
+                logging.info(f"SMTP connection to {smtp_config.host} dropped ({e}), reconnecting")
+                continue
+
+            conn.messages_sent += 1
+            self.release(conn)
+            with self._lock:
+                self._count(smtp_config.id, 'sent')
+            break
+
+        email_dispatched.send(app, message=message)
+
+    def close(self, config_id=None):
+        """Close idle connections for one configuration, or for all of them"""
+        with self._lock:
+            if config_id is None:
+                conns = [conn for idle in self._idle.values() for conn in idle]
+                self._idle.clear()
+            else:
+                conns = list(self._idle.pop(config_id, ()))
+
+        for conn in conns:
+            self._discard(conn)
+
+    def get_stats(self, config_id=None):
+        """Return pool size and connection reuse counters"""
+        with self._lock:
+            if config_id is None:
+                stats = {counter: sum(s[counter] for s in self._stats.values()) for counter in COUNTERS}
+                stats['idle'] = sum(len(idle) for idle in self._idle.values())
+                stats['in_use'] = sum(self._in_use.values())
+            else:
+                stats = dict(self._stats.get(config_id) or dict.fromkeys(COUNTERS, 0))
+                stats['idle'] = len(self._idle.get(config_id, ()))
+                stats['in_use'] = self._in_use.get(config_id, 0)
+        stats['pool_size'] = stats['idle'] + stats['in_use']
+        return stats
+
+
+def _is_connection_error(error):
+    """True if the error means the SMTP session itself is unusable"""
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code in RECONNECT_CODES
+    return isinstance(error, (socket.timeout, ConnectionError))
+
+
+smtp_pool = SMTPConnectionPool()
+atexit.register(smtp_pool.close)
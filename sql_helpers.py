@@ -0,0 +1,56 @@
+"""Dialect-specific SQL that SQLAlchemy core does not cover portably.
+
+The app runs on PostgreSQL in production and SQLite for local development;
+both support ``INSERT ... ON CONFLICT DO NOTHING`` and ``RETURNING``.
+"""
+from app import db
+
+
+def _insert(model):
+    dialect = db.engine.dialect.name
+
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise NotImplementedError(f"ON CONFLICT is not supported on {dialect}")
+
+    return insert(model)
+
+
+def insert_ignore(model, index_elements=None):
+    """INSERT statement that skips rows violating a unique constraint.
+
+    Args:
+        model: Mapped class to insert into
+        index_elements: Columns of the constraint to check; None means any
+
+    Returns:
+        Insert: Statement to which .values() and .returning() can be added
+    """
+    return _insert(model).on_conflict_do_nothing(index_elements=index_elements)
+
+
+def upsert_increment(model, keys, deltas):
+    """INSERT a row, or add to its counters if the key already exists.
+
+    Args:
+        model: Mapped class whose primary key is exactly the columns in keys
+        keys: Column name to value for the key columns
+        deltas: Column name to amount for the counter columns
+
+    Returns:
+        Insert: INSERT ... ON CONFLICT (keys) DO UPDATE SET c = c + excluded.c
+    """
+    stmt = _insert(model).values(**keys, **deltas)
+    return stmt.on_conflict_do_update(
+        index_elements=list(keys),
+        set_={name: getattr(model, name) + stmt.excluded[name] for name in deltas}
+    )
+
+
+def chunked(rows, size=1000):
+    """Split a list of rows so multi-row statements stay under parameter limits"""
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
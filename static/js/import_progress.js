@@ -0,0 +1,50 @@
+// Badge colour for each import status
+const IMPORT_STATUS_BADGES = {
+    queued: 'bg-secondary',
+    running: 'bg-primary',
+    completed: 'bg-success',
+    failed: 'bg-danger'
+};
+
+// Milliseconds between progress checks
+const IMPORT_POLL_INTERVAL = 1000;
+
+document.addEventListener('DOMContentLoaded', function() {
+    const panel = document.getElementById('import-progress');
+    if (!panel || panel.dataset.finished === 'true') {
+        return;
+    }
+    
+    const timer = setInterval(function() {
+        fetch(`/imports/${panel.dataset.importId}`)
+            .then(response => response.json())
+            .then(data => {
+                updateImportProgress(data);
+                
+                // Reload once the import is done so the new contacts are listed
+                if (data.finished) {
+                    clearInterval(timer);
+                    window.location.reload();
+                }
+            })
+            .catch(error => console.error('Error fetching import progress:', error));
+    }, IMPORT_POLL_INTERVAL);
+});
+
+function updateImportProgress(data) {
+    const statusBadge = document.getElementById('import-status');
+    statusBadge.textContent = data.status.charAt(0).toUpperCase() + data.status.slice(1);
+    statusBadge.className = `badge ${IMPORT_STATUS_BADGES[data.status] || 'bg-secondary'}`;
+    
+    document.getElementById('import-rows-read').textContent = data.rows_read;
+    document.getElementById('import-inserted').textContent = data.inserted;
+    document.getElementById('import-duplicates').textContent = data.duplicates;
+    document.getElementById('import-rejected').textContent = data.rejected;
+    document.getElementById('import-rate').textContent = Math.round(data.rows_per_second);
+    
+    if (data.error) {
+        const error = document.getElementById('import-error');
+        error.textContent = data.error;
+        error.classList.remove('d-none');
+    }
+}
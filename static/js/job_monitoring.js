@@ -1,8 +1,23 @@
+// Badge colour for each job status
+const STATUS_BADGES = {
+    scheduled: 'bg-secondary',
+    running: 'bg-primary',
+    paused: 'bg-warning',
+    completed: 'bg-success',
+    cancelled: 'bg-danger',
+    failed: 'bg-danger'
+};
+
+// Log entries requested per call
+const LOG_PAGE_SIZE = 100;
+
+let refreshTimer = null;
+
 document.addEventListener('DOMContentLoaded', function() {
-    // Auto-refresh the page every 5 seconds if the job is running or paused
+    // Refresh the job data every 5 seconds while the job is running or paused
     const jobStatus = document.getElementById('job-status').dataset.status;
     if (jobStatus === 'running' || jobStatus === 'paused') {
-        setInterval(function() {
+        refreshTimer = setInterval(function() {
             refreshJobData();
         }, 5000);
     }
@@ -12,6 +27,11 @@ document.addEventListener('DOMContentLoaded', function() {
         refreshLogs();
     });
     
+    // Load older log entries on demand
+    document.getElementById('load-older-logs').addEventListener('click', function() {
+        loadOlderLogs();
+    });
+    
     // Initialize charts if we have data
     initCharts();
 });
@@ -24,8 +44,10 @@ function refreshJobData() {
         .then(response => response.json())
         .then(data => {
             // Update job status
-            document.getElementById('job-status').textContent = data.status;
-            document.getElementById('job-status').dataset.status = data.status;
+            const statusBadge = document.getElementById('job-status');
+            statusBadge.textContent = data.status.charAt(0).toUpperCase() + data.status.slice(1);
+            statusBadge.dataset.status = data.status;
+            statusBadge.className = `badge ${STATUS_BADGES[data.status] || 'bg-secondary'}`;
             
             // Update progress bar
             const progress = data.total_emails > 0 ? (data.sent_emails / data.total_emails) * 100 : 0;
@@ -51,44 +73,104 @@ function refreshJobData() {
             
             // Update charts if needed
             updateCharts(data);
+            
+            // Nothing more will change once the job has finished
+            if (data.status !== 'running' && data.status !== 'paused' && refreshTimer) {
+                clearInterval(refreshTimer);
+                refreshTimer = null;
+            }
         })
         .catch(error => console.error('Error refreshing job data:', error));
 }
 
-// Function to refresh just the logs
+// Function to fetch log entries added since the newest one shown
 function refreshLogs() {
     const jobId = document.getElementById('job-container').dataset.jobId;
+    const logsContainer = document.getElementById('logs-container');
+    const sinceId = logsContainer.dataset.newestId || 0;
     
-    fetch(`/job/${jobId}/logs`)
+    fetch(`/job/${jobId}/logs?since_id=${sinceId}&limit=${LOG_PAGE_SIZE}`)
         .then(response => response.json())
         .then(data => {
-            const logsContainer = document.getElementById('logs-container');
-            let logsHtml = '';
+            if (data.logs.length === 0) return;
+            
+            removeNoLogsRow();
             
-            if (data.logs.length === 0) {
-                logsHtml = '<tr><td colspan="3" class="text-center">No logs available yet</td></tr>';
-            } else {
-                data.logs.forEach(log => {
-                    const rowClass = log.level === 'error' ? 'table-danger' : 
-                                    log.level === 'warning' ? 'table-warning' : '';
-                    const badgeClass = log.level === 'info' ? 'bg-info' : 
-                                      log.level === 'warning' ? 'bg-warning' : 'bg-danger';
-                    
-                    logsHtml += `
-                        <tr class="${rowClass}">
-                            <td>${log.timestamp}</td>
-                            <td><span class="badge ${badgeClass}">${log.level.toUpperCase()}</span></td>
-                            <td>${log.message}</td>
-                        </tr>
-                    `;
-                });
+            // Entries arrive newest first; put them above the ones shown
+            const rows = document.createDocumentFragment();
+            data.logs.forEach(log => rows.appendChild(createLogRow(log)));
+            logsContainer.insertBefore(rows, logsContainer.firstChild);
+            
+            logsContainer.dataset.newestId = data.logs[0].id;
+            if (!Number(logsContainer.dataset.oldestId)) {
+                logsContainer.dataset.oldestId = data.logs[data.logs.length - 1].id;
             }
             
-            logsContainer.innerHTML = logsHtml;
+            // Catch up in further pages if many entries were added
+            if (data.has_more) {
+                refreshLogs();
+            }
         })
         .catch(error => console.error('Error fetching logs:', error));
 }
 
+// Function to append the page of log entries before the oldest one shown
+function loadOlderLogs() {
+    const jobId = document.getElementById('job-container').dataset.jobId;
+    const logsContainer = document.getElementById('logs-container');
+    const beforeId = logsContainer.dataset.oldestId;
+    
+    fetch(`/job/${jobId}/logs?before_id=${beforeId}&limit=${LOG_PAGE_SIZE}`)
+        .then(response => response.json())
+        .then(data => {
+            data.logs.forEach(log => logsContainer.appendChild(createLogRow(log)));
+            
+            if (data.logs.length > 0) {
+                logsContainer.dataset.oldestId = data.logs[data.logs.length - 1].id;
+            }
+            if (!data.has_more) {
+                document.getElementById('older-logs').classList.add('d-none');
+            }
+        })
+        .catch(error => console.error('Error fetching logs:', error));
+}
+
+// Function to build a table row for a log entry
+function createLogRow(log) {
+    const row = document.createElement('tr');
+    const rowClass = log.level === 'error' ? 'table-danger' : 
+                    log.level === 'warning' ? 'table-warning' : '';
+    const badgeClass = log.level === 'info' ? 'bg-info' : 
+                      log.level === 'warning' ? 'bg-warning' : 'bg-danger';
+    if (rowClass) {
+        row.className = rowClass;
+    }
+    
+    const timestampCell = document.createElement('td');
+    timestampCell.textContent = log.timestamp;
+    
+    const levelCell = document.createElement('td');
+    const badge = document.createElement('span');
+    badge.className = `badge ${badgeClass}`;
+    badge.textContent = log.level.toUpperCase();
+    levelCell.appendChild(badge);
+    
+    // Messages contain recipient addresses and SMTP replies, so never parse them as HTML
+    const messageCell = document.createElement('td');
+    messageCell.textContent = log.message;
+    
+    row.append(timestampCell, levelCell, messageCell);
+    return row;
+}
+
+// Function to remove the "No logs available yet" placeholder
+function removeNoLogsRow() {
+    const placeholder = document.getElementById('no-logs');
+    if (placeholder) {
+        placeholder.remove();
+    }
+}
+
 // Function to update control buttons based on job status
 function updateControlButtons(status) {
     const controlContainer = document.getElementById('job-controls');
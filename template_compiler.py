@@ -0,0 +1,371 @@
+"""Email template personalization, tracking and precompilation.
+
+``personalize_email``, ``add_open_tracking`` and ``add_click_tracking`` are the
+per-message pipeline. Running it for every recipient means repeated
+``str.replace`` over the whole document and a BeautifulSoup parse and
+serialize per message.
+
+``compile_template`` runs that same pipeline once, with marker characters in
+place of every per-recipient value, and splits the result into literal
+segments and slots. Rendering a recipient is then a single join. Output is
+byte-identical to the per-message pipeline: recipients whose values could be
+changed by the HTML parser (markup characters, entities, a leading ``#``, or
+whitespace where the template puts a token in an unquoted attribute) are
+rendered through the pipeline instead.
+
+Compiled for a campaign (``link_table=True``), links whose URL is the same
+for every recipient point at the job's CampaignLink rows and carry only a
+signed token; the URL itself is looked up when the link is clicked. Links
+whose URL contains personalization, and every link in test sends, carry the
+URL in the query string, percent-encoded and signed into the token.
+
+``get_compiled_template`` keeps compiled templates in a process-wide LRU
+cache keyed on the template's id, ``updated_at`` and tracking flags, so test
+sends and back-to-back campaigns with the same template compile it once.
+"""
+import re
+import threading
+from collections import OrderedDict
+from urllib.parse import quote
+
+from bs4 import BeautifulSoup
+
+import tracking_tokens
+
+# Slot kinds
+NAME = 'n'
+EMAIL = 'e'
+OPEN_TOKEN = 'o'
+CLICK_TOKEN = 'k'
+
+# Private-use characters delimit slots in the compiled document; the HTML
+# parser passes them through untouched
+MARK_START = '\ue000'
+MARK_END = '\ue001'
+_SLOT_RE = re.compile(MARK_START + '([a-z])' + MARK_END)
+
+# Characters that could be mistaken for tokens or markers in a value
+_TOKEN_CHARS = frozenset('{}' + MARK_START + MARK_END)
+
+# Characters the HTML parser may rewrite, or that could change which links
+# click tracking rewrites
+_PARSER_CHARS = frozenset('&<>"\'\r#')
+
+# Compiled templates kept in memory per process
+TEMPLATE_CACHE_SIZE = 128
+
+# Whitespace is only a problem when a token sits in an unquoted attribute.
+# html.parser ends those at anything its patterns match as \s, which is every
+# Unicode whitespace character (the last is U+3000); \r never gets this far
+_WHITESPACE = ''.join(ch for ch in map(chr, range(0x3001)) if ch.isspace() and ch not in _PARSER_CHARS)
+
+
+def _mark(kind, padding=''):
+    return f'{MARK_START}{kind}{padding}{MARK_END}'
+
+
+def personalize_email(content, contact):
+    """Replace personalization tokens in email content"""
+    personalized = content
+
+    # Replace name if available
+    if contact.name:
+        personalized = personalized.replace('{{name}}', contact.name)
+    else:
+        personalized = personalized.replace('{{name}}', 'Valued Customer')
+
+    # Replace email
+    personalized = personalized.replace('{{email}}', contact.email)
+
+    return personalized
+
+def add_open_tracking(content, open_token):
+    """Add open tracking pixel to email"""
+    # Use request.url_root to get the domain of the current application
+    # For now, we'll use a relative URL which will resolve correctly
+    # regardless of the domain the application is deployed on
+    tracking_pixel = f'<img src="/o/{open_token}" width="1" height="1" alt="" style="display:none" />'
+
+    # Add tracking pixel before closing body tag
+    if '</body>' in content:
+        return content.replace('</body>', f'{tracking_pixel}</body>')
+    else:
+        return content + tracking_pixel
+
+def add_click_tracking(content, tracked_url):
+    """Add click tracking to all links in the email
+
+    Args:
+        content: HTML content
+        tracked_url: Called with each tracked link's original URL, in
+            document order, and returns the tracking URL to use instead
+    """
+    soup = BeautifulSoup(content, 'html.parser')
+
+    # Find all links
+    for link in soup.find_all('a'):
+        if link.has_attr('href'):
+            original_url = link['href']
+            # Skip empty or javascript links
+            if not original_url or original_url.startswith('javascript:') or original_url.startswith('#'):
+                continue
+
+            link['href'] = tracked_url(original_url)
+
+    return str(soup)
+
+def click_tracking_url(job_id, contact_id, original_url, links=None):
+    """Tracking URL for one link
+
+    Args:
+        links: The job's CampaignLink indexes by URL; URLs not in it are
+            carried in the query string
+    """
+    link_index = links.get(original_url) if links else None
+
+    # Use a relative URL which will resolve correctly regardless of the domain
+    if link_index is None:
+        return _query_url_link(job_id, contact_id, original_url)
+
+    return f"/c/{tracking_tokens.make_token(tracking_tokens.CLICK, job_id, contact_id, link_index)}"
+
+def _query_url_link(job_id, contact_id, url):
+    # The token's signature covers the URL, so the link can't be pointed elsewhere
+    token = tracking_tokens.make_token(tracking_tokens.CLICK, job_id, contact_id, tracking_tokens.NO_LINK, url=url)
+    return f"/c/{token}?url={quote(url, safe='')}"
+
+def render_email(content, job_id, contact, has_open_tracking, has_click_tracking, links=None):
+    """Run the full per-message pipeline for one recipient"""
+    personalized_content = personalize_email(content, contact)
+
+    # Add tracking if enabled for this template
+    if has_open_tracking:
+        open_token = tracking_tokens.make_token(tracking_tokens.OPEN, job_id, contact.id)
+        personalized_content = add_open_tracking(personalized_content, open_token)
+
+    if has_click_tracking:
+        personalized_content = add_click_tracking(
+            personalized_content,
+            lambda original_url: click_tracking_url(job_id, contact.id, original_url, links)
+        )
+
+    return personalized_content
+
+
+class CompiledTemplate:
+    """A template split into literal segments and per-recipient slots"""
+
+    def __init__(self, content, has_open_tracking, has_click_tracking, link_table=False):
+        self.content = content
+        self.has_open_tracking = has_open_tracking
+        self.has_click_tracking = has_click_tracking
+        self.link_table = link_table
+        self.pieces = None
+        self.whitespace_safe = True
+
+        # URL of each click slot in order; None where the URL is personalized
+        # or travels in the query string
+        self.click_urls = []
+
+        # Marked URL of each click slot that travels in the query string, in
+        # the same order; None for CampaignLinks
+        self.query_urls = []
+
+        if MARK_START in content or MARK_END in content:
+            # Can't tell our markers from the template's own text
+            return
+
+        # Run the regular pipeline once with markers in place of every value
+        marked = self._run_pipeline(_MarkedContact(), self.click_urls, self.query_urls)
+
+        # Alternating literal text and slot kinds: [text, kind, text, kind, ..., text]
+        self.pieces = _SLOT_RE.split(marked)
+
+        if has_click_tracking:
+            # Run it again with whitespace inside the name and email markers;
+            # if the parser leaves the document unchanged, values containing
+            # whitespace can use the compiled form too
+            probe_urls = []
+            probe = self._run_pipeline(_MarkedContact(_WHITESPACE), [], probe_urls)
+            for kind in (NAME, EMAIL):
+                probe = probe.replace(_mark(kind, _WHITESPACE), _mark(kind))
+                probe_urls = [url.replace(_mark(kind, _WHITESPACE), _mark(kind)) if url else url for url in probe_urls]
+            self.whitespace_safe = probe == marked and probe_urls == self.query_urls
+
+    def _run_pipeline(self, contact, click_urls, query_urls):
+        marked = personalize_email(self.content, contact)
+        if self.has_open_tracking:
+            marked = add_open_tracking(marked, _mark(OPEN_TOKEN))
+        if self.has_click_tracking:
+            marked = add_click_tracking(marked, lambda original_url: self._mark_link(original_url, click_urls, query_urls))
+        return marked
+
+    def _mark_link(self, original_url, click_urls, query_urls):
+        # Click slots appear in document order, matching click_urls and
+        # query_urls; the whole tracking URL goes in the slot, as a URL in the
+        # query string is encoded and signed once its values are known
+        if self.link_table and MARK_START not in original_url:
+            click_urls.append(original_url)
+            query_urls.append(None)
+        else:
+            click_urls.append(None)
+            query_urls.append(original_url)
+        return _mark(CLICK_TOKEN)
+
+    @property
+    def links(self):
+        """Distinct URLs to register as the job's CampaignLinks, in document order"""
+        return list(dict.fromkeys(url for url in self.click_urls if url is not None))
+
+    def _can_compile(self, contact, links):
+        if self.pieces is None:
+            return False
+
+        if links is None:
+            links = {}
+        if any(url is not None and url not in links for url in self.click_urls):
+            return False
+
+        for value in (contact.name or 'Valued Customer', contact.email):
+            if not value or _TOKEN_CHARS.intersection(value):
+                return False
+
+            # The open pixel is inserted at every </body>, including one in a value
+            if self.has_open_tracking and '</body>' in value:
+                return False
+
+            # Without click tracking the pipeline is plain substitution
+            if self.has_click_tracking and (_PARSER_CHARS.intersection(value) or value.startswith('javascript:')):
+                return False
+
+            if not self.whitespace_safe and any(ch.isspace() for ch in value):
+                return False
+
+        return True
+
+    def render(self, job_id, contact, links=None):
+        """Render the message body for one recipient
+
+        Args:
+            links: The job's CampaignLink indexes by URL, from
+                campaign_links.register_links
+        """
+        if not self._can_compile(contact, links):
+            return render_email(self.content, job_id, contact, self.has_open_tracking, self.has_click_tracking, links)
+
+        values = {
+            NAME: contact.name or 'Valued Customer',
+            EMAIL: contact.email,
+        }
+        if self.has_open_tracking:
+            values[OPEN_TOKEN] = tracking_tokens.make_token(tracking_tokens.OPEN, job_id, contact.id)
+
+        pieces = self.pieces
+        click_urls = iter(self.click_urls)
+        query_urls = iter(self.query_urls)
+        out = [pieces[0]]
+        for i in range(1, len(pieces), 2):
+            kind = pieces[i]
+            if kind == CLICK_TOKEN:
+                url = next(click_urls)
+                query_url = next(query_urls)
+                if url is None:
+                    for value_kind in (NAME, EMAIL):
+                        query_url = query_url.replace(_mark(value_kind), values[value_kind])
+                    out.append(_query_url_link(job_id, contact.id, query_url))
+                else:
+                    out.append(f"/c/{tracking_tokens.make_token(tracking_tokens.CLICK, job_id, contact.id, links[url])}")
+            else:
+                out.append(values[kind])
+            out.append(pieces[i + 1])
+        return ''.join(out)
+
+
+class _MarkedContact:
+    """Stands in for a contact while compiling"""
+
+    def __init__(self, padding=''):
+        self.name = _mark(NAME, padding)
+        self.email = _mark(EMAIL, padding)
+
+
+def compile_template(content, has_open_tracking, has_click_tracking, link_table=False):
+    """Parse template content once into a CompiledTemplate"""
+    return CompiledTemplate(content, bool(has_open_tracking), bool(has_click_tracking), link_table)
+
+
+class TemplateCache:
+    """Thread-safe LRU cache of compiled templates"""
+
+    def __init__(self, maxsize=TEMPLATE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(template, link_table):
+        return (template.id, template.updated_at, bool(template.has_open_tracking), bool(template.has_click_tracking), link_table)
+
+    def get(self, template, link_table=False):
+        """Return the compiled form of an EmailTemplate, compiling it on a miss"""
+        if template.id is None:
+            # Not saved yet, so there is nothing stable to key on
+            return compile_template(template.content, template.has_open_tracking, template.has_click_tracking, link_table)
+
+        key = self.key(template, link_table)
+        with self._lock:
+            compiled = self._entries.get(key)
+            if compiled is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return compiled
+            self.misses += 1
+
+        # Compile outside the lock; two threads missing together both compile
+        # the same template, which is harmless
+        compiled = compile_template(template.content, template.has_open_tracking, template.has_click_tracking, link_table)
+
+        with self._lock:
+            self._entries[key] = compiled
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+        return compiled
+
+    def invalidate(self, template_id):
+        """Drop every cached version of a template"""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == template_id]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+template_cache = TemplateCache()
+
+
+def get_compiled_template(template, link_table=False):
+    """Compiled form of an EmailTemplate from the process-wide cache"""
+    return template_cache.get(template, link_table)
+
+
+def invalidate_template(template_id):
+    """Forget cached compiled versions of a template after it changes"""
+    template_cache.invalidate(template_id)
@@ -0,0 +1,38 @@
+"""The compiled fast path must render exactly what the per-message pipeline does"""
+from collections import namedtuple
+
+import pytest
+from flask import Flask
+
+import template_compiler
+
+Contact = namedtuple('Contact', ['id', 'email', 'name'])
+
+TEMPLATES = [
+    '<a href=http://x.com/{{name}}>x</a>',
+    '<p title={{email}}>{{name}}</p><a href=http://y.com>y</a>',
+    '<a href="http://x.com/{{name}}">x</a> {{name}}',
+]
+
+# html.parser ends an unquoted attribute at any Unicode whitespace
+NAMES = ['plain', 'a b', 'a\tb', 'a\x0bb', 'a\xa0b', 'a\x1cb', 'a\x85b', 'a b', 'a　b']
+
+
+@pytest.fixture(autouse=True)
+def app_context():
+    app = Flask(__name__)
+    app.secret_key = 'test'
+    with app.app_context():
+        yield
+
+
+@pytest.mark.parametrize('link_table', [False, True])
+@pytest.mark.parametrize('content', TEMPLATES)
+def test_whitespace_values_match_pipeline(content, link_table):
+    compiled = template_compiler.compile_template(content, True, True, link_table)
+    links = {url: index for index, url in enumerate(compiled.links)}
+
+    for name in NAMES:
+        contact = Contact(7, 'x@example.com', name)
+        expected = template_compiler.render_email(content, 3, contact, True, True, links)
+        assert compiled.render(3, contact, links) == expected, repr(name)
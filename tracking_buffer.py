@@ -0,0 +1,282 @@
+"""Write-behind buffer for email open and click tracking.
+
+The tracking routes used to look up the job and contact, insert the event and
+update the job's counters in their own transaction, so a campaign landing in
+inboxes tied up the database connection pool with one transaction per pixel.
+
+The routes now only append the event to an in-memory queue and answer
+straight away. A background thread flushes the queue every FLUSH_INTERVAL
+seconds (sooner once FLUSH_SIZE events are waiting): events for unknown jobs
+or contacts are dropped, the rest are bulk-inserted, and the job counters are
+bumped with one UPDATE per job per flush.
+
+The first open and first click per (job, contact) also go into
+email_unique_open / email_unique_click, whose primary key rejects repeats.
+Rows that insert are counted into the job's unique_opens / unique_clicks, so
+repeat opens and mail client prefetches don't inflate open rates.
+
+Request-supplied fields are cut to their column lengths when queued. A batch
+the database still rejects because of one of its events is split in halves,
+each written in its own transaction, until only the offending events are
+left out; other errors put the whole batch back to be retried.
+
+Events still queued when the process dies without a clean shutdown are lost,
+so at most a few seconds of tracking data is at risk.
+"""
+import atexit
+import logging
+import threading
+from collections import Counter, deque, namedtuple
+from datetime import datetime
+
+from sqlalchemy import insert, select
+from sqlalchemy.exc import DataError, IntegrityError
+
+from app import db
+from models import ScheduledJob, Contact, ContactAlias, EmailOpen, EmailClick, EmailUniqueOpen, EmailUniqueClick
+from sql_helpers import insert_ignore, chunked
+
+# Seconds between flushes
+FLUSH_INTERVAL = 2
+
+# Flush early once this many events are waiting
+FLUSH_SIZE = 500
+
+# Events held in memory before new ones are dropped, in case the database is
+# unreachable for a long time
+MAX_PENDING = 100000
+
+# Consecutive failed flushes before the pending events are discarded
+MAX_FLUSH_ATTEMPTS = 5
+
+OPEN = 'open'
+CLICK = 'click'
+
+# Errors caused by the events being written rather than by the database; the
+# batch is split so that only the events causing them are dropped
+BAD_EVENT_ERRORS = (DataError, IntegrityError)
+
+TrackingEvent = namedtuple('TrackingEvent', ['kind', 'job_id', 'contact_id', 'tracking_id', 'url', 'link_id', 'timestamp', 'ip_address', 'user_agent'])
+
+
+class TrackingBuffer:
+    """Queue of tracking events written to the database in batches"""
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL, flush_size=FLUSH_SIZE, max_pending=MAX_PENDING):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.max_pending = max_pending
+        self.app = None
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self._failed_attempts = 0
+        self.dropped = 0
+
+    def start(self, app):
+        """Start the background flusher for this app"""
+        self.app = app
+        if self._thread is not None:
+            return
+
+        self._thread = threading.Thread(target=self._run, name='tracking-buffer', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Stop the flusher and write out whatever is still queued"""
+        self._stopping = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+        self.flush()
+
+    def record_open(self, job_id, contact_id, tracking_id, ip_address=None, user_agent=None):
+        self._append(TrackingEvent(
+            OPEN, job_id, contact_id, _fit(tracking_id, EmailOpen.tracking_id), None, None, datetime.utcnow(),
+            _fit(ip_address, EmailOpen.ip_address), _fit(user_agent, EmailOpen.user_agent)
+        ))
+
+    def record_click(self, job_id, contact_id, tracking_id, url, ip_address=None, user_agent=None, link_id=None):
+        """Queue a click on either a CampaignLink (link_id) or a URL carried in the tracking URL"""
+        self._append(TrackingEvent(
+            CLICK, job_id, contact_id, _fit(tracking_id, EmailClick.tracking_id), url, link_id, datetime.utcnow(),
+            _fit(ip_address, EmailClick.ip_address), _fit(user_agent, EmailClick.user_agent)
+        ))
+
+    def _append(self, event):
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                self.dropped += 1
+                if self.dropped % 1000 == 1:
+                    logging.error(f"Tracking buffer full, {self.dropped} events dropped so far")
+                return
+            self._pending.append(event)
+            full = len(self._pending) >= self.flush_size
+
+        if full:
+            self._wakeup.set()
+
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Error flushing tracking events: {str(e)}")
+
+    def flush(self):
+        """Write all queued events to the database.
+
+        Returns:
+            int: Number of events written
+        """
+        if self.app is None:
+            return 0
+
+        with self._flush_lock:
+            with self._lock:
+                events, self._pending = self._pending, []
+
+            if not events:
+                return 0
+
+            # Each batch is its own transaction; a batch the database rejects
+            # because of its events is replaced by its two halves
+            batches = deque([events])
+            written = 0
+            with self.app.app_context():
+                try:
+                    while batches:
+                        batch = batches[0]
+                        try:
+                            written += self._write(batch)
+                            db.session.commit()
+                        except BAD_EVENT_ERRORS as e:
+                            db.session.rollback()
+                            batches.popleft()
+                            if len(batch) == 1:
+                                logging.warning(f"Dropping tracking event the database rejected: {str(e)}")
+                            else:
+                                middle = len(batch) // 2
+                                batches.extendleft([batch[middle:], batch[:middle]])
+                            continue
+                        batches.popleft()
+                except Exception as e:
+                    db.session.rollback()
+                    remaining = [event for batch in batches for event in batch]
+                    self._failed_attempts += 1
+
+                    if self._failed_attempts >= MAX_FLUSH_ATTEMPTS:
+                        logging.error(f"Discarding {len(remaining)} tracking events after {self._failed_attempts} failed flushes: {str(e)}")
+                        self._failed_attempts = 0
+                        return written
+
+                    # Put them back in front of anything that arrived meanwhile
+                    logging.warning(f"Error writing {len(remaining)} tracking events, will retry: {str(e)}")
+                    with self._lock:
+                        self._pending = (remaining + self._pending)[-self.max_pending:]
+                    return written
+                finally:
+                    db.session.remove()
+
+            self._failed_attempts = 0
+            return written
+
+    def _write(self, events):
+        # Resolve every job and contact id in the batch with one query each
+        job_ids = {event.job_id for event in events}
+        contact_ids = {event.contact_id for event in events}
+        known_jobs = set(db.session.scalars(select(ScheduledJob.id).where(ScheduledJob.id.in_(job_ids))))
+        contacts = {
+            contact_id: contact_id
+            for contact_id in db.session.scalars(select(Contact.id).where(Contact.id.in_(contact_ids)))
+        }
+
+        # Tokens sent to contacts since merged into another count for that one
+        merged = contact_ids - contacts.keys()
+        if merged:
+            contacts.update(db.session.execute(
+                select(ContactAlias.old_contact_id, ContactAlias.contact_id).where(ContactAlias.old_contact_id.in_(merged))
+            ).all())
+
+        opens = []
+        clicks = []
+        for event in events:
+            contact_id = contacts.get(event.contact_id)
+            if event.job_id not in known_jobs or contact_id is None:
+                continue
+
+            row = {
+                'job_id': event.job_id,
+                'contact_id': contact_id,
+                'tracking_id': event.tracking_id,
+                'timestamp': event.timestamp,
+                'ip_address': event.ip_address,
+                'user_agent': event.user_agent,
+            }
+            if event.kind == CLICK:
+                row['url'] = event.url
+                row['link_id'] = event.link_id
+                clicks.append(row)
+            else:
+                opens.append(row)
+
+        if opens:
+            db.session.execute(insert(EmailOpen), opens)
+        if clicks:
+            db.session.execute(insert(EmailClick), clicks)
+
+        unique_opened = self._insert_unique(EmailUniqueOpen, 'first_opened_at', opens)
+        unique_clicked = self._insert_unique(EmailUniqueClick, 'first_clicked_at', clicks)
+
+        # One counter update per job, applied in the database
+        opened = Counter(row['job_id'] for row in opens)
+        clicked = Counter(row['job_id'] for row in clicks)
+        for job_id in sorted(opened.keys() | clicked.keys()):
+            ScheduledJob.increment_counters(
+                job_id,
+                opened_emails=opened[job_id],
+                clicked_emails=clicked[job_id],
+                unique_opens=unique_opened[job_id],
+                unique_clicks=unique_clicked[job_id]
+            )
+
+        skipped = len(events) - len(opens) - len(clicks)
+        if skipped:
+            logging.debug(f"Dropped {skipped} tracking events for unknown jobs or contacts")
+
+        return len(opens) + len(clicks)
+
+    def _insert_unique(self, model, timestamp_column, rows):
+        """Record first events per (job, contact) and count the new ones per job"""
+        first = {}
+        for row in rows:
+            key = (row['job_id'], row['contact_id'])
+            if key not in first or row['timestamp'] < first[key]:
+                first[key] = row['timestamp']
+
+        new = Counter()
+        unique_rows = [
+            {'job_id': job_id, 'contact_id': contact_id, timestamp_column: timestamp}
+            for (job_id, contact_id), timestamp in first.items()
+        ]
+        for chunk in chunked(unique_rows):
+            # RETURNING only yields the rows that were actually inserted
+            stmt = insert_ignore(model).values(chunk).returning(model.job_id)
+            new.update(db.session.scalars(stmt))
+
+        return new
+
+
+def _fit(value, column):
+    """Cut a value taken from the request to the length of its column"""
+    return value[:column.type.length] if value else value
+
+
+tracking_buffer = TrackingBuffer()
@@ -0,0 +1,117 @@
+"""Signed tracking tokens for open and click URLs.
+
+A token packs the job id, contact id, link index and the day it was issued
+into 12 bytes, followed by a truncated HMAC-SHA256 over the token kind and
+those bytes, all base64url-encoded without padding into 30 characters. The
+tracking routes check it with no database read; a forged or tampered token
+fails the signature check, and tokens older than TOKEN_MAX_AGE_DAYS are
+refused.
+
+Click tokens for links that aren't CampaignLinks (NO_LINK) carry their URL
+in the query string; their signature also covers that URL, so the token
+can't be reused to redirect anywhere else.
+
+The signing key is derived from the app's secret key, so rotating
+SESSION_SECRET invalidates tokens in emails already sent.
+"""
+import base64
+import binascii
+import hashlib
+import hmac
+import struct
+import time
+from collections import namedtuple
+
+from flask import current_app
+
+OPEN = b'o'
+CLICK = b'c'
+
+# Tokens older than this are no longer recorded
+TOKEN_MAX_AGE_DAYS = 365
+
+# Link index of click tokens whose URL is carried in the query string rather
+# than looked up in the job's CampaignLink rows
+NO_LINK = 0xFFFF
+
+# Bytes of the HMAC kept in the token
+SIGNATURE_BYTES = 10
+
+# job id, contact id, link index, issue day (days since the epoch)
+_PAYLOAD = struct.Struct('>IIHH')
+_TOKEN_BYTES = _PAYLOAD.size + SIGNATURE_BYTES
+
+TrackingToken = namedtuple('TrackingToken', ['job_id', 'contact_id', 'link_index', 'issued_day', 'expired'])
+
+# HMAC objects already keyed and fed the token kind, per (secret, kind);
+# copying one is cheaper than keying a new one for every token
+_signers = {}
+
+
+def _signer(kind):
+    secret = current_app.secret_key
+    signer = _signers.get((secret, kind))
+    if signer is None:
+        raw_secret = secret.encode() if isinstance(secret, str) else secret
+        key = hmac.new(raw_secret, b'email-tracking-token', hashlib.sha256).digest()
+        signer = hmac.new(key, kind, hashlib.sha256)
+        _signers[(secret, kind)] = signer
+    return signer
+
+
+def _today():
+    return int(time.time() // 86400)
+
+
+def _sign(kind, payload, url=None):
+    mac = _signer(kind).copy()
+    mac.update(payload)
+    if url is not None:
+        mac.update(url.encode('utf-8'))
+    return mac.digest()[:SIGNATURE_BYTES]
+
+
+def make_token(kind, job_id, contact_id, link_index=0, url=None):
+    """Return the URL-safe token for an open (link_index 0) or a click on a link
+
+    Args:
+        url: for NO_LINK click tokens, the URL the click goes to
+    """
+    payload = _PAYLOAD.pack(job_id, contact_id, link_index, _today())
+    if link_index == NO_LINK and url is None:
+        raise ValueError("A NO_LINK token needs its URL")
+    token = payload + _sign(kind, payload, url if link_index == NO_LINK else None)
+    return base64.urlsafe_b64encode(token).rstrip(b'=').decode('ascii')
+
+
+def verify_token(kind, token, url=None):
+    """Decode and check a token.
+
+    Args:
+        url: the URL a NO_LINK click token was given with
+
+    Returns:
+        TrackingToken, with expired set if it is older than TOKEN_MAX_AGE_DAYS,
+        or None if the token is malformed or the signature doesn't match
+    """
+    try:
+        raw = base64.urlsafe_b64decode(token.encode('ascii') + b'=' * (-len(token) % 4))
+    except (binascii.Error, ValueError, UnicodeEncodeError):
+        return None
+
+    if len(raw) != _TOKEN_BYTES:
+        return None
+
+    payload, signature = raw[:_PAYLOAD.size], raw[_PAYLOAD.size:]
+    job_id, contact_id, link_index, issued_day = _PAYLOAD.unpack(payload)
+    if link_index == NO_LINK:
+        if url is None:
+            return None
+        expected = _sign(kind, payload, url)
+    else:
+        expected = _sign(kind, payload)
+    if not hmac.compare_digest(signature, expected):
+        return None
+
+    age = _today() - issued_day
+    return TrackingToken(job_id, contact_id, link_index, issued_day, age > TOKEN_MAX_AGE_DAYS or age < -1)
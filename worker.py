@@ -0,0 +1,70 @@
+"""
+Send worker: sends campaign email from the send_work_item queue.
+
+When USE_SEND_WORKERS is set, the scheduler queues each campaign as work
+items instead of sending it in the web process (see send_queue.py). Run as
+many workers as needed, on any hosts that share the database:
+
+    python -m worker
+
+Each worker has its own SMTP connection pool and handles one work item at a
+time. SIGTERM or Ctrl+C stops it after the current batch, putting its item
+back in the queue.
+"""
+import logging
+import os
+import signal
+import socket
+import threading
+
+# Workers only send; leave the scheduler and tracking buffer to the web processes
+os.environ["SEND_WORKER"] = "1"
+
+from app import app, db
+import send_queue
+
+# Seconds between queue checks while there's nothing to send
+POLL_SECONDS = 2
+
+def run_worker():
+    """Claim and send work items until stopped"""
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        logging.info(f"Worker {worker_id} stopping after its current batch")
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    # CampaignSender per job, kept while the job still has items for us
+    senders = {}
+
+    with app.app_context():
+        logging.info(f"Send worker {worker_id} started")
+        try:
+            while not stopping.is_set():
+                try:
+                    item = send_queue.claim_work_item(worker_id)
+                    if item is None:
+                        # Idle: don't hold SMTP sessions open for finished jobs
+                        send_queue.close_senders(senders)
+                        stopping.wait(POLL_SECONDS)
+                        continue
+
+                    sent, failed = send_queue.process_work_item(app, item, senders, should_stop=stopping.is_set)
+                    logging.info(f"Work item {item.id} of job {item.job_id}: sent {sent}, failed {failed}")
+                except Exception as e:
+                    # The item is handed out again once its claim times out
+                    db.session.rollback()
+                    logging.exception(f"Error processing work item: {e}")
+                    stopping.wait(POLL_SECONDS)
+                finally:
+                    db.session.remove()
+        finally:
+            send_queue.close_senders(senders)
+            logging.info(f"Send worker {worker_id} stopped")
+
+if __name__ == "__main__":
+    run_worker()